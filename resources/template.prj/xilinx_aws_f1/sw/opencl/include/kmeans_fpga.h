@@ -12,9 +12,53 @@
 
 #define NUM_CHANNELS 1
 #define NUM_HW_INPUT 32
+//feature width of the generated kernel, set by data_width.mk
+#ifndef DATA_INPUT_HW_BITS
 #define DATA_INPUT_HW_BITS 16
+#endif
+#define DATA_INPUT_HW_BYTES (DATA_INPUT_HW_BITS / 8.0)
+//centroids of a multipass kernel, set by block_clusters.mk: the clusters are
+//classified in passes of that many centroids and the kernel writes the
+//distance of every point above the ID of its nearest centroid of the pass
+#ifndef KMEANS_HW_BLOCK_CLUSTERS
+#define KMEANS_HW_BLOCK_CLUSTERS 0
+#endif
+#if KMEANS_HW_BLOCK_CLUSTERS > 0
+#define DATA_OUTPUT_HW_BITS 64
+#else
 #define DATA_OUTPUT_HW_BITS 8
+#endif
+#define DATA_OUTPUT_HW_BYTES (DATA_OUTPUT_HW_BITS / 8)
+//set by accumulate.mk: the kernel writes the coordinate sums and the point
+//count of every cluster, a 64-bit word each, instead of the labels
+#ifndef KMEANS_HW_ACCUMULATE
+#define KMEANS_HW_ACCUMULATE 0
+#endif
+#if KMEANS_HW_ACCUMULATE && KMEANS_HW_BLOCK_CLUSTERS > 0
+#error "the accumulate kernels do not run in multipass"
+#endif
+//lines of points kept on chip by a persistent kernel, set by persistent.mk:
+//the kernel runs the iterations up to the maximum of the header and writes
+//the passes and the final centroids, a 64-bit word each
+#ifndef KMEANS_HW_PERSISTENT
+#define KMEANS_HW_PERSISTENT 0
+#endif
+#if KMEANS_HW_PERSISTENT > 0 && (KMEANS_HW_ACCUMULATE || KMEANS_HW_BLOCK_CLUSTERS > 0)
+#error "the persistent kernels neither accumulate nor run in multipass"
+#endif
+//set by header.mk: the centroid header holds a 16-bit value per coordinate,
+//in IMM ID order, instead of a 64-bit IMM ID and value pair
+#ifndef KMEANS_HW_DENSE_HEADER
+#define KMEANS_HW_DENSE_HEADER 0
+#endif
+#if KMEANS_HW_DENSE_HEADER && (KMEANS_HW_PERSISTENT > 0 || DATA_INPUT_HW_BITS > 16)
+#error "the dense header holds features of up to 16 bits, for kernels that are not persistent"
+#endif
+#if KMEANS_HW_DENSE_HEADER
+#define CLUSTER_HW_BITS 16
+#else
 #define CLUSTER_HW_BITS 64
+#endif
 #define CL1 512
 #define CL4 2048
 #define INITIAL_CONF_ID 0
@@ -36,6 +80,57 @@ using namespace std::chrono;
 typedef unsigned char byte;
 typedef unsigned short uint16;
 
+#if KMEANS_HW_BLOCK_CLUSTERS > 0
+typedef uint16 label_t;
+#else
+typedef byte label_t;
+#endif
+
+#if DATA_INPUT_HW_BITS < 1 || DATA_INPUT_HW_BITS > 32
+#error "DATA_INPUT_HW_BITS must be between 1 and 32"
+#endif
+
+//features are packed densely, LSB first, so they may straddle bytes and cache lines
+inline void store_feature(byte *base, size_t index, unsigned int value){
+    size_t bit = index * DATA_INPUT_HW_BITS;
+    unsigned long long mask = ((1ULL << DATA_INPUT_HW_BITS) - 1) << (bit % 8);
+    unsigned long long window = ((unsigned long long) value << (bit % 8)) & mask;
+    for (size_t i = bit / 8, b = 0; i <= (bit + DATA_INPUT_HW_BITS - 1) / 8; i++, b += 8) {
+        base[i] = (byte) ((base[i] & ~(mask >> b)) | (window >> b));
+    }
+}
+
+inline unsigned int load_feature(const byte *base, size_t index){
+    size_t bit = index * DATA_INPUT_HW_BITS;
+    unsigned long long window = 0;
+    for (size_t i = bit / 8, b = 0; i <= (bit + DATA_INPUT_HW_BITS - 1) / 8; i++, b += 8) {
+        window |= (unsigned long long) base[i] << b;
+    }
+    return (unsigned int) ((window >> (bit % 8)) & ((1ULL << DATA_INPUT_HW_BITS) - 1));
+}
+
+//labels, or multipass states, that the kernel writes for num_points: a word
+//per core of every beat. Behind the input gearbox a beat takes one core more
+//than the whole points of a line and the last, partial beat is flushed, so
+//the padding of the last beat has words too. The points of two lines or more
+//are split into tiles, a word per point
+inline size_t output_words(size_t num_points, size_t num_dims){
+    size_t point_width = num_dims * DATA_INPUT_HW_BITS;
+    size_t lines = (num_points * point_width + CL1 - 1) / CL1;
+    size_t cores = (CL1 + point_width - 1) / point_width;
+    size_t tiles = 1;
+    if (point_width >= 2 * CL1) {
+        size_t tile_dims = (num_dims + point_width / CL1 - 1) / (point_width / CL1);
+        tiles = (num_dims + tile_dims - 1) / tile_dims;
+    }
+    //bits of the beats before the last tile of a point
+    size_t first_tiles = (tiles - 1) * cores * DATA_INPUT_HW_BITS * ((num_dims + tiles - 1) / tiles);
+    if (lines * CL1 <= first_tiles) {
+        return 0;
+    }
+    return cores * ((lines * CL1 - first_tiles + cores * point_width - 1) / (cores * point_width));
+}
+
 class KmeansFpga{
     
 private:
@@ -64,8 +159,18 @@ private:
   int *m_clusters;
   int *m_clusters_old;
   
-  uint16 *m_input_data;
+  byte *m_input_data;
   byte *m_output_data;
+  label_t *m_labels;
+  
+  //multipass: centroids of the current pass in the input, and the distance
+  //of every point to its nearest centroid of the passes so far
+  int *m_block_clusters;
+  unsigned long long *m_distances;
+  
+  //dense header: the centroid values in the input, packed from the
+  //clusters before every launch
+  uint16 *m_dense_clusters;
   
   void kmeans_process();
   
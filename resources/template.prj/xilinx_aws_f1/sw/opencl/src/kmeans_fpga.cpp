@@ -54,18 +54,25 @@ int KmeansFpga::kmeans_allocate(int num_points, int num_clusters, int num_dims){
     m_num_dims = num_dims;
     m_num_clusters = num_clusters;
       
+    int hw_clusters = KMEANS_HW_BLOCK_CLUSTERS > 0 ? KMEANS_HW_BLOCK_CLUSTERS : num_clusters;
     m_config_bytes = 64; //aligned in 64 bytes
-    m_cluster_bytes = std::ceil((num_clusters * num_dims * 8.0)/64.0)*64.0; //aligned in 64 bytes
-    m_points_bytes = std::ceil((num_points * num_dims * 2.0)/64.0)*64.0;   //aligned in 64 bytes
+    m_cluster_bytes = std::ceil((hw_clusters * num_dims * (CLUSTER_HW_BITS / 8.0))/64.0)*64.0; //aligned in 64 bytes
+    m_points_bytes = std::ceil((num_points * num_dims * (double)DATA_INPUT_HW_BYTES)/64.0)*64.0;   //aligned in 64 bytes
     m_input_size_bytes = (size_t)(m_config_bytes + m_cluster_bytes + m_points_bytes);//aligned in 64 bytes
     
     
-    //(((m_points_bytes/64)/(512/((512/16/num_dims)*8))) * 64);
-    //               |                  |                   |____ acelerator input size in bytes
-    //               |                  |________________________ acerarator output size per input
-    //               |___________________________________________ number of inputs to acelerator
-        
-    m_output_size_bytes = (size_t)(std::ceil(m_points_bytes/(2 * m_num_dims)/64.0)*64.0);//simplification of the formula above and aligned to 64 bytes
+    //a label, or a multipass state, per core of every beat, aligned to 64 bytes
+    m_output_size_bytes = (size_t)(std::ceil(output_words(num_points, num_dims) * (double)DATA_OUTPUT_HW_BYTES/64.0)*64.0);
+#if KMEANS_HW_ACCUMULATE
+    m_output_size_bytes = (size_t)(std::ceil(num_clusters * (num_dims + 1) * 8.0/64.0)*64.0);
+#endif
+#if KMEANS_HW_PERSISTENT > 0
+    if (m_points_bytes / 64 > KMEANS_HW_PERSISTENT) {
+        std::cout << "The points take more than the " << KMEANS_HW_PERSISTENT << " lines of the persistent kernel\n";
+        exit(EXIT_FAILURE);
+    }
+    m_output_size_bytes = (size_t)(std::ceil((1 + num_clusters * num_dims) * 8.0/64.0)*64.0);
+#endif
     
     posix_memalign((void**)&m_main_data,4096,m_input_size_bytes); //m_main_data = (byte *) malloc(m_input_size_bytes);
     posix_memalign((void**)&m_clusters_old,4096,sizeof(int) * num_clusters * num_dims);//m_clusters_old = (int *) malloc(sizeof(int) * num_clusters * num_dims);
@@ -73,10 +80,27 @@ int KmeansFpga::kmeans_allocate(int num_points, int num_clusters, int num_dims){
     
     m_num_conf = (int *) &m_main_data[INITIAL_CONF_ID];
     m_clusters = (int *) &m_main_data[INITIAL_CLUSTER_ID];
-    m_num_conf[0] = (num_clusters * num_dims);
+    m_num_conf[0] = (hw_clusters * num_dims);
+    m_num_conf[2] = num_points; //bounds the points accumulated past the padding of the last line
+    m_labels = (label_t *) m_output_data;
+#if KMEANS_HW_BLOCK_CLUSTERS > 0
+    //all the clusters live on the host, copied to the input one pass at a time
+    m_block_clusters = m_clusters;
+    m_clusters = (int *) malloc(sizeof(int) * 2 * num_clusters * num_dims);
+    m_labels = (label_t *) malloc(sizeof(label_t) * num_points);
+    m_distances = (unsigned long long *) malloc(sizeof(unsigned long long) * num_points);
+#endif
+#if KMEANS_HW_DENSE_HEADER
+    //the clusters live on the host, as for multipass, and only their values
+    //go to the input
+    m_dense_clusters = (uint16 *) &m_main_data[INITIAL_CLUSTER_ID];
+#if KMEANS_HW_BLOCK_CLUSTERS == 0
+    m_clusters = (int *) malloc(sizeof(int) * 2 * num_clusters * num_dims);
+#endif
+#endif
 
     int idx = m_config_bytes+m_cluster_bytes;
-    m_input_data = (uint16 *) &m_main_data[idx];
+    m_input_data = &m_main_data[idx];
     
    OCL_CHECK(err, m_input_buffer = cl::Buffer(m_context, CL_MEM_ALLOC_HOST_PTR | CL_MEM_READ_ONLY, m_input_size_bytes, NULL, &err));
    OCL_CHECK(err, m_output_buffer = cl::Buffer(m_context, CL_MEM_ALLOC_HOST_PTR | CL_MEM_WRITE_ONLY, m_output_size_bytes, NULL, &err));
@@ -90,6 +114,13 @@ int KmeansFpga::kmeans_deallocate(){
     free(m_main_data);
     free(m_clusters_old);
     free(m_output_data);
+#if KMEANS_HW_BLOCK_CLUSTERS > 0
+    free(m_clusters);
+    free(m_labels);
+    free(m_distances);
+#elif KMEANS_HW_DENSE_HEADER
+    free(m_clusters);
+#endif
     return 0;
 }
 
@@ -113,7 +144,7 @@ int KmeansFpga::read_file(std::string &data_file){
         //please comment next line if it is desireble
         iss >> a;
         for (int j = 0; (iss >> a); j++) {
-            m_input_data[data_idx] = (short) a;
+            store_feature(m_input_data, data_idx, (unsigned int) a);
             data_idx++;
             if (j + 1 == m_num_dims) {
                 break;
@@ -166,11 +197,23 @@ void KmeansFpga::kmeans_clustering(int max_iterations, std::string &output_file)
   }
   //start kmeans
   int it;
-  int k_sum[m_num_clusters * m_num_dims];
+#if KMEANS_HW_PERSISTENT > 0
+  //a single launch runs the iterations: the kernel writes the passes, with
+  //the converged flag in bit 32, and the centroid configurations
+  m_num_conf[3] = max_iterations;
+  kmeans_process();
+  unsigned long long *result = (unsigned long long *) m_output_data;
+  int passes = (int) (result[0] & 0xffffffff);
+  it = (result[0] >> 32) & 1 ? passes - 1 : passes;
+  for (int j = 0; j < m_num_clusters * m_num_dims; j++) {
+      m_clusters[j * 2 + 1] = (int) (result[j + 1] >> 32);
+  }
+#else
+  long long k_sum[m_num_clusters * m_num_dims];
   int k_avg[m_num_clusters];
   
   for (it = 0; it < max_iterations; it++) {
-      memset(k_sum, 0, sizeof(int) * (m_num_clusters * m_num_dims));
+      memset(k_sum, 0, sizeof(long long) * (m_num_clusters * m_num_dims));
       memset(k_avg, 0, sizeof(int) * m_num_clusters);
       
       //call hw kmeans process
@@ -178,12 +221,23 @@ void KmeansFpga::kmeans_clustering(int max_iterations, std::string &output_file)
       
       //clusters update
       TIMER_START(UPDATE_CLUSTER_TIMER_ID);
+#if KMEANS_HW_ACCUMULATE
+      //sums and counts of the kernel, the count after the sums of a cluster
+      unsigned long long *accumulators = (unsigned long long *) m_output_data;
+      for (int i = 0; i < m_num_clusters; i++) {
+          for (int j = 0; j < m_num_dims; j++) {
+              k_sum[i * m_num_dims + j] = accumulators[i * (m_num_dims + 1) + j];
+          }
+          k_avg[i] = accumulators[i * (m_num_dims + 1) + m_num_dims];
+      }
+#else
       for (int i = 0; i < m_num_points; i++) {
           for (int j = 0; j < m_num_dims; j++) {
-              k_sum[m_output_data[i] * m_num_dims + j] += m_input_data[i * m_num_dims + j];
+              k_sum[m_labels[i] * m_num_dims + j] += load_feature(m_input_data, i * m_num_dims + j);
           }
-          k_avg[m_output_data[i]]++;
+          k_avg[m_labels[i]]++;
       }
+#endif
          
       int different = 0;
       for (int j = 0, n=m_num_clusters * m_num_dims; j < n; j++) {
@@ -201,6 +255,7 @@ void KmeansFpga::kmeans_clustering(int max_iterations, std::string &output_file)
           break;
       }
   }
+#endif
   TIMER_STOP_ID(CLUSTERING_TIMER_ID);
   
   
@@ -232,6 +287,29 @@ void KmeansFpga::kmeans_process(){
     
     TIMER_START(PROCESS_TIMER_ID);
     
+#if KMEANS_HW_BLOCK_CLUSTERS > 0
+    //one pass per block of centroids, the last one padded with its first
+    //centroid; the nearest over the passes is kept, ties to the first block
+    for (int base = 0; base < m_num_clusters; base += KMEANS_HW_BLOCK_CLUSTERS) {
+        for (int i = 0; i < KMEANS_HW_BLOCK_CLUSTERS; i++) {
+            int c = base + i < m_num_clusters ? base + i : base;
+            for (int j = 0; j < m_num_dims; j++) {
+#if KMEANS_HW_DENSE_HEADER
+                m_dense_clusters[i * m_num_dims + j] = (uint16) m_clusters[(c * m_num_dims + j) * 2 + 1];
+#else
+                int c_idx = (i * m_num_dims + j) * 2;
+                m_block_clusters[c_idx + 0] = i * m_num_dims + j + 1;
+                m_block_clusters[c_idx + 1] = m_clusters[(c * m_num_dims + j) * 2 + 1];
+#endif
+            }
+        }
+        m_num_conf[1] = base; //centroid ID base of the pass
+#elif KMEANS_HW_DENSE_HEADER
+    //the value of every coordinate in the slot of its IMM ID
+    for (int j = 0; j < m_num_clusters * m_num_dims; j++) {
+        m_dense_clusters[j] = (uint16) m_clusters[j * 2 + 1];
+    }
+#endif
     OCL_CHECK(err, err = m_q.enqueueWriteBuffer(m_input_buffer, CL_TRUE, 0,
                                                 m_config_bytes + m_cluster_bytes, //No need to send the points again, just the clusters
                                                 m_main_data, NULL, NULL));
@@ -244,6 +322,17 @@ void KmeansFpga::kmeans_process(){
     OCL_CHECK(err, err = m_q.enqueueReadBuffer(m_output_buffer, CL_TRUE, 0,
                                                m_output_size_bytes,
                                                m_output_data, NULL, NULL));
+#if KMEANS_HW_BLOCK_CLUSTERS > 0
+        unsigned long long *states = (unsigned long long *) m_output_data;
+        for (int i = 0; i < m_num_points; i++) {
+            unsigned long long distance = states[i] >> 16;
+            if (base == 0 || distance < m_distances[i]) {
+                m_distances[i] = distance;
+                m_labels[i] = (label_t) (states[i] & 0xffff);
+            }
+        }
+    }
+#endif
     TIMER_STOP_ID(PROCESS_TIMER_ID);
     
     if(m_iteration_count == 0)
@@ -1,10 +1,11 @@
 import pynq
-import sys
 import numpy as np
 import random
 import time
 from datetime import timedelta
 from math import ceil
+from kmeans_packing import header_line, flat_clusters, flat_data, output_bytes, merge_states, unpack_accumulators, \
+    unpack_persistent
 
 class KmeansHLS(pynq.DefaultIP):
     """
@@ -52,26 +53,59 @@ class KmeansHw(pynq.DefaultIP):
         self._fullpath = description['fullpath']
         self.input_buffer = []
         self.output_buffer = []
+        self.data_width = 16
+        # centroids of a multipass kernel (create_project --multipass), that
+        # classifies K beyond them in passes of block_k centroids
+        self.block_k = None
+        # the kernel writes the coordinate sums and point count of every
+        # cluster instead of the labels (create_project --accumulate)
+        self.accumulate = False
+        # lines of points of a persistent kernel (create_project
+        # --persistent), that runs up to max_iter iterations per launch
+        self.persistent = 0
+        self.max_iter = 0
+        self.num_points = 0
+        # centroid configuration format of the kernel (create_project
+        # --header): sparse IMM ID and value pairs, or dense 16-bit values
+        self.header = 'sparse'
     
     def allocate(self, k, n, num_points):
+        data_bytes = self.data_width / 8.0
         num_config_bytes = 64
-        num_cluster_bytes = int(ceil((k*n*8.0)/64.0)*64.0)
-        num_points_bytes = int(ceil((num_points * n * 2.0)/64.0)*64.0)
+        if self.block_k:
+            k = self.block_k
+        num_cluster_bytes = int(ceil((k*n*self.cluster_bytes())/64.0)*64.0)
+        num_points_bytes = int(ceil((num_points * n * data_bytes)/64.0)*64.0)
         total_in_bytes = num_config_bytes+num_cluster_bytes+num_points_bytes
-        total_out_bytes = int(ceil(num_points_bytes/(2 * n)/64.0)*64.0)
+        total_out_bytes = output_bytes(num_points, n, self.data_width)
+        if self.block_k:
+            # 64-bit distance and centroid ID per core of every beat
+            total_out_bytes = output_bytes(num_points, n, self.data_width, 8)
+        if self.accumulate:
+            # a 64-bit accumulator per coordinate and count of every cluster
+            total_out_bytes = int(ceil(k*(n+1)*8/64.0)*64.0)
+        if self.persistent:
+            if num_points_bytes // 64 > self.persistent:
+                raise Exception('The points take more than the %d lines of the persistent kernel' % self.persistent)
+            # the passes and a 64-bit configuration per centroid coordinate
+            total_out_bytes = int(ceil((1+k*n)*8/64.0)*64.0)
+        self.num_points = num_points
         self.input_buffer = pynq.allocate((total_in_bytes,),dtype=np.byte)
         self.output_buffer = pynq.allocate((total_out_bytes,),dtype=np.byte)
         
+    def cluster_bytes(self):
+        # bytes of the header per centroid coordinate
+        return 2 if self.header == 'dense' else 8
+    
     def flat_clusters(self,c):
-        flat_c = np.array(c,dtype='u4').flatten()
-        flat_idx = np.array([i for i in range(1,len(flat_c)+1)],dtype='u4')
-        flat_with_idx_clusters = np.array(list(zip(flat_idx,flat_c)),dtype='u4').flatten().tobytes()
-        return list(flat_with_idx_clusters)
+        return flat_clusters(c, self.header)
     
     def flat_data(self, d):
-        return list(np.array(d,dtype='u2').flatten().tobytes())
+        return flat_data(d, self.data_width)
     
     def classify(self, k, n, clusters, data):        
+        if self.block_k:
+            return self.classify_blocks(k, n, clusters, data)
         flat_with_idx_clusters = self.flat_clusters(clusters)  
         if len(data) > 0:
             self.allocate(k, n, len(data)) 
@@ -79,25 +113,80 @@ class KmeansHw(pynq.DefaultIP):
             self.input_buffer[64+len(flat_with_idx_clusters):64+len(flat_with_idx_clusters)+len(flat_data)] = flat_data
             self.input_buffer[64+len(flat_with_idx_clusters):64+len(flat_with_idx_clusters)+len(flat_data)].sync_to_device() 
             
-        self.input_buffer[0:64] = list(int(k * n).to_bytes(64,sys.byteorder))
+        # the number of points, in the second word of the header, bounds
+        # the points accumulated past the padding of the last line, and the
+        # iterations of a persistent kernel follow it
+        self.input_buffer[0:64] = header_line(k * n, self.num_points, self.max_iter)
         self.input_buffer[64:64+len(flat_with_idx_clusters)] = flat_with_idx_clusters
         self.input_buffer[0:64+len(flat_with_idx_clusters)].sync_to_device()        
         self.call(len(self.input_buffer), len(self.output_buffer),self.input_buffer, self.output_buffer)
         self.output_buffer.sync_from_device()
                
         return self.output_buffer
+    
+    def accumulate_clusters(self, k, n, clusters, data):
+        # coordinate sums (k x n) and point counts (k) of the clusters
+        self.classify(k, n, clusters, data)
+        return unpack_accumulators(self.output_buffer, k, n)
+    
+    def run_persistent(self, k, n, clusters, data, max_iter):
+        # a single launch: the passes run, whether the centroids converged
+        # and the final centroids (k x n)
+        self.max_iter = max_iter
+        self.classify(k, n, clusters, data)
+        return unpack_persistent(self.output_buffer, k, n)
+    
+    def classify_blocks(self, k, n, clusters, data):
+        # one pass per block of block_k centroids, the last one padded with its
+        # first centroid; the kernel writes the distance of every point to its
+        # nearest centroid of the pass above the centroid ID, offset by the ID
+        # base of the header, and the nearest over the passes is kept, ties to
+        # the first block
+        num_config_bytes = 64
+        num_cluster_bytes = int(ceil((self.block_k*n*self.cluster_bytes())/64.0)*64.0)
+        if len(data) > 0:
+            self.allocate(k, n, len(data))
+            flat_data = self.flat_data(data)
+            start = num_config_bytes + num_cluster_bytes
+            self.input_buffer[start:start+len(flat_data)] = flat_data
+            self.input_buffer[start:start+len(flat_data)].sync_to_device()
+        
+        labels = np.zeros((self.num_points,),dtype='u2')
+        best = np.full((self.num_points,),np.iinfo('u8').max,dtype='u8')
+        for base in range(0, k, self.block_k):
+            block = list(clusters[base:base+self.block_k])
+            block += [block[0]] * (self.block_k - len(block))
+            self.input_buffer[0:64] = header_line(self.block_k * n, id_base=base)
+            flat_with_idx_clusters = self.flat_clusters(block)
+            self.input_buffer[64:64+len(flat_with_idx_clusters)] = flat_with_idx_clusters
+            self.input_buffer[0:64+num_cluster_bytes].sync_to_device()
+            self.call(len(self.input_buffer), len(self.output_buffer),self.input_buffer, self.output_buffer)
+            self.output_buffer.sync_from_device()
+            merge_states(self.output_buffer, best, labels)
+               
+        return labels
        
     
 class KMeansFPGA():
-    def __init__(self, n_clusters, n_dims, max_iter = 10, xclbin=''):
+    def __init__(self, n_clusters, n_dims, max_iter = 10, xclbin='', data_width=16, block_k=None, accumulate=False,
+                 persistent=0, header='sparse'):
         self._xclbin = xclbin
         self._n_clusters = n_clusters
         self._n_dims = n_dims
         self._max_iter = max_iter
         self.ol = pynq.Overlay(xclbin)
         self.kmeans_hw = self.ol.kernel_top_1
+        self.kmeans_hw.data_width = data_width
+        self.kmeans_hw.block_k = block_k
+        self.kmeans_hw.accumulate = accumulate
+        self.kmeans_hw.persistent = persistent
+        self.kmeans_hw.header = header
         
     def fit(self, X):
+        if self.kmeans_hw.accumulate:
+            return self.fit_accumulated(X)
+        if self.kmeans_hw.persistent:
+            return self.fit_persistent(X)
         self.clusters = [ [j if i == 0 else 0 for i in range(self._n_dims)] for j in range(self._n_clusters) ]     
         clusters_old = self.clusters
         
@@ -137,7 +226,36 @@ class KMeansFPGA():
         return self
     
      
+    def fit_accumulated(self, X):
+        # the kernel sums the points of every cluster, so an iteration only
+        # divides the sums by the counts
+        self.clusters = [ [j if i == 0 else 0 for i in range(self._n_dims)] for j in range(self._n_clusters) ]     
+        data = X
+        for it in range(self._max_iter):
+            sums, counts = self.kmeans_hw.accumulate_clusters(self._n_clusters,self._n_dims,self.clusters,data)
+            data = []
+            clusters = [ [int(sums[j][d] // counts[j]) if counts[j] > 0 else self.clusters[j][d]
+                          for d in range(self._n_dims)] for j in range(self._n_clusters) ]
+            if clusters == self.clusters:
+                break
+            self.clusters = clusters
+        
+        return self
+     
+    def fit_persistent(self, X):
+        # the kernel iterates on chip and writes the final centroids
+        self.clusters = [ [j if i == 0 else 0 for i in range(self._n_dims)] for j in range(self._n_clusters) ]     
+        self.n_iter_, self.converged_, clusters = self.kmeans_hw.run_persistent(self._n_clusters,self._n_dims,
+                                                                                self.clusters,X,self._max_iter)
+        self.clusters = clusters.tolist()
+        
+        return self
+     
     def predict(self, X):
+        if self.kmeans_hw.accumulate or self.kmeans_hw.persistent:
+            # the kernel writes no labels: nearest centroid, ties to the first
+            distances = ((np.array(X,dtype=np.int64)[:,None,:] - np.array(self.clusters,dtype=np.int64)[None,:,:])**2).sum(axis=2)
+            return np.argmin(distances,axis=1)
         pred = self.kmeans_hw.classify(self._n_clusters,self._n_dims,self.clusters,X)
         return np.array(pred[:len(X)],dtype=int)
         
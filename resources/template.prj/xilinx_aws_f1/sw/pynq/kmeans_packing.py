@@ -0,0 +1,82 @@
+import sys
+import numpy as np
+
+# host side of the kernel buffers: the header line, the centroid
+# configuration and the points written to the kernel, and the words it
+# writes back, kept apart from the driver so they run without pynq
+
+# feature width of the kernel (create_project -w); other widths are packed
+# bit by bit
+data_types = {8: 'u1', 16: 'u2', 32: 'u4'}
+
+def header_line(entries, num_points=0, max_iter=0, id_base=0):
+    # 64 bytes: the configuration entries, the centroid ID base of a
+    # multipass kernel in bits 32 to 47, the number of points in the second
+    # word and the iterations of a persistent kernel above it
+    return list(int(entries | id_base << 32 | num_points << 64 | max_iter << 96).to_bytes(64,sys.byteorder))
+
+
+def flat_clusters(c, header='sparse'):
+    if header == 'dense':
+        # the values in IMM ID order, up to the end of the line so that
+        # the points start on a line
+        flat_c = np.array(c,dtype='u2').flatten()
+        return list(np.pad(flat_c,(0,-len(flat_c) % 32)).tobytes())
+    flat_c = np.array(c,dtype='u4').flatten()
+    flat_idx = np.array([i for i in range(1,len(flat_c)+1)],dtype='u4')
+    flat_with_idx_clusters = np.array(list(zip(flat_idx,flat_c)),dtype='u4').flatten().tobytes()
+    return list(flat_with_idx_clusters)
+
+
+def flat_data(d, data_width=16):
+    if data_width in data_types:
+        return list(np.array(d,dtype=data_types[data_width]).flatten().tobytes())
+    # features packed densely, LSB first, straddling bytes and cache lines
+    values = np.array(d,dtype='u4').flatten()
+    bits = (values[:,None] >> np.arange(data_width,dtype='u4')) & 1
+    return list(np.packbits(bits.astype('u1').flatten(),bitorder='little').tobytes())
+
+
+def output_bytes(num_points, n, data_width=16, word_bytes=1):
+    # bytes, in whole lines, of the labels, or the multipass states of
+    # word_bytes, that the kernel writes for num_points: a word per core of
+    # every beat. Behind the input gearbox a beat takes one core more than
+    # the whole points of a line and the last, partial beat is flushed, so
+    # the padding of the last beat has words too. The points of two lines or
+    # more are split into tiles, a word per point
+    point_width = n * data_width
+    lines = -(-num_points * point_width // 512)
+    cores = -(-512 // point_width)
+    tiles = 1
+    if point_width >= 2 * 512:
+        tiles = -(-n // -(-n // (point_width // 512)))
+    # bits of the beats before the last tile of a point
+    first_tiles = (tiles - 1) * cores * data_width * -(-n // tiles)
+    words = cores * -(-max(0, lines * 512 - first_tiles) // (cores * point_width))
+    return -(-words * word_bytes // 64) * 64
+def merge_states(output, best, labels):
+    # multipass: the 64-bit state of every point, its distance to the nearest
+    # centroid of the pass above the centroid ID, replaces the nearest of the
+    # previous passes when strictly nearer, so ties go to the first block
+    states = np.asarray(output).view('<u8')[:len(labels)]
+    distances = states >> np.uint64(16)
+    nearer = distances < best
+    best[nearer] = distances[nearer]
+    labels[nearer] = states[nearer] & np.uint64(0xffff)
+
+
+def unpack_accumulators(output, k, n):
+    # accumulate: the kernel drains the clusters in order, the n coordinate
+    # sums of a cluster followed by its point count, a 64-bit word each.
+    # Returns the sums (k x n) and the counts (k)
+    accumulators = np.asarray(output).view('<u8')[:k*(n+1)].reshape((k, n+1))
+    return accumulators[:, :n], accumulators[:, n]
+
+
+def unpack_persistent(output, k, n):
+    # persistent: a word with the passes and, in bit 32, whether the
+    # centroids converged, then the final centroids in the header format.
+    # Returns the passes, the convergence and the centroids (k x n)
+    result = np.asarray(output).view('<u8')[:1+k*n]
+    centroids = (result[1:] >> np.uint64(32)).astype(int).reshape((k, n))
+    return int(result[0] & np.uint64(0xffffffff)), bool(result[0] >> np.uint64(32) & np.uint64(1)), centroids
@@ -0,0 +1,117 @@
+import argparse
+import time
+
+from make_kmeans_core import make_kmeans_core
+from components import Components
+from kmeans_accelerator import KmeanAcc
+from create_acc_axi_interface import AccAXIInterface
+from utils import Node, generate_kmeans_core
+
+
+def create_args():
+    parser = argparse.ArgumentParser('benchmark_generation -h')
+    parser.add_argument('-N', '--dimensions', help='Dimensions to benchmark', type=int, nargs='+',
+                        default=[2, 4, 8, 16])
+    parser.add_argument('-K', '--centroids', help='Clusters to benchmark', type=int, nargs='+',
+                        default=[2, 4, 16, 64])
+    parser.add_argument('-w', '--data-width', help='Data width', type=int, default=16)
+    parser.add_argument('-r', '--repeat', help='Repetitions per configuration (best is reported)', type=int,
+                        default=3)
+    parser.add_argument('--skip-scan', help='Do not time the full-graph input scan', action='store_true')
+    parser.add_argument('--emission', help='Compare the size and emission time of the flat and generate Verilog '
+                                           'instead of the DFG lowering', action='store_true')
+
+    return parser.parse_args()
+
+
+def node_graph(core):
+    # the graph as the dict of Node successor lists it was stored in before
+    # the flat arrays
+    nodes = [Node(core.ids[node], Node.Type(core.types[node])) for node in core.keys()]
+    return {nodes[node]: [nodes[succ] for succ in core.successors(node)] for node in core.keys()}
+
+
+def scan_inputs(graph):
+    # lookup used before the predecessor index, on the dict of Node successor
+    # lists: one full graph scan per node, comparing the node names
+    inputs = {}
+    for node in graph.keys():
+        name = str(node)
+        inputs[name] = []
+        for dict_key, values in graph.items():
+            for value in values:
+                if name == str(value):
+                    inputs[name].append(str(dict_key))
+    return inputs
+
+
+def index_inputs(core):
+    succ_ptr, succ, pred_ptr, pred = core._build_csr()
+    return [pred[pred_ptr[node]:pred_ptr[node + 1]] for node in core.keys()]
+
+
+def best_of(repeat, fn, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def components_array():
+    return {'ADD': Components().create_add(),
+            'CMP': Components().create_cmp(),
+            'IMM': Components().create_imm(),
+            'QUAD': Components().create_quad(),
+            'SUB': Components().create_sub(),
+            'REG': Components().create_reg()}
+
+
+def emit(k, dimensions, data_width, emission):
+    kernel_top = AccAXIInterface(KmeanAcc(512, data_width, [k], dimensions, 1, emission)).create_kernel_top()
+    start = time.perf_counter()
+    verilog = kernel_top.to_verilog()
+    return verilog, time.perf_counter() - start
+
+
+def benchmark_emission(args):
+    print('%5s %5s %10s %10s %10s %10s %10s %10s' % ('K', 'N', 'flat (B)', 'lines', 'emit (s)', 'gen (B)', 'lines',
+                                                     'emit (s)'))
+    for k in args.centroids:
+        for dimensions in args.dimensions:
+            row = [k, dimensions]
+            for emission in ['flat', 'generate']:
+                best = None
+                for _ in range(args.repeat):
+                    verilog, elapsed = emit(k, dimensions, args.data_width, emission)
+                    best = elapsed if best is None else min(best, elapsed)
+                row.extend([len(verilog), verilog.count('\n'), best])
+            print('%5d %5d %10d %10d %10.4f %10d %10d %10.4f' % tuple(row))
+
+
+def main():
+    args = create_args()
+    components = components_array()
+
+    if args.emission:
+        benchmark_emission(args)
+        return
+
+    print('%5s %5s %8s %10s %12s %12s %9s %14s' % ('K', 'N', 'nodes', 'build (s)', 'scan (s)', 'index (s)',
+                                                   'speedup', 'lowering (s)'))
+    for k in args.centroids:
+        for dimensions in args.dimensions:
+            core = generate_kmeans_core(k, dimensions)
+            build = best_of(args.repeat, generate_kmeans_core, k, dimensions)
+            scan = best_of(args.repeat, scan_inputs, node_graph(core)) if not args.skip_scan else float('nan')
+            index = best_of(args.repeat, index_inputs, core)
+            lowering = best_of(args.repeat, make_kmeans_core, args.data_width, k, k, dimensions, components)
+            print('%5d %5d %8d %10.4f %12.4f %12.4f %8.1fx %14.4f' % (k, dimensions, len(core), build, scan, index,
+                                                                    scan / index, lowering))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,7 @@
-from math import ceil, log2
-
 from veriloggen import *
 
-from utils import initialize_regs
+from utils import initialize_regs, pipeline_depth, line_cores, bits, state_id_width, accumulator_width, \
+    header_slot_width
 
 
 class Components:
@@ -16,8 +15,8 @@ class Components:
     def __init__(self):
         self.cache = {}
 
-    def create_add(self):
-        name = 'm_add'
+    def create_add(self, num_inputs=2):
+        name = 'm_add' if num_inputs == 2 else 'm_add%d' % num_inputs
         if name in self.cache.keys():
             return self.cache[name]
 
@@ -28,26 +27,52 @@ class Components:
 
         clk = m.Input('clk')
         rst = m.Input('rst')
-        data_in_0 = m.Input('data_in_0', data_width)
-        data_in_1 = m.Input('data_in_1', data_width)
+        data_in = [m.Input('data_in_%d' % i, data_width) for i in range(num_inputs)]
         data_out = m.OutputReg('data_out', data_width)
 
         m.EmbeddedCode('//Separation of the centroid ID values from the data to be processed')
-        data_0 = m.Wire('data_0', data_width - centroid_id_width)
-        data_1 = m.Wire('data_1', data_width - centroid_id_width)
+        data = [m.Wire('data_%d' % i, data_width - centroid_id_width) for i in range(num_inputs)]
         centroid_id = m.Wire('centroid_id', centroid_id_width)
 
         m.EmbeddedCode(' ')
         m.EmbeddedCode('//Assigns')
-        data_0.assign(data_in_0[0:data_width - centroid_id_width])
-        data_1.assign(data_in_1[0:data_width - centroid_id_width])
-        centroid_id.assign(data_in_0[data_width - centroid_id_width:data_width])
+        for i in range(num_inputs):
+            data[i].assign(data_in[i][0:data_width - centroid_id_width])
+        centroid_id.assign(data_in[0][data_width - centroid_id_width:data_width])
+
+        m.Always(Posedge(clk))(
+            If(rst)(
+                data_out(0),
+            ).Else(
+                data_out(Cat(centroid_id, sum(data[1:], data[0]))),
+            )
+        )
+
+        initialize_regs(m)
+        self.cache[name] = m
+
+        return m
+
+    def create_add_noid(self, num_inputs=2):
+        # adder of the datapath without centroid IDs
+        name = ('m_add' if num_inputs == 2 else 'm_add%d' % num_inputs) + '_noid'
+        if name in self.cache.keys():
+            return self.cache[name]
+
+        m = Module(name)
+
+        data_width = m.Parameter('DATA_WIDTH', 16)
+
+        clk = m.Input('clk')
+        rst = m.Input('rst')
+        data_in = [m.Input('data_in_%d' % i, data_width) for i in range(num_inputs)]
+        data_out = m.OutputReg('data_out', data_width)
 
         m.Always(Posedge(clk))(
             If(rst)(
                 data_out(0),
             ).Else(
-                data_out(Cat(centroid_id, (data_0 + data_1))),
+                data_out(sum(data_in[1:], data_in[0])),
             )
         )
 
@@ -56,8 +81,10 @@ class Components:
 
         return m
 
-    def create_cmp(self):
-        name = 'm_comp'
+    def create_acc(self):
+        # sum of the partial distances of the tiles of a point: the first
+        # tile restarts the sum, and the sum holds between the beats
+        name = 'm_acc'
         if name in self.cache.keys():
             return self.cache[name]
 
@@ -65,30 +92,109 @@ class Components:
 
         data_width = m.Parameter('DATA_WIDTH', 16)
         centroid_id_width = m.Parameter('CENTROID_ID_WIDTH', 8)
+
         clk = m.Input('clk')
         rst = m.Input('rst')
+        en = m.Input('en')
+        first = m.Input('first')
         data_in_0 = m.Input('data_in_0', data_width)
-        data_in_1 = m.Input('data_in_1', data_width)
         data_out = m.OutputReg('data_out', data_width)
 
         m.EmbeddedCode('//Separation of the centroid ID values from the data to be processed')
         data_0 = m.Wire('data_0', data_width - centroid_id_width)
-        data_1 = m.Wire('data_1', data_width - centroid_id_width)
-        centroid_id_0 = m.Wire('centroid_id_0', centroid_id_width)
-        centroid_id_1 = m.Wire('centroid_id_1', centroid_id_width)
+        total = m.Wire('total', data_width - centroid_id_width)
+        centroid_id = m.Wire('centroid_id', centroid_id_width)
 
         m.EmbeddedCode(' ')
         m.EmbeddedCode('//Assigns')
         data_0.assign(data_in_0[0:data_width - centroid_id_width])
-        data_1.assign(data_in_1[0:data_width - centroid_id_width])
-        centroid_id_0.assign(data_in_0[data_width - centroid_id_width:data_width])
-        centroid_id_1.assign(data_in_1[data_width - centroid_id_width:data_width])
+        total.assign(data_out[0:data_width - centroid_id_width])
+        centroid_id.assign(data_in_0[data_width - centroid_id_width:data_width])
+
+        m.Always(Posedge(clk))(
+            If(rst)(
+                data_out(0),
+            ).Elif(en)(
+                data_out(Cat(centroid_id, Mux(first, data_0, total + data_0))),
+            )
+        )
+
+        initialize_regs(m)
+        self.cache[name] = m
+
+        return m
+
+    def create_acc_noid(self):
+        # tile accumulator of the datapath without centroid IDs
+        name = 'm_acc_noid'
+        if name in self.cache.keys():
+            return self.cache[name]
+
+        m = Module(name)
+
+        data_width = m.Parameter('DATA_WIDTH', 16)
+
+        clk = m.Input('clk')
+        rst = m.Input('rst')
+        en = m.Input('en')
+        first = m.Input('first')
+        data_in_0 = m.Input('data_in_0', data_width)
+        data_out = m.OutputReg('data_out', data_width)
+
+        m.Always(Posedge(clk))(
+            If(rst)(
+                data_out(0),
+            ).Elif(en)(
+                data_out(Mux(first, data_in_0, data_out + data_in_0)),
+            )
+        )
+
+        initialize_regs(m)
+        self.cache[name] = m
+
+        return m
+
+    def create_cmp(self, num_inputs=2):
+        # minimum of the inputs; between equal values the last input wins,
+        # make_kmeans_core orders the inputs from the last centroid to the
+        # first
+        name = 'm_comp' if num_inputs == 2 else 'm_comp%d' % num_inputs
+        if name in self.cache.keys():
+            return self.cache[name]
+
+        m = Module(name)
+
+        data_width = m.Parameter('DATA_WIDTH', 16)
+        centroid_id_width = m.Parameter('CENTROID_ID_WIDTH', 8)
+        clk = m.Input('clk')
+        rst = m.Input('rst')
+        data_in = [m.Input('data_in_%d' % i, data_width) for i in range(num_inputs)]
+        data_out = m.OutputReg('data_out', data_width)
+
+        m.EmbeddedCode('//Separation of the centroid ID values from the data to be processed')
+        data = [m.Wire('data_%d' % i, data_width - centroid_id_width) for i in range(num_inputs)]
+        centroid_id = [m.Wire('centroid_id_%d' % i, centroid_id_width) for i in range(num_inputs)]
+
+        m.EmbeddedCode(' ')
+        m.EmbeddedCode('//Assigns')
+        for i in range(num_inputs):
+            data[i].assign(data_in[i][0:data_width - centroid_id_width])
+        for i in range(num_inputs):
+            centroid_id[i].assign(data_in[i][data_width - centroid_id_width:data_width])
+
+        best = Cat(centroid_id[-1], data[-1])
+        best_data = data[-1]
+        for i in reversed(range(1, num_inputs - 1)):
+            wire = m.Wire('best_%d' % i, data_width)
+            wire.assign(Mux(data[i] < best_data, Cat(centroid_id[i], data[i]), best))
+            best = wire
+            best_data = wire[0:data_width - centroid_id_width]
 
         m.Always(Posedge(clk))(
             If(rst)(
                 data_out(0),
             ).Else(
-                data_out(Mux(data_0 < data_1, Cat(centroid_id_0, data_0), Cat(centroid_id_1, data_1))),
+                data_out(Mux(data[0] < best_data, Cat(centroid_id[0], data[0]), best)),
             )
         )
 
@@ -97,8 +203,10 @@ class Components:
 
         return m
 
-    def create_imm(self):
-        name = 'm_imm'
+    def create_imm(self, shadow=False):
+        # shadow: the configurations are written to a shadow register, that
+        # replaces the immediate when swap is high
+        name = 'm_imm_shadow' if shadow else 'm_imm'
         if name in self.cache.keys():
             return self.cache[name]
 
@@ -114,9 +222,14 @@ class Components:
         clk = m.Input('clk')
         rst = m.Input('rst')
         centroid_configuration_in = m.Input('centroid_configuration_in', 64)
+        if shadow:
+            swap = m.Input('swap')
         data_out = m.Output('data_out', data_width)
 
         immediate = m.Reg('immediate', data_width - centroid_id_width)
+        loaded = immediate
+        if shadow:
+            loaded = m.Reg('shadow', data_width - centroid_id_width)
 
         m.EmbeddedCode(' ')
         m.EmbeddedCode('//Output assign')
@@ -126,12 +239,162 @@ class Components:
         m.Always(Posedge(clk))(
             If(rst)(
                 immediate(0),
+                [loaded(0)] if shadow else [],
             ).Else(
                 If(centroid_configuration_in[0:imm_id_width] == IMM_ID)(
-                    immediate(centroid_configuration_in[
-                              configuration_id_width:configuration_id_width + data_width - centroid_id_width])
+                    loaded(centroid_configuration_in[
+                           configuration_id_width:configuration_id_width + data_width - centroid_id_width])
                 ),
+                [If(swap)(
+                    immediate(loaded)
+                )] if shadow else [],
+            )
+        )
+
+        initialize_regs(m)
+        self.cache[name] = m
+
+        return m
+
+    def create_imm_tiled(self, tiles):
+        # one centroid coordinate per tile, selected by the tile in the SUB
+        # stage. IMM_ID_<t> is 0 for the coordinates past the last feature,
+        # that are the constant zero of the padding and have no register
+        name = 'm_imm_tiled%d' % tiles
+        if name in self.cache.keys():
+            return self.cache[name]
+
+        m = Module(name)
+
+        data_width = m.Parameter('DATA_WIDTH', 16)
+        centroid_id_width = m.Parameter('CENTROID_ID_WIDTH', 8)
+        centroid_id = m.Parameter('CENTROID_ID', 0)
+        imm_id_width = m.Parameter('IMM_ID_WIDTH', 8)
+        imm_ids = [m.Parameter('IMM_ID_%d' % t, 0) for t in range(tiles)]
+        tile_width = m.Parameter('TILE_WIDTH', 8)
+        configuration_id_width = m.Parameter('CONF_ID_WIDTH', 32)
+
+        clk = m.Input('clk')
+        rst = m.Input('rst')
+        tile = m.Input('tile', tile_width)
+        centroid_configuration_in = m.Input('centroid_configuration_in', 64)
+        data_out = m.Output('data_out', data_width)
+
+        coordinate_width = data_width - centroid_id_width
+        immediates = m.Wire('immediates', coordinate_width * tiles)
+        immediate = [immediates[t * coordinate_width:(t + 1) * coordinate_width] for t in range(tiles)]
+
+        m.EmbeddedCode(' ')
+        m.EmbeddedCode('//Output assign')
+
+        selected = immediate[-1]
+        for t in reversed(range(tiles - 1)):
+            selected = Mux(tile == t, immediate[t], selected)
+        data_out.assign(Cat(centroid_id, selected))
+
+        value = centroid_configuration_in[configuration_id_width:configuration_id_width + coordinate_width]
+        for t in range(tiles):
+            gen = m.GenerateIf(imm_ids[t] != 0, 'tile_%d' % t)
+            register = gen.Reg('immediate', coordinate_width)
+            gen.Always(Posedge(clk))(
+                If(rst)(
+                    register(0),
+                ).Elif(centroid_configuration_in[0:imm_id_width] == imm_ids[t])(
+                    register(value),
+                )
             )
+            gen.Assign(immediates[t * coordinate_width:(t + 1) * coordinate_width](register))
+            gen.Else.Assign(immediates[t * coordinate_width:(t + 1) * coordinate_width](0))
+
+        initialize_regs(m)
+        self.cache[name] = m
+
+        return m
+
+    def create_centroid_bank(self):
+        # centroids of a folded distance unit, one per round, or the lines of
+        # points of the persistent kernel: a simple dual port memory of
+        # registered read, that synthesis maps to block RAM
+        name = 'm_centroid_bank'
+        if name in self.cache.keys():
+            return self.cache[name]
+
+        m = Module(name)
+
+        data_width = m.Parameter('DATA_WIDTH', 16)
+        addr_width = m.Parameter('ADDR_WIDTH', 1)
+        depth = m.Parameter('DEPTH', 2)
+
+        clk = m.Input('clk')
+        wr_en = m.Input('wr_en')
+        wr_addr = m.Input('wr_addr', addr_width)
+        wr_data = m.Input('wr_data', data_width)
+        rd_addr = m.Input('rd_addr', addr_width)
+        rd_data = m.OutputReg('rd_data', data_width)
+
+        mem = m.Reg('mem', data_width, depth)
+
+        m.Always(Posedge(clk))(
+            If(wr_en)(
+                mem[wr_addr](wr_data),
+            ),
+            rd_data(mem[rd_addr]),
+        )
+
+        initialize_regs(m)
+        self.cache[name] = m
+
+        return m
+
+    def create_cluster_accumulator(self, k, dimensions, data_width):
+        # coordinate sums and point count of every cluster over the labels of
+        # a core: a distributed RAM per feature, read and written back with
+        # every valid label. The reset only clears the valid bit of the
+        # clusters, which reads the accumulators of a cluster not labeled
+        # since as zero, so the RAMs need none. The drain reads an
+        # accumulator per cycle, the count after the sums of the features
+        name = 'cluster_accumulator_%d_%d_%d' % (k, dimensions, data_width)
+        if name in self.cache.keys():
+            return self.cache[name]
+
+        m = Module(name)
+
+        clk = m.Input('clk')
+        rst = m.Input('rst')
+
+        cluster_accumulator_valid = m.Input('cluster_accumulator_valid')
+        cluster_accumulator_label = m.Input('cluster_accumulator_label', bits(k))
+        cluster_accumulator_data_in = m.Input('cluster_accumulator_data_in', data_width * dimensions)
+        cluster_accumulator_rd_cluster = m.Input('cluster_accumulator_rd_cluster', bits(k))
+        cluster_accumulator_rd_feature = m.Input('cluster_accumulator_rd_feature', bits(dimensions + 1))
+        cluster_accumulator_rd_data = m.OutputReg('cluster_accumulator_rd_data', accumulator_width)
+
+        cluster_valid = m.Reg('cluster_valid', k)
+        accumulators = [m.Reg('sum_%d' % d, accumulator_width, k) for d in range(dimensions)]
+        accumulators.append(m.Reg('count', accumulator_width, k))
+        increments = [cluster_accumulator_data_in[d * data_width:(d + 1) * data_width] for d in range(dimensions)]
+        increments.append(Int(1, 1, 10))
+
+        label = cluster_accumulator_label
+        update = [acc[label](Mux(cluster_valid[label], acc[label], Int(0, accumulator_width, 10)) + increment)
+                  for acc, increment in zip(accumulators, increments)]
+        read = [When(Int(d, cluster_accumulator_rd_feature.width, 10))(
+            cluster_accumulator_rd_data(acc[cluster_accumulator_rd_cluster])) for d, acc in enumerate(accumulators)]
+
+        m.Always(Posedge(clk))(
+            If(cluster_accumulator_valid)(
+                *update
+            ),
+            If(rst)(
+                cluster_valid(Int(0, k, 10)),
+            ).Elif(cluster_accumulator_valid)(
+                cluster_valid[label](Int(1, 1, 2)),
+            ),
+            If(cluster_valid[cluster_accumulator_rd_cluster])(
+                Case(cluster_accumulator_rd_feature)(*read),
+            ).Else(
+                cluster_accumulator_rd_data(Int(0, accumulator_width, 10)),
+            ),
         )
 
         initialize_regs(m)
@@ -180,6 +443,169 @@ class Components:
         self.cache[name] = m
         return m
 
+    def create_quad_exact(self):
+        # square of a signed DATA_WIDTH_IN-bit difference kept on the data
+        # bits of DATA_WIDTH_OUT, that the range analysis sized to hold it
+        name = 'm_quad_exact'
+        if name in self.cache.keys():
+            return self.cache[name]
+
+        m = Module(name)
+
+        data_width_in = m.Parameter('DATA_WIDTH_IN', 16)
+        data_width_out = m.Parameter('DATA_WIDTH_OUT', 16)
+        centroid_id_width = m.Parameter('CENTROID_ID_WIDTH', 8)
+
+        clk = m.Input('clk')
+        rst = m.Input('rst')
+        data_in_0 = m.Input('data_in_0', data_width_in + centroid_id_width)
+        data_out = m.OutputReg('data_out', data_width_out)
+
+        m.EmbeddedCode('//Separation of the centroid ID values from the data to be processed')
+        data_0 = m.Wire('data_0', data_width_in, signed=True)
+        square = m.Wire('square', data_width_in * 2, signed=True)
+        centroid_id = m.Wire('centroid_id', centroid_id_width)
+
+        m.EmbeddedCode(' ')
+        m.EmbeddedCode('//Assigns')
+        data_0.assign(data_in_0[0:data_width_in])
+        square.assign(data_0 * data_0)
+        centroid_id.assign(data_in_0[data_width_in:data_width_in + centroid_id_width])
+
+        m.Always(Posedge(clk))(
+            If(rst)(
+                data_out(0),
+            ).Else(
+                data_out(Cat(centroid_id, square[0:data_width_out - centroid_id_width])),
+            )
+        )
+
+        initialize_regs(m)
+        self.cache[name] = m
+        return m
+
+    def create_quad_noid(self):
+        # square of a signed DATA_WIDTH_IN-bit difference, without centroid
+        # ID, extended or truncated to DATA_WIDTH_OUT
+        name = 'm_quad_noid'
+        if name in self.cache.keys():
+            return self.cache[name]
+
+        m = Module(name)
+
+        data_width_in = m.Parameter('DATA_WIDTH_IN', 16)
+        data_width_out = m.Parameter('DATA_WIDTH_OUT', 16)
+
+        clk = m.Input('clk')
+        rst = m.Input('rst')
+        data_in_0 = m.Input('data_in_0', data_width_in)
+        data_out = m.OutputReg('data_out', data_width_out)
+
+        data_0 = m.Wire('data_0', data_width_in, signed=True)
+        square = m.Wire('square', data_width_in * 2, signed=True)
+
+        m.EmbeddedCode(' ')
+        m.EmbeddedCode('//Assigns')
+        data_0.assign(data_in_0)
+        square.assign(data_0 * data_0)
+
+        m.Always(Posedge(clk))(
+            If(rst)(
+                data_out(0),
+            ).Else(
+                data_out(square),
+            )
+        )
+
+        initialize_regs(m)
+        self.cache[name] = m
+        return m
+
+    def create_mac(self):
+        # squared coordinate difference added to the partial sum of the
+        # previous coordinate: the multiplier, post-adder and output register
+        # of one DSP48, chained through the cascade ports
+        name = 'm_mac'
+        if name in self.cache.keys():
+            return self.cache[name]
+
+        m = Module(name)
+
+        data_width_in = m.Parameter('DATA_WIDTH_IN', 16)
+        data_width_out = m.Parameter('DATA_WIDTH_OUT', 16)
+        centroid_id_width = m.Parameter('CENTROID_ID_WIDTH', 8)
+
+        clk = m.Input('clk')
+        rst = m.Input('rst')
+        data_in_0 = m.Input('data_in_0', data_width_in + centroid_id_width)
+        cascade_in = m.Input('cascade_in', data_width_out)
+        data_out = m.OutputReg('data_out', data_width_out)
+
+        m.EmbeddedCode('//Separation of the centroid ID values from the data to be processed')
+        data_0 = m.Wire('data_0', data_width_in, signed=True)
+        square = m.Wire('square', data_width_in * 2, signed=True)
+        partial = m.Wire('partial', data_width_out - centroid_id_width)
+        total = m.Wire('total', data_width_out - centroid_id_width)
+        centroid_id = m.Wire('centroid_id', centroid_id_width)
+
+        m.EmbeddedCode(' ')
+        m.EmbeddedCode('//Assigns')
+        data_0.assign(data_in_0[0:data_width_in])
+        square.assign(data_0 * data_0)
+        partial.assign(cascade_in[0:data_width_out - centroid_id_width])
+        # the sum is kept on the data bits even when the square is wider
+        total.assign(partial + square)
+        centroid_id.assign(data_in_0[data_width_in:data_width_in + centroid_id_width])
+
+        m.Always(Posedge(clk))(
+            If(rst)(
+                data_out(0),
+            ).Else(
+                data_out(Cat(centroid_id, total)),
+            )
+        )
+
+        initialize_regs(m)
+        self.cache[name] = m
+        return m
+
+    def create_mac_noid(self):
+        # m_mac without centroid IDs
+        name = 'm_mac_noid'
+        if name in self.cache.keys():
+            return self.cache[name]
+
+        m = Module(name)
+
+        data_width_in = m.Parameter('DATA_WIDTH_IN', 16)
+        data_width_out = m.Parameter('DATA_WIDTH_OUT', 16)
+
+        clk = m.Input('clk')
+        rst = m.Input('rst')
+        data_in_0 = m.Input('data_in_0', data_width_in)
+        cascade_in = m.Input('cascade_in', data_width_out)
+        data_out = m.OutputReg('data_out', data_width_out)
+
+        data_0 = m.Wire('data_0', data_width_in, signed=True)
+        square = m.Wire('square', data_width_in * 2, signed=True)
+
+        m.EmbeddedCode(' ')
+        m.EmbeddedCode('//Assigns')
+        data_0.assign(data_in_0)
+        square.assign(data_0 * data_0)
+
+        m.Always(Posedge(clk))(
+            If(rst)(
+                data_out(0),
+            ).Else(
+                data_out(cascade_in + square),
+            )
+        )
+
+        initialize_regs(m)
+        self.cache[name] = m
+        return m
+
     def create_reg(self):
         name = 'm_reg'
         if name in self.cache.keys():
@@ -246,12 +672,56 @@ class Components:
 
         return m
 
-    def create_config_centroids(self, external_data_width):
+    def create_sub_noid(self):
+        # subtractor of the datapath without centroid IDs
+        name = 'm_sub_noid'
+        if name in self.cache.keys():
+            return self.cache[name]
+
+        m = Module(name)
+
+        data_width = m.Parameter('DATA_WIDTH', 16)
+        clk = m.Input('clk')
+        rst = m.Input('rst')
+        data_in_0 = m.Input('data_in_0', data_width)
+        data_in_1 = m.Input('data_in_1', data_width)
+        data_out = m.OutputReg('data_out', data_width)
+
+        m.Always(Posedge(clk))(
+            If(rst)(
+                data_out(0),
+            ).Else(
+                data_out(data_in_0 - data_in_1),
+            )
+        )
+
+        initialize_regs(m)
+        self.cache[name] = m
+
+        return m
+
+    def create_config_centroids(self, external_data_width, id_base=False, num_points=False, max_iterations=False,
+                                dense=False):
+        # id_base: also latches the ID of the first centroid of the pass, in
+        # the bits of the first line above the number of configurations.
+        # num_points: also latches the number of points, in the second 64-bit
+        # word of the first line. max_iterations: also latches the maximum of
+        # passes of the persistent kernel, in the 32 bits above it. dense: the
+        # lines of the dense header go out whole, a line per cycle, above
+        # their line ID
         name = 'config_centroids'
+        if dense:
+            name += '_dense'
+        if id_base:
+            name += '_base'
+        if num_points:
+            name += '_points'
+        if max_iterations:
+            name += '_iterations'
         if name in self.cache.keys():
             return self.cache[name]
 
-        m = Module('config_centroids')
+        m = Module(name)
 
         # sinais básicos para o funcionamento do circuito
         clk = m.Input('clk')
@@ -264,7 +734,22 @@ class Components:
         config_centroids_read_data_valid = m.Input('config_centroids_read_data_valid')
 
         config_centroids_start_circuit = m.OutputReg('config_centroids_start_circuit')
-        config_centroids_configurations_out = m.OutputReg('config_centroids_configurations_out', 64)
+        config_centroids_configurations_out = m.OutputReg('config_centroids_configurations_out',
+                                                          32 + external_data_width if dense else 64)
+        reset_header = []
+        latch_header = []
+        if id_base:
+            config_centroids_id_base = m.OutputReg('config_centroids_id_base', state_id_width)
+            reset_header = [config_centroids_id_base(Int(0, state_id_width, 10))]
+            latch_header = [config_centroids_id_base(config_centroids_read_data[32:32 + state_id_width])]
+        if num_points:
+            config_centroids_num_points = m.OutputReg('config_centroids_num_points', 32)
+            reset_header.append(config_centroids_num_points(Int(0, 32, 10)))
+            latch_header.append(config_centroids_num_points(config_centroids_read_data[64:96]))
+        if max_iterations:
+            config_centroids_max_iterations = m.OutputReg('config_centroids_max_iterations', 32)
+            reset_header.append(config_centroids_max_iterations(Int(0, 32, 10)))
+            latch_header.append(config_centroids_max_iterations(config_centroids_read_data[96:128]))
 
         m.EmbeddedCode('//For Config Control')
         fsm_config = m.Reg('fsm_config', 3)
@@ -275,10 +760,52 @@ class Components:
         FSM_CONF_FINISHED = m.Localparam('FSM_CONF_FINISHED', Int(4, fsm_config.width, 10))
 
         m.EmbeddedCode(' ')
-        data_received = m.Reg('data_received', external_data_width)
-        counter_end_line = m.Reg('counter_end_line', 9)
+        if dense:
+            counter_lines = m.Reg('counter_lines', 32)
+        else:
+            data_received = m.Reg('data_received', external_data_width)
+            counter_end_line = m.Reg('counter_end_line', 9)
         counter_configurations = m.Reg('counter_configurations', 32)
         num_configurations = m.Reg('num_configurations', 32)
+        if dense:
+            # the next line is requested while the current one is read, and
+            # the configurations count the slots of the lines
+            slots = external_data_width // header_slot_width
+            reset_lines = [counter_lines(Int(1, counter_lines.width, 10))]
+            read_line = [config_centroids_request_read(Int(1, 1, 2)),
+                         fsm_config(FSM_CONFIGURE)]
+            configure = [
+                If(config_centroids_read_data_valid)(
+                    config_centroids_configurations_out(Cat(config_centroids_read_data, counter_lines)),
+                    counter_lines(counter_lines + Int(1, counter_lines.width, 2)),
+                    counter_configurations(counter_configurations + Int(slots, counter_configurations.width, 10)),
+                    If(counter_configurations + Int(slots, counter_configurations.width, 10) < num_configurations)(
+                        config_centroids_request_read(Int(1, 1, 2)),
+                    ).Else(
+                        fsm_config(FSM_READ_CONF),
+                    )
+                ).Else(
+                    fsm_config(FSM_READ_CONF),
+                )
+            ]
+        else:
+            reset_lines = [data_received(Int(0, data_received.width, 10)),
+                           counter_end_line(Int(0, counter_end_line.width, 10))]
+            read_line = [data_received(config_centroids_read_data),
+                         config_centroids_request_read(Int(1, 1, 2)),
+                         counter_end_line(Int(0, counter_end_line.width, 10)),
+                         fsm_config(FSM_CONFIGURE)]
+            configure = [
+                config_centroids_configurations_out(data_received[0: 64]),
+                data_received(data_received >> Int(64, 10, 10)),
+                counter_end_line(counter_end_line + Int(1, counter_end_line.width, 2)),
+                counter_configurations(counter_configurations + Int(1, counter_configurations.width, 2)),
+                If(counter_end_line == Int((external_data_width // (64)) - 1, counter_end_line.width, 10))(
+                    fsm_config(FSM_READ_CONF),
+                ).Else(
+                    fsm_config(FSM_CONFIGURE),
+                ),
+            ]
 
         # confControl
         m.EmbeddedCode('//confControl')
@@ -288,10 +815,10 @@ class Components:
                 config_centroids_start_circuit(Int(0, 1, 10)),
                 config_centroids_request_read(Int(0, 1, 10)),
                 config_centroids_configurations_out(Int(0, config_centroids_configurations_out.width, 10)),
-                data_received(Int(0, data_received.width, 10)),
-                counter_end_line(Int(0, counter_end_line.width, 10)),
+                *reset_lines,
                 counter_configurations(Int(0, counter_configurations.width, 10)),
                 num_configurations(Int(0, num_configurations.width, 10)),
+                *reset_header,
                 fsm_config(FSM_IDLE_CONF),
             ).Else(
                 config_centroids_request_read(Int(0, 1, 2)),
@@ -304,6 +831,7 @@ class Components:
                     When(FSM_READ_NUM_CONF)(
                         If(config_centroids_read_data_valid)(
                             num_configurations(config_centroids_read_data[0:num_configurations.width]),
+                            *latch_header,
                             config_centroids_request_read(Int(1, 1, 2)),
                             fsm_config(FSM_READ_CONF)
                         )
@@ -312,22 +840,11 @@ class Components:
                         If(counter_configurations >= num_configurations)(
                             fsm_config(FSM_CONF_FINISHED)
                         ).Elif(config_centroids_read_data_valid & ~config_centroids_request_read)(
-                            data_received(config_centroids_read_data),
-                            config_centroids_request_read(Int(1, 1, 2)),
-                            counter_end_line(Int(0, counter_end_line.width, 10)),
-                            fsm_config(FSM_CONFIGURE)
+                            *read_line
                         )
                     ),
                     When(FSM_CONFIGURE)(
-                        config_centroids_configurations_out(data_received[0: 64]),
-                        data_received(data_received >> Int(64, 10, 10)),
-                        counter_end_line(counter_end_line + Int(1, counter_end_line.width, 2)),
-                        counter_configurations(counter_configurations + Int(1, counter_configurations.width, 2)),
-                        If(counter_end_line == Int((external_data_width // (64)) - 1, counter_end_line.width, 10))(
-                            fsm_config(FSM_READ_CONF),
-                        ).Else(
-                            fsm_config(FSM_CONFIGURE),
-                        ),
+                        *configure
                     ),
                     When(FSM_CONF_FINISHED)(
                         config_centroids_configurations_out(Int(0, config_centroids_configurations_out.width, 10)),
@@ -343,8 +860,11 @@ class Components:
 
         return m
 
-    def create_input_controller(self, external_data_width):
-        name = 'input_controller'
+    def create_input_controller(self, external_data_width, backpressure=False):
+        # backpressure: the lines are only requested while
+        # input_controller_ready is high, and the line already requested is
+        # delivered after it falls
+        name = 'input_controller_ready' if backpressure else 'input_controller'
         if name in self.cache.keys():
             return self.cache[name]
 
@@ -360,6 +880,8 @@ class Components:
         input_controller_read_data = m.Input('input_controller_read_data', external_data_width)
         input_controller_read_data_valid = m.Input('input_controller_read_data_valid')
         input_controller_request_read = m.OutputReg('input_controller_request_read')
+        if backpressure:
+            ready = m.Input('input_controller_ready')
 
         # output
         input_controller_data_out = m.OutputReg('input_controller_data_out', external_data_width)
@@ -372,6 +894,17 @@ class Components:
         FSM_READ = m.Localparam('FSM_READ', Int(2, fsm_main.width, 10))
         FSM_DONE = m.Localparam('FSM_DONE', Int(3, fsm_main.width, 10))
 
+        # a line is requested in WAIT_DATA, and the next one while it is
+        # read
+        request_line = [input_controller_request_read(Int(1, 1, 2)), fsm_main(FSM_READ)]
+        request_next = [input_controller_request_read(Int(1, 1, 2))]
+        if backpressure:
+            request_line = [If(ready)(*request_line)]
+            request_next = [input_controller_request_read(ready),
+                            If(Not(ready))(
+                                fsm_main(FSM_WAIT_DATA)
+                            )]
+
         m.EmbeddedCode(' ')
         m.Always(Posedge(clk))(
             If(rst)(
@@ -390,8 +923,7 @@ class Components:
                     ),
                     When(FSM_WAIT_DATA)(
                         If(input_controller_read_data_valid)(
-                            input_controller_request_read(Int(1, 1, 2)),
-                            fsm_main(FSM_READ)
+                            *request_line
                         ).Elif(done_rd_data)(
                             input_controller_output_valid(Int(2, input_controller_output_valid.width, 10)),
                             fsm_main(FSM_DONE)
@@ -401,7 +933,7 @@ class Components:
                         If(input_controller_read_data_valid)(
                             input_controller_data_out(input_controller_read_data),
                             input_controller_output_valid(Int(1, input_controller_output_valid.width, 10)),
-                            input_controller_request_read(Int(1, 1, 2))
+                            *request_next
                         ).Elif(done_rd_data)(
                             input_controller_output_valid(Int(2, input_controller_output_valid.width, 10)),
                             fsm_main(FSM_DONE)
@@ -421,17 +953,118 @@ class Components:
         self.cache[name] = m
         return m
 
-    def create_output_controller(self, external_data_width, data_width, dimensions):
+    def create_input_gearbox(self, external_data_width, beat_width, tiles=1, last_width=None):
+        # realigns cache lines of densely packed points into beats of
+        # beat_width bits, one point per kmeans core. A beat is wider than a
+        # line, so the gearbox keeps up with the input controller: a beat
+        # leaves whenever the buffer holds one, and the last, partial beat
+        # leaves on done. With tiles, every point leaves in tiles beats, the
+        # last one of last_width bits zero extended; the tiles average a line
+        # at least, so a short last tile only puts the buffer behind for a
+        # while
+        name = 'input_gearbox_%d_%d' % (external_data_width, beat_width)
+        if tiles > 1:
+            name += '_%d_%d' % (tiles, last_width)
+        if name in self.cache.keys():
+            return self.cache[name]
+
+        m = Module(name)
+
+        clk = m.Input('clk')
+        rst = m.Input('rst')
 
+        input_gearbox_data_in = m.Input('input_gearbox_data_in', external_data_width)
+        input_gearbox_input_valid = m.Input('input_gearbox_input_valid', 2)
+        input_gearbox_data_out = m.OutputReg('input_gearbox_data_out', beat_width)
+        input_gearbox_output_valid = m.OutputReg('input_gearbox_output_valid', 2)
+
+        m.EmbeddedCode(' ')
+        buffer_width = beat_width + external_data_width
+        if tiles > 1:
+            buffer_width += beat_width - last_width
+        data = m.Reg('data', buffer_width)
+        fill = m.Reg('fill', bits(buffer_width + 1))
+        emit = m.Wire('emit')
+        remaining = m.Wire('remaining', buffer_width)
+        remaining_fill = m.Wire('remaining_fill', fill.width)
+        line = m.Wire('line', buffer_width)
+
+        size = Int(beat_width, fill.width, 10)
+        shifted = Cat(Int(0, beat_width, 10), data[beat_width:buffer_width])
+        beat = data[0:beat_width]
+        if tiles > 1:
+            tile = m.Reg('tile', bits(tiles))
+            last = m.Wire('last')
+            last.assign(tile == Int(tiles - 1, tile.width, 10))
+            size = Mux(last, Int(last_width, fill.width, 10), size)
+            shifted = Mux(last, Cat(Int(0, last_width, 10), data[last_width:buffer_width]), shifted)
+            beat = Mux(last, Cat(Int(0, beat_width - last_width, 10), data[0:last_width]), beat)
+
+        emit.assign(OrList(fill >= size,
+                           AndList(input_gearbox_input_valid == Int(2, 2, 10), fill != Int(0, fill.width, 10))))
+        remaining.assign(Mux(emit, shifted, data))
+        remaining_fill.assign(Mux(fill > size, fill - size, Mux(emit, Int(0, fill.width, 10), fill)))
+        line.assign(Cat(Int(0, buffer_width - external_data_width, 10), input_gearbox_data_in) << remaining_fill)
+
+        if tiles > 1:
+            m.EmbeddedCode(' ')
+            m.Always(Posedge(clk))(
+                If(rst)(
+                    tile(Int(0, tile.width, 10)),
+                ).Elif(emit)(
+                    tile(Mux(last, Int(0, tile.width, 10), tile + Int(1, tile.width, 10))),
+                )
+            )
+
+        m.EmbeddedCode(' ')
+        m.Always(Posedge(clk))(
+            If(rst)(
+                data(Int(0, data.width, 10)),
+                fill(Int(0, fill.width, 10)),
+                input_gearbox_data_out(Int(0, input_gearbox_data_out.width, 10)),
+                input_gearbox_output_valid(Int(0, input_gearbox_output_valid.width, 10)),
+            ).Else(
+                EmbeddedCode('//Stop = 00, Done = 10, Valid = 01'),
+                input_gearbox_data_out(beat),
+                If(emit)(
+                    input_gearbox_output_valid(Int(1, 2, 10)),
+                ).Elif(input_gearbox_input_valid == Int(2, 2, 10))(
+                    input_gearbox_output_valid(Int(2, 2, 10)),
+                ).Else(
+                    input_gearbox_output_valid(Int(0, 2, 10)),
+                ),
+                If(input_gearbox_input_valid == Int(1, 2, 10))(
+                    data(remaining | line),
+                    fill(remaining_fill + Int(external_data_width, fill.width, 10)),
+                ).Else(
+                    data(remaining),
+                    fill(remaining_fill),
+                )
+            )
+        )
+
+        initialize_regs(m)
+        self.cache[name] = m
+        return m
+
+    def create_output_controller(self, external_data_width, data_width, dimensions, controller_data_width=8,
+                                 num_inputs=None):
+        # controller_data_width: bits written per core and point, the label
+        # or the multipass state. num_inputs: words taken per valid, one per
+        # core of a line by default
         name = 'output_controller_%d_%d_%d' % (external_data_width, data_width, dimensions)
+        if controller_data_width != 8:
+            name += '_%d' % controller_data_width
+        if num_inputs is not None:
+            name = 'output_controller_%d_%dx%d' % (external_data_width, num_inputs, controller_data_width)
 
         if name in self.cache.keys():
             return self.cache[name]
 
         m = Module(name)
 
-        controller_data_width = 8
-        num_inputs = (external_data_width // data_width) // dimensions
+        if num_inputs is None:
+            num_inputs = line_cores(external_data_width, data_width, dimensions)
 
         # basic signals BEGIN
         clk = m.Input('clk')
@@ -472,6 +1105,57 @@ class Components:
                             ),
                             When(Int(0, output_controller_input_valid.width, 10))(
 
+                            )
+                        )
+                    )
+                )
+            )
+        elif external_data_width % (controller_data_width * num_inputs) != 0:
+            # the labels of a beat straddle the cache lines: they are appended
+            # above the fill and a line is written whenever one is complete
+            m.EmbeddedCode(" ")
+            buffer_width = external_data_width + controller_data_width * num_inputs
+            data = m.Reg('data', buffer_width)
+            fill = m.Reg('fill', bits(buffer_width + 1))
+            merged = m.Wire('merged', buffer_width)
+            merged.assign(data | (Cat(Int(0, external_data_width, 10), output_controller_data_in) << fill))
+
+            m.Always(Posedge(clk))(
+                If(rst)(
+                    output_controller_request_write(Int(0, 1, 10)),
+                    data(Int(0, data.width, 10)),
+                    fill(Int(0, fill.width, 10)),
+                    output_controller_done(Int(0, 1, 10)),
+                ).Elif(AndList(start, Not(output_controller_done)))(
+                    EmbeddedCode('//Stop = 00, Done = 10, Valid = 01'),
+                    output_controller_request_write(Int(0, 1, 10)),
+                    If(output_controller_available_write)(
+                        Case(output_controller_input_valid)(
+                            When(Int(2, 2, 10))(  # Done = 2
+                                If(fill != Int(0, fill.width, 10))(
+                                    output_controller_write_data(data[0:external_data_width]),
+                                    output_controller_request_write(Int(1, 1, 10)),
+                                    data(Int(0, data.width, 10)),
+                                    fill(Int(0, fill.width, 10)),
+                                ).Else(
+                                    output_controller_done(Int(1, 1, 10)),
+                                )
+                            ),
+                            When(Int(1, 2, 10))(  # Valid = 1
+                                If(fill >= Int(external_data_width - controller_data_width * num_inputs, fill.width,
+                                               10))(
+                                    output_controller_write_data(merged[0:external_data_width]),
+                                    output_controller_request_write(Int(1, 1, 10)),
+                                    data(Cat(Int(0, external_data_width, 10), merged[external_data_width:buffer_width])),
+                                    fill(fill - Int(external_data_width - controller_data_width * num_inputs,
+                                                    fill.width, 10)),
+                                ).Else(
+                                    data(merged),
+                                    fill(fill + Int(controller_data_width * num_inputs, fill.width, 10)),
+                                )
+                            ),
+                            When(Int(0, 2, 10))(
+
                             )
                         )
                     )
@@ -502,7 +1186,10 @@ class Components:
                                     output_controller_write_data(data),
                                     output_controller_request_write(Int(1, 1, 10)),
                                     wr_flag(Int(1, 1, 10)),
-                                ).Elif(OrList(wr_flag))(
+                                ).Elif(OrList(wr_flag, counter == Int(0, counter.width, 10)))(
+                                    # the last line was written, or the
+                                    # words filled it and there is no line
+                                    # left to pad
                                     output_controller_done(Int(1, 1, 10)),
                                 ).Else(
                                     counter(counter + Int(1, counter.width, 10)),
@@ -575,21 +1262,18 @@ class Components:
         self.cache[name] = m
         return m
 
-    def create_validity_protractor(self, k, dimensions):
+    def create_validity_protractor(self, k, dimensions, arity=2, mac=False, tiles=1, folded=False):
+        # k: distance units of the core. The kmeans of different K, and the
+        # folded cores with their units, differ in depth and get a
+        # protractor per depth
+        dfg_depth = pipeline_depth(k, dimensions, arity, mac, tiles, folded)
 
-        name = 'validity_protractor'
+        name = 'validity_protractor_%d' % dfg_depth
         if name in self.cache.keys():
             return self.cache[name]
 
         m = Module(name)
 
-        # ceil(log2(k)) = reduce min
-        # +1 = quad
-        # +1 = sub
-        # ceil(log2(dimensions)) = reduce ADD
-        # (0 if k < 3 else ceil(log2(k)) - 1) = regs
-        dfg_depth = ceil(log2(k)) + 2 + ceil(log2(dimensions)) + (0 if k < 3 else ceil(log2(k)) - 1)
-
         clk = m.Input('clk')
         rst = m.Input('rst')
 
@@ -1,59 +1,270 @@
 import argparse
+import errno
+import os
+import shutil
 import traceback
 
-from veriloggen import *
+from generation_cache import add_cache_args, open_cache
+from kmeans_generator import KmeansConfig, generate_verilog
+from profiler import profiler, add_profile_args
+from utils import split_modules, write_if_changed
 
-from create_acc_axi_interface import AccAXIInterface
-from kmeans_accelerator import KmeanAcc
-from utils import commands_getoutput
+kmeans_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
 
-
-def write_file(name, string):
-    with open(name, 'w') as fp:
-        fp.write(string)
-        fp.close()
+# full: copy the whole template, as it is
+# copy/hardlink/symlink: only the generated platform, without the prebuilt
+# host binary and sample outputs, with the template files copied or linked
+materialize_modes = ['full', 'copy', 'hardlink', 'symlink']
+platform = 'xilinx_aws_f1'
+# feature widths packed by the OpenCL and pynq hosts
+data_widths = [8, 12, 16, 32]
+generated_modules_file = '.generated_modules'
+template_outputs = ['xilinx_aws_f1/sw/opencl/kernel_top',
+                    'xilinx_aws_f1/sw/opencl/kmeans_2000000_4_4_out_fpga.txt',
+                    'xilinx_aws_f1/sw/opencl/out.csv']
 
 
 def create_args():
     parser = argparse.ArgumentParser('create_project -h')
     parser.add_argument('-N', '--dimensions', help='Number of Kmeans dimensions', type=int)
     parser.add_argument('-K', '--centroids', help='Number of Kmeans clusters', type=int)
-    parser.add_argument('-c', '--copies', help='Number of KmeansAcc copies', type=int, default=1)
+    parser.add_argument('-c', '--copies', help='Number of KmeansAcc copies, or auto for the highest modeled '
+                                               'throughput that fits the F1', type=copies_type, default=1)
     parser.add_argument('-p', '--name', help='Project name', type=str, default='a.prj')
+    add_data_width_arg(parser)
 
     parser.add_argument('-o', '--output', help='Project location', type=str, default='.')
+    add_emission_arg(parser)
+    add_datapath_args(parser)
+    add_materialize_arg(parser)
+    add_split_arg(parser)
+    add_cache_args(parser)
+    add_profile_args(parser)
 
     return parser.parse_args()
 
 
+def copies_type(value):
+    if value == 'auto':
+        return value
+    return int(value)
+
+
+def auto_copies(dimensions, centroids, data_width=16, arity=2, mac=False, widths='uniform', ids='datapath', fold=0,
+                multipass=False, accumulate=False, persistent=0, shadow=False, header='sparse'):
+    # the resource model is only loaded when asked for
+    from design_optimizer import optimize, explain
+
+    best, candidates = optimize(dimensions, centroids, [data_width], arity=arity, mac=mac, widths=widths,
+                                ids=ids, fold=fold, multipass=multipass, accumulate=accumulate,
+                                persistent=persistent, shadow=shadow, header=header)
+    print(explain(best, candidates))
+    return best['config']['copies']
+
+
+def add_data_width_arg(parser):
+    parser.add_argument('-w', '--data-width', help='Bits of every feature and centroid coordinate', type=int,
+                        choices=data_widths, default=16)
+
+
+def add_emission_arg(parser):
+    parser.add_argument('-e', '--emission', help='Verilog emission: flat unrolls every core and datapath node, '
+                                                 'generate uses generate loops for the repeated lanes',
+                        choices=['flat', 'generate'], default='flat')
+
+
+def add_datapath_args(parser):
+    parser.add_argument('-a', '--arity', help='Inputs of the adder and compare tree operators', type=int,
+                        choices=[2, 3, 4], default=2)
+    parser.add_argument('--mac', help='Accumulate the squared differences in DSP cascade chains instead of an '
+                                      'adder tree', action='store_true')
+    parser.add_argument('--widths', help='Datapath widths: uniform gives all the nodes of a type the width of the '
+                                         'widest, exact gives every node the width of its value range',
+                        choices=['uniform', 'exact'], default='uniform')
+    parser.add_argument('--ids', help='Centroid IDs: datapath carries them through every node, leaves adds them as '
+                                      'constants at the compare tree inputs', choices=['datapath', 'leaves'],
+                        default='datapath')
+    parser.add_argument('--fold', help='Distance units of every kmeans core, that iterate over the centroids kept '
+                                       'in block RAM, a point every ceil(K / units) cycles; 0 gives a unit per '
+                                       'centroid', type=int, default=0)
+    parser.add_argument('--multipass', help='Write the distance and centroid of every point instead of its label, '
+                                            'so that the hosts classify more clusters than -K in passes of -K '
+                                            'centroids', action='store_true')
+    parser.add_argument('--accumulate', help='Write the coordinate sums and point count of every cluster instead of '
+                                             'the labels, for the hosts to update the centroids from',
+                        action='store_true')
+    parser.add_argument('--persistent', help='Cache lines of points kept on chip by a kernel that runs the Lloyd '
+                                             'iterations itself, up to the maximum of the header, and writes the '
+                                             'final centroids; 0 runs one iteration per launch', type=int, default=0)
+    parser.add_argument('--shadow', help='Double-buffer the centroids of the persistent kernel cores, so that the '
+                                         'new centroids are written behind the running ones and swapped in between '
+                                         'the passes', action='store_true')
+    parser.add_argument('--header', help='Centroid configuration format: sparse gives every coordinate a 64-bit '
+                                         'entry with its IMM ID, dense packs the coordinates in 16-bit slots in IMM '
+                                         'ID order and loads a line of them per cycle', choices=['sparse', 'dense'],
+                        default='sparse')
+
+
+def add_materialize_arg(parser, flag='-m'):
+    parser.add_argument(flag, '--materialize', help='How the template is materialized: full copies the whole '
+                                                    'template; copy, hardlink and symlink only the %s platform '
+                                                    'without prebuilt outputs. Linked files are shared with '
+                                                    'the template, do not edit them in place' % platform,
+                        choices=materialize_modes, default='full')
+
+
+def add_split_arg(parser):
+    parser.add_argument('-s', '--split-modules', help='Write one Verilog file per module, rewriting only the '
+                                                      'modules that changed', action='store_true')
+
+
+def list_template(template='%s/resources/template.prj' % kmeans_root, materialize='full'):
+    # directories and files of the template, relative to its root
+    if materialize not in materialize_modes:
+        raise Exception('Unknown materialization mode %s' % materialize)
+
+    dirs = []
+    files = []
+    for root, dirnames, filenames in os.walk(template):
+        rel = os.path.relpath(root, template)
+        dirs.extend(os.path.normpath(os.path.join(rel, d)) for d in sorted(dirnames))
+        files.extend(os.path.normpath(os.path.join(rel, f)) for f in sorted(filenames))
+
+    if materialize != 'full':
+        dirs = [d for d in dirs if d == platform or d.startswith(platform + os.sep)]
+        files = [f for f in files if f.startswith(platform + os.sep) and f not in template_outputs]
+
+    return template, dirs, files, materialize
+
+
+def materialize_file(src, dst, materialize):
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if materialize == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError as e:
+            # template and project on different file systems
+            if e.errno != errno.EXDEV:
+                raise
+    elif materialize == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+        return
+
+    shutil.copy2(src, dst)
+
+
+def copy_template(template_list, project_path):
+    template, dirs, files, materialize = template_list
+    os.makedirs(project_path, exist_ok=True)
+    for d in dirs:
+        os.makedirs(os.path.join(project_path, d), exist_ok=True)
+    for f in files:
+        materialize_file(os.path.join(template, f), os.path.join(project_path, f), materialize)
+
+
+def clean_generator_files():
+    # files left in the source tree by older pyverilog versions
+    for f in ['parser.out', 'parsetab.py']:
+        if os.path.exists('%s/src/%s' % (kmeans_root, f)):
+            os.remove('%s/src/%s' % (kmeans_root, f))
+    shutil.rmtree('%s/src/__pycache__' % kmeans_root, ignore_errors=True)
+
+
+def write_verilog(src_path, verilog, split=False):
+    # kernel_top.v holds the whole design, or only the kernel_top module when
+    # split; files of modules no longer generated are removed
+    modules_file = '%s/%s' % (src_path, generated_modules_file)
+    old_files = []
+    if os.path.exists(modules_file):
+        with open(modules_file) as fp:
+            old_files = fp.read().split()
+
+    if split:
+        files = split_modules(verilog, src_path)
+        write_if_changed(modules_file, '\n'.join(sorted(files)) + '\n')
+    else:
+        files = {'kernel_top.v': write_if_changed('%s/kernel_top.v' % src_path, verilog)}
+        if os.path.exists(modules_file):
+            os.remove(modules_file)
+
+    for f in old_files:
+        if f not in files and os.path.exists('%s/%s' % (src_path, f)):
+            os.remove('%s/%s' % (src_path, f))
+
+    return files
+
+
+def create_project(config, name, output, template_list=None, cache=None, split=False):
+    if template_list is None:
+        template_list = list_template()
+
+    project_path = '%s/%s' % (output, name)
+
+    with profiler.stage('generate'):
+        verilog, metadata = generate_verilog(config, cache)
+    num_m_axis = metadata['num_m_axis']
+
+    with profiler.stage('template_copy'):
+        copy_template(template_list, project_path)
+
+    with profiler.stage('write_files'):
+        write_verilog('%s/xilinx_aws_f1/hw/src' % project_path, verilog, split)
+
+        write_if_changed('%s/xilinx_aws_f1/hw/simulate/num_m_axis.mk' % project_path, 'NUM_M_AXIS=%d' % num_m_axis)
+        write_if_changed('%s/xilinx_aws_f1/hw/synthesis/num_m_axis.mk' % project_path, 'NUM_M_AXIS=%d' % num_m_axis)
+        write_if_changed('%s/xilinx_aws_f1/hw/synthesis/prj_name' % project_path, name)
+        write_if_changed('%s/xilinx_aws_f1/sw/opencl/data_width.mk' % project_path,
+                         'DATA_WIDTH=%d' % config.data_width)
+        write_if_changed('%s/xilinx_aws_f1/sw/opencl/block_clusters.mk' % project_path,
+                         'BLOCK_CLUSTERS=%d' % (config.k_array[0] if config.multipass else 0))
+        write_if_changed('%s/xilinx_aws_f1/sw/opencl/accumulate.mk' % project_path,
+                         'ACCUMULATE=%d' % (1 if config.accumulate else 0))
+        write_if_changed('%s/xilinx_aws_f1/sw/opencl/persistent.mk' % project_path,
+                         'PERSISTENT=%d' % config.persistent)
+        write_if_changed('%s/xilinx_aws_f1/sw/opencl/header.mk' % project_path,
+                         'DENSE_HEADER=%d' % (1 if config.header == 'dense' else 0))
+
+    return project_path, metadata
+
+
 def main():
     args = create_args()
-    running_path = os.getcwd()
-    os.chdir(os.path.dirname(__file__))
-    kmeans_root = os.getcwd() + '/../'
 
     if args.output == '.':
-        args.output = running_path
-        
-    if args.dimensions and args.centroids:
-        kmeansacc = KmeanAcc(512, 16, [args.centroids], args.dimensions, args.copies)
-
-        acc_axi = AccAXIInterface(kmeansacc).create_kernel_top()
+        args.output = os.getcwd()
 
-        commands_getoutput('cp -r %s/resources/template.prj %s/%s' % (kmeans_root, args.output, args.name))
-
-        acc_axi.to_verilog('%s/%s/xilinx_aws_f1/hw/src/kernel_top.v' % (args.output, args.name))
+    if args.dimensions and args.centroids:
+        if args.copies == 'auto':
+            args.copies = auto_copies(args.dimensions, args.centroids, args.data_width, arity=args.arity, mac=args.mac,
+                                      widths=args.widths, ids=args.ids, fold=args.fold, multipass=args.multipass,
+                                      accumulate=args.accumulate, persistent=args.persistent, shadow=args.shadow,
+                                      header=args.header)
+        config = KmeansConfig(args.dimensions, args.centroids, args.copies, data_width=args.data_width,
+                              emission=args.emission, arity=args.arity, mac=args.mac, widths=args.widths, ids=args.ids,
+                              fold=args.fold, multipass=args.multipass, accumulate=args.accumulate,
+                              persistent=args.persistent, shadow=args.shadow, header=args.header)
+        profile = args.profile or args.profile_json or args.cprofile
+        if profile:
+            profiler.enable(args.cprofile_stage if args.cprofile else None)
+        create_project(config, args.name, args.output, list_template(materialize=args.materialize), open_cache(args),
+                       args.split_modules)
 
-        write_file('%s/%s/xilinx_aws_f1/hw/simulate/num_m_axis.mk' % (args.output, args.name),
-                   'NUM_M_AXIS=%d' % kmeansacc.get_num_in())
-        write_file('%s/%s/xilinx_aws_f1/hw/synthesis/num_m_axis.mk' % (args.output, args.name),
-                   'NUM_M_AXIS=%d' % kmeansacc.get_num_in())
-        write_file('%s/%s/xilinx_aws_f1/hw/synthesis/prj_name' % (args.output, args.name), args.name)
-        commands_getoutput(
-            'rm -rf %s/src/parser.out %s/src/parsetab.py %s/src/__pycache__' % (kmeans_root, kmeans_root, kmeans_root))
+        clean_generator_files()
 
-        commands_getoutput(
-            'rm -rf %s/src/parser.out %s/src/parsetab.py %s/src/__pycache__' % (kmeans_root, kmeans_root, kmeans_root))
+        if profile:
+            profiler.disable()
+            print(profiler.report())
+            if args.profile_json:
+                profiler.write_json(args.profile_json)
+            if args.cprofile:
+                stage = profiler.dump_cprofile(args.cprofile)
+                if stage is None:
+                    print('No stage named %s was profiled' % args.cprofile_stage)
+                else:
+                    print('cProfile statistics of stage %s written to %s' % (stage, args.cprofile))
 
         print('Project successfully created in %s/%s' % (args.output, args.name))
     else:
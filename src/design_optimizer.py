@@ -0,0 +1,86 @@
+from kmeans_generator import KmeansConfig
+from resource_model import estimate, kernel_frequency, f1_budget, resource_names, ddr_channels
+
+# Vitis places a design near this utilization; past it placement and
+# timing closure usually fail
+utilization_limit = 0.8
+max_copies = 16
+
+
+def optimize(dimensions, centroids, data_widths=(16,), copies=None, frequency=kernel_frequency, budget=None,
+             limit=utilization_limit, external_data_width=512, arity=2, mac=False, widths='uniform',
+             ids='datapath', fold=0, multipass=False, accumulate=False, persistent=0, shadow=False,
+             header='sparse'):
+    # estimates every (data width, copies) candidate and picks the highest
+    # modeled throughput that fits; between candidates within 1% of the best
+    # throughput, the one with less copies and then the widest data wins
+    if budget is None:
+        budget = f1_budget
+    if copies is None:
+        copies = range(1, max_copies + 1)
+
+    candidates = []
+    for data_width in data_widths:
+        previous = None
+        for c in copies:
+            config = KmeansConfig(dimensions, centroids, c, external_data_width, data_width, arity=arity, mac=mac,
+                                  widths=widths, ids=ids, fold=fold, multipass=multipass, accumulate=accumulate,
+                                  persistent=persistent, shadow=shadow, header=header)
+            estimation = estimate(config, frequency, budget)
+            estimation['fits_limit'] = all(estimation['utilization'][r] <= limit for r in resource_names)
+            candidates.append(estimation)
+
+            # the resources only grow with the copies: stop at the first copy
+            # count over the limit or that no longer adds throughput
+            points = estimation['throughput']['points_per_s']
+            if not estimation['fits_limit'] or (previous is not None and points < 1.01 * previous):
+                break
+            previous = points
+
+    fitting = [e for e in candidates if e['fits_limit']]
+    if not fitting:
+        raise Exception('No configuration of %d dimensions and %s clusters fits %d%% of the F1 kernel region' % (
+            dimensions, ','.join(str(k) for k in KmeansConfig(dimensions, centroids).k_array), 100 * limit))
+
+    best_points = max(e['throughput']['points_per_s'] for e in fitting)
+    best = min([e for e in fitting if e['throughput']['points_per_s'] >= 0.99 * best_points],
+               key=lambda e: (e['config']['copies'], -e['config']['data_width']))
+    return best, candidates
+
+
+def explain(best, candidates, limit=utilization_limit):
+    lines = ['%6s %7s %14s %14s %14s %10s %11s %s' % ('width', 'copies', 'compute (M/s)', 'memory (M/s)',
+                                                     'model (M/s)', 'bound', 'max util', '')]
+    for e in candidates:
+        t = e['throughput']
+        c = e['config']
+        mark = '<' if e is best else ('' if e['fits_limit'] else 'over budget')
+        lines.append('%6d %7d %14.1f %14.1f %14.1f %10s %10.1f%% %s' % (
+            c['data_width'], c['copies'], t['compute_points_per_s'] / 1e6, t['memory_points_per_s'] / 1e6,
+            t['points_per_s'] / 1e6, t['bound'], 100 * max(e['utilization'].values()), mark))
+
+    t = best['throughput']
+    c = best['config']
+    lines.append('')
+    lines.append('Selected %d copies of data width %d: %.1f Mpoints/s, %.1f ops/byte (%d ops and %.1f bytes per '
+                 'point).' % (c['copies'], c['data_width'], t['points_per_s'] / 1e6, t['ops_per_byte'],
+                              t['ops_per_point'], t['bytes_per_point']))
+    following = [e for e in candidates if e['config']['data_width'] == c['data_width'] and
+                 e['config']['copies'] == c['copies'] + 1]
+    if t['bound'] == 'bandwidth':
+        lines.append('The design is bandwidth bound: the copies ask for %.2f GB/s and get %.2f GB/s of DDR.' % (
+            t['compute_points_per_s'] * t['bytes_per_point'] / 1e9, t['bandwidth_bytes_per_s'] / 1e9))
+    else:
+        lines.append('The design is compute bound: the copies use %.2f GB/s of DDR.' % (
+            t['bandwidth_bytes_per_s'] / 1e9))
+
+    if following and not following[0]['fits_limit']:
+        u = following[0]['utilization']
+        critical = max(u, key=u.get)
+        lines.append('One more copy takes %s to %.1f%% of the F1 kernel region, over the %d%% limit.' % (
+            critical.upper(), 100 * u[critical], 100 * limit))
+    elif following:
+        lines.append('More copies share the %d saturated DDR channels and gain less than 1%%.' % ddr_channels)
+    else:
+        lines.append('This is the largest copy count searched.')
+    return '\n'.join(lines)
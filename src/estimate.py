@@ -0,0 +1,62 @@
+import argparse
+import json
+import traceback
+
+from create_project import copies_type, add_datapath_args
+from design_optimizer import optimize, explain
+from kmeans_generator import KmeansConfig
+from resource_model import estimate, report, kernel_frequency
+
+
+def create_args():
+    parser = argparse.ArgumentParser('estimate -h')
+    parser.add_argument('-N', '--dimensions', help='Number of Kmeans dimensions', type=int)
+    parser.add_argument('-K', '--centroids', help='Number of Kmeans clusters', type=int, nargs='+')
+    parser.add_argument('-c', '--copies', help='Number of KmeansAcc copies, or auto to search the copies (and the '
+                                               'data widths given) of highest modeled throughput', type=copies_type,
+                        default=1)
+    parser.add_argument('-w', '--data-width', help='Data width, or the data widths searched with -c auto', type=int,
+                        nargs='+', default=[16])
+    parser.add_argument('-f', '--frequency', help='Kernel clock in MHz', type=float, default=kernel_frequency / 1e6)
+    parser.add_argument('-j', '--json', help='Also write the estimation to this JSON file', type=str)
+    add_datapath_args(parser)
+
+    return parser.parse_args()
+
+
+def main():
+    args = create_args()
+
+    if not (args.dimensions and args.centroids):
+        raise Exception('Missing parameters. Run estimate -h to see all parameters needed')
+    if args.copies != 'auto' and len(args.data_width) > 1:
+        raise Exception('Several data widths are only searched with -c auto; give a single -w otherwise')
+
+    if args.copies == 'auto':
+        estimation, candidates = optimize(args.dimensions, args.centroids, args.data_width,
+                                          frequency=args.frequency * 1e6, arity=args.arity, mac=args.mac,
+                                          widths=args.widths, ids=args.ids, fold=args.fold,
+                                          multipass=args.multipass, accumulate=args.accumulate,
+                                          persistent=args.persistent, shadow=args.shadow,
+                                          header=args.header)
+        print(explain(estimation, candidates))
+        print('')
+    else:
+        config = KmeansConfig(args.dimensions, args.centroids, args.copies, data_width=args.data_width[0],
+                              arity=args.arity, mac=args.mac, widths=args.widths, ids=args.ids, fold=args.fold,
+                              multipass=args.multipass, accumulate=args.accumulate, persistent=args.persistent,
+                              shadow=args.shadow, header=args.header)
+        estimation = estimate(config, args.frequency * 1e6)
+    print(report(estimation))
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(estimation, fp, indent=2)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(e)
+        traceback.print_exc()
@@ -0,0 +1,124 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+src_path = os.path.dirname(os.path.abspath(__file__))
+
+_generator_version = None
+
+
+def generator_version():
+    # any change to the generator sources invalidates the cached designs
+    global _generator_version
+    if _generator_version is None:
+        digest = hashlib.sha256()
+        for name in sorted(glob.glob('%s/*.py' % src_path)):
+            digest.update(os.path.basename(name).encode('utf-8'))
+            with open(name, 'rb') as fp:
+                digest.update(fp.read())
+        _generator_version = digest.hexdigest()
+    return _generator_version
+
+
+def add_cache_args(parser):
+    parser.add_argument('--cache-dir', help='Directory of the generation cache (disabled if not given)', type=str,
+                        default=os.environ.get('KMEANS_GENERATOR_CACHE'))
+    parser.add_argument('--cache-size', help='Generation cache size limit in MB', type=int, default=1024)
+
+
+class GenerationCache:
+    verilog_file = 'kernel_top.v'
+    metadata_file = 'metadata.json'
+
+    def __init__(self, root, max_bytes=1024 * 1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def key(config):
+        normalized = json.dumps({'config': config.to_dict(), 'generator': generator_version()}, sort_keys=True)
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, config):
+        path = self.entry_path(self.key(config))
+        try:
+            with open(os.path.join(path, self.verilog_file)) as fp:
+                verilog = fp.read()
+            with open(os.path.join(path, self.metadata_file)) as fp:
+                metadata = json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+        # the entry modification time is its last use, for the LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return verilog, metadata
+
+    def put(self, config, verilog, metadata):
+        path = self.entry_path(self.key(config))
+        if os.path.isdir(path):
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp_', dir=os.path.dirname(path))
+        with open(os.path.join(tmp, self.verilog_file), 'w') as fp:
+            fp.write(verilog)
+        with open(os.path.join(tmp, self.metadata_file), 'w') as fp:
+            json.dump(metadata, fp, indent=2)
+
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another process stored the same design first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.root, '??', '*')):
+            if os.path.basename(path).startswith('.tmp_'):
+                continue
+            try:
+                size = sum(os.path.getsize(f) for f in glob.glob(os.path.join(path, '*')))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            self.remove(path)
+
+    @staticmethod
+    def remove(path):
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+
+def open_cache(args):
+    if not args.cache_dir:
+        return None
+    return GenerationCache(args.cache_dir, args.cache_size * 1024 * 1024)
@@ -1,11 +1,13 @@
 from veriloggen import *
 
 from make_kmeans_top import make_kmeans_top
-from utils import validate_configurations, initialize_regs
+from utils import initialize_regs
 
 
 class KmeanAcc:
-    def __init__(self, external_data_width, data_width, k, dimensions, copies):
+    def __init__(self, external_data_width, data_width, k, dimensions, copies, emission='flat', arity=2, mac=False,
+                 widths='uniform', ids='datapath', fold=0, multipass=False, accumulate=False, persistent=0,
+                 shadow=False, header='sparse'):
         self.external_data_width = external_data_width
         self.data_width = data_width
         self.k = k
@@ -13,6 +15,17 @@ class KmeanAcc:
         self.num_in = copies
         self.num_out = copies
         self.copies = copies
+        self.emission = emission
+        self.arity = arity
+        self.mac = mac
+        self.widths = widths
+        self.ids = ids
+        self.fold = fold
+        self.multipass = multipass
+        self.accumulate = accumulate
+        self.persistent = persistent
+        self.shadow = shadow
+        self.header = header
 
     def get_num_in(self):
         return self.num_in
@@ -24,13 +37,6 @@ class KmeanAcc:
         return self.create_kmeans_acc()
 
     def create_kmeans_acc(self):
-        # Verificação do preenchimento total da linha de cache pelo circuito.
-        if not validate_configurations(self.external_data_width, self.data_width, self.dimensions):
-            print('Erro de geração')
-            print('A geração do circuito depende do preenchimento completo da linha de cache fornecida.')
-            print('')
-            exit(1)
-
         m = Module('kmeans_acc')
 
         INTERFACE_DATA_WIDTH = m.Parameter('INTERFACE_DATA_WIDTH', self.external_data_width)
@@ -74,7 +80,9 @@ class KmeanAcc:
             )
         )
 
-        kmeans = make_kmeans_top(self.external_data_width, self.data_width, self.k, self.dimensions)
+        kmeans = make_kmeans_top(self.external_data_width, self.data_width, self.k, self.dimensions, self.emission,
+                                 self.arity, self.mac, self.widths, self.ids, self.fold, self.multipass,
+                                 self.accumulate, self.persistent, self.shadow, self.header)
         for i in range(self.copies):
             params = []
             con = [('clk', clk), ('rst', rst), ('start', start_r), ('kmeans_top_done_rd_data', acc_user_done_rd_data[i]),
@@ -0,0 +1,151 @@
+from profiler import profiler
+
+
+class KmeansConfig:
+    def __init__(self, dimensions, centroids, copies=1, external_data_width=512, data_width=16, emission='flat',
+                 arity=2, mac=False, widths='uniform', ids='datapath', fold=0, multipass=False, accumulate=False,
+                 persistent=0, shadow=False, header='sparse'):
+        self.dimensions = dimensions
+        self.k_array = list(centroids) if isinstance(centroids, (list, tuple)) else [centroids]
+        self.copies = copies
+        self.external_data_width = external_data_width
+        self.data_width = data_width
+        # flat: one instance per core and per datapath node
+        # generate: generate loops for the core replicas and the IMM/SUB/QUAD lanes
+        self.emission = emission
+        # inputs of the ADD and CMP tree operators
+        self.arity = arity
+        # DSP cascade (MAC chain) distance instead of QUAD and ADD tree
+        self.mac = mac
+        # uniform: one bus width per node type
+        # exact: the width of the value range of every node
+        self.widths = widths
+        # datapath: the centroid IDs travel with the data through every node
+        # leaves: the IDs are constants added at the compare tree inputs
+        self.ids = ids
+        # distance units of every kmeans core, iterating over the centroids;
+        # 0 gives a unit per centroid
+        self.fold = fold
+        # the kernel writes the (distance, centroid) state of every point,
+        # and the hosts classify K beyond the centroids of the kernel in
+        # several passes
+        self.multipass = multipass
+        # the kernel writes the coordinate sums and point count of every
+        # cluster instead of the labels
+        self.accumulate = accumulate
+        # lines of points kept on chip by a kernel that runs the Lloyd
+        # iterations itself and writes the final centroids; 0 disables it
+        self.persistent = persistent
+        # shadow centroid registers of the persistent kernel, loaded while
+        # the updater runs and swapped in at the pass boundary
+        self.shadow = shadow
+        # centroid configuration format: 64-bit entries of the IMM ID and
+        # the value, or dense lines of values in IMM ID order
+        self.header = header
+
+    def validate(self):
+        # the options that cannot be combined, checked by the generator and
+        # by the resource model
+        from utils import line_cores, point_tiles, state_width, header_slot_width
+
+        cores_per_kmeans = line_cores(self.external_data_width, self.data_width, self.dimensions)
+        tiles = point_tiles(self.external_data_width, self.data_width, self.dimensions)
+        if self.fold and tiles > 1:
+            raise Exception('Folded kmeans cores do not take points of more than a tile')
+        if self.header == 'dense' and (self.data_width > header_slot_width or self.fold or tiles > 1 or
+                                       self.persistent):
+            # every IMM takes the slot of its coordinate, whole, from the line
+            # of the dense header
+            raise Exception('The dense header takes coordinates of up to %d bits, and neither folded cores, points '
+                            'of more than a tile nor the persistent kernel' % header_slot_width)
+        if self.multipass and cores_per_kmeans * state_width > self.external_data_width:
+            # a core writes a state per point, so the states of a line only
+            # fit in it when the points are as wide as a state
+            raise Exception('Multipass writes a %d-bit state per point, so the points take at least %d bits: %d '
+                            'features of %d bits or more, not %d' % (state_width, state_width,
+                                                                     -(-state_width // self.data_width),
+                                                                     self.data_width, self.dimensions))
+        if self.persistent and (len(self.k_array) > 1 or tiles > 1 or self.multipass or self.accumulate):
+            raise Exception('The persistent kernel takes a single kmeans, and neither points of more than a tile, '
+                            'multipass nor accumulate')
+        if self.shadow and not self.persistent:
+            raise Exception('The shadow centroids are swapped between the passes of the persistent kernel')
+        if self.accumulate and (tiles > 1 or self.multipass):
+            raise Exception('The accumulate mode takes neither points of more than a tile nor multipass')
+
+    def to_dict(self):
+        return {'dimensions': self.dimensions,
+                'k_array': list(self.k_array),
+                'copies': self.copies,
+                'external_data_width': self.external_data_width,
+                'data_width': self.data_width,
+                'emission': self.emission,
+                'arity': self.arity,
+                'mac': self.mac,
+                'widths': self.widths,
+                'ids': self.ids,
+                'fold': self.fold,
+                'multipass': self.multipass,
+                'accumulate': self.accumulate,
+                'persistent': self.persistent,
+                'shadow': self.shadow,
+                'header': self.header}
+
+
+class KmeansDesign:
+    def __init__(self, config, accelerator, kernel_top, verilog):
+        self.config = config
+        self.accelerator = accelerator
+        self.kernel_top = kernel_top
+        self.verilog = verilog
+        self.metadata = design_metadata(config)
+
+
+def design_metadata(config):
+    from utils import pipeline_depth, line_cores, point_tiles, tile_dimensions, fold_units, fold_rounds
+
+    cores_per_kmeans = line_cores(config.external_data_width, config.data_width, config.dimensions)
+    tiles = point_tiles(config.external_data_width, config.data_width, config.dimensions)
+    return {'config': config.to_dict(),
+            'cores_per_kmeans': cores_per_kmeans,
+            'cores_per_copy': cores_per_kmeans * len(config.k_array),
+            'tiles': tiles,
+            'rounds': max(fold_rounds(k, config.fold) for k in config.k_array),
+            'pipeline_depth': max(pipeline_depth(fold_units(k, config.fold), tile_dimensions(config.dimensions, tiles),
+                                                 config.arity, config.mac, tiles, config.fold > 0)
+                                  for k in config.k_array),
+            'num_m_axis': config.copies}
+
+
+def generate(config):
+    # builds the kernel_top module and its Verilog in memory, without touching
+    # the working directory or the file system. The generator modules are
+    # imported here, so cache hits in generate_verilog never load veriloggen
+    from create_acc_axi_interface import AccAXIInterface
+    from kmeans_accelerator import KmeanAcc
+
+    with profiler.stage('kernel_top'):
+        accelerator = KmeanAcc(config.external_data_width, config.data_width, config.k_array, config.dimensions,
+                               config.copies, config.emission, config.arity, config.mac, config.widths,
+                               config.ids, config.fold, config.multipass, config.accumulate,
+                               config.persistent, config.shadow, config.header)
+        kernel_top = AccAXIInterface(accelerator).create_kernel_top()
+    with profiler.stage('to_verilog'):
+        verilog = kernel_top.to_verilog()
+    return KmeansDesign(config, accelerator, kernel_top, verilog)
+
+
+def generate_verilog(config, cache=None):
+    # returns the Verilog and metadata of the design, from the generation
+    # cache when the same configuration was already generated
+    if cache is not None:
+        with profiler.stage('cache_lookup'):
+            cached = cache.get(config)
+        if cached is not None:
+            return cached
+
+    design = generate(config)
+    if cache is not None:
+        with profiler.stage('cache_store'):
+            cache.put(config, design.verilog, design.metadata)
+    return design.verilog, design.metadata
@@ -2,13 +2,27 @@ from veriloggen import *
 
 from components import Components
 from make_kmeans_core import make_kmeans_core
+from utils import line_cores, point_tiles, tile_dimensions, bits, fold_units, fold_rounds, pipeline_depth, \
+    state_width, state_id_width, accumulator_width, accumulator_word_width, header_slot_width, configuration_width
 
+# beats waiting for the folded cores. kmeans_ready holds the input
+# controller while the FIFO has less free entries than the beats that may
+# still arrive: the lines requested and read before it sees ready fall,
+# and the beat of the input gearbox
+fold_fifo_depth = 8
+fold_fifo_slack = 4
 
-def make_kmeans(external_data_width, data_width, k, sumK, dimensions, components_array):
+
+def make_kmeans(external_data_width, data_width, k, sumK, dimensions, components_array, emission='flat', arity=2,
+                mac=False, widths='uniform', ids='datapath', fold=0, multipass=False, accumulate=False,
+                persistent=False, shadow=False, header='sparse', centroid_id_base=0, imm_id_base=0):
     m = Module('kmeans_%d' % k)
 
-    controller_data_width = 8
-    kmeans_cores = (external_data_width // data_width) // dimensions
+    controller_data_width = state_width if multipass else 8
+    kmeans_cores = line_cores(external_data_width, data_width, dimensions)
+    # features of the beat of every core: a point, or a tile of it
+    tiles = point_tiles(external_data_width, data_width, dimensions)
+    core_dimensions = tile_dimensions(dimensions, tiles)
         
     params = []
 
@@ -16,32 +30,531 @@ def make_kmeans(external_data_width, data_width, k, sumK, dimensions, components
     clk = m.Input('clk')
     rst = m.Input('rst')
 
-    kmeans_centroids_configurations_in = m.Input('kmeans_centroids_configurations_in', 64)
-    kmeans_data_in = m.Input('kmeans_data_in', external_data_width)
+    kmeans_centroids_configurations_in = m.Input('kmeans_centroids_configurations_in',
+                                                 configuration_width(external_data_width, header))
+    kmeans_data_in = m.Input('kmeans_data_in', kmeans_cores * data_width * core_dimensions)
     kmeans_input_valid = m.Input('kmeans_input_valid', 2)
-    kmeans_data_out = m.Output('kmeans_data_out', kmeans_cores * controller_data_width)
-    kmeans_output_valid = m.Output('kmeans_output_valid', 2)
+    if accumulate or persistent:
+        # the cores label the points for the cluster accumulators, that
+        # write their sums and counts once the input is done, or update the
+        # centroids of the persistent kernel
+        kmeans_data_out = m.Output('kmeans_data_out', accumulator_word_width)
+        kmeans_output_valid = m.Output('kmeans_output_valid', 2)
+        kmeans_num_points = m.Input('kmeans_num_points', 32)
+        core_data_out = m.Wire('core_labels', kmeans_cores * controller_data_width)
+        label_valid = m.Wire('label_valid', 2)
+    else:
+        kmeans_data_out = m.Output('kmeans_data_out', kmeans_cores * controller_data_width)
+        kmeans_output_valid = m.Output('kmeans_output_valid', 2)
+        core_data_out = kmeans_data_out
+        label_valid = kmeans_output_valid
+    pass_rst = rst
+    core_configurations_in = kmeans_centroids_configurations_in
+    if persistent:
+        # every pass over the points resets the cores, the accumulators and
+        # the validity of the labels, and the centroids computed on chip are
+        # loaded into the cores between the passes, the folded ones from
+        # their first IMM ID again
+        kmeans_max_iterations = m.Input('kmeans_max_iterations', 32)
+        kmeans_store_overflow = m.Input('kmeans_store_overflow')
+        kmeans_restart = m.OutputReg('kmeans_restart')
+        kmeans_replay = m.OutputReg('kmeans_replay')
+        pass_rst = m.Wire('pass_rst')
+        pass_rst.assign(rst | kmeans_restart)
+        core_configurations_in = m.Wire('core_centroids_configurations_in', 64)
+    core_rst = pass_rst
+    core_swap = []
+    if shadow:
+        # the cores keep their centroids over the restart: the new ones are
+        # written behind them while the updater computes them, and swapped
+        # in with the restart, or once the header is loaded
+        kmeans_centroids_swap = m.Input('kmeans_centroids_swap')
+        centroids_swap = m.Wire('centroids_swap')
+        centroids_swap.assign(kmeans_centroids_swap | kmeans_restart)
+        core_rst = rst
+        core_swap = [('kmeans_core_centroids_swap', centroids_swap)]
+    core_id_base = []
+    if multipass:
+        kmeans_id_base = m.Input('kmeans_id_base', state_id_width)
+        core_id_base = [('kmeans_core_id_base', kmeans_id_base)]
 
     m.EmbeddedCode(' ')
     m.EmbeddedCode('//Validity_protractor instantiation.')
 
-    validity_protractor = Components().create_validity_protractor(k, dimensions)
-    con = [('clk', clk), ('rst', rst),
-           ('validity_protractor_input_valid', kmeans_input_valid),
-           ('validity_protractor_output_valid', kmeans_output_valid)]
+    point_valid = kmeans_input_valid
+    core_data_in = kmeans_data_in
+    core_tile = []
+    if tiles > 1:
+        # tile of the beat; only the last tile of a point gives a label
+        m.EmbeddedCode(' ')
+        m.EmbeddedCode('//Tile counter')
+        tile = m.Reg('tile', bits(tiles))
+        point_valid = m.Wire('point_valid', 2)
+        point_valid.assign(Mux(AndList(kmeans_input_valid == Int(1, 2, 10), tile != Int(tiles - 1, tile.width, 10)),
+                               Int(0, 2, 10), kmeans_input_valid))
+        m.Always(Posedge(clk))(
+            If(rst)(
+                tile(Int(0, tile.width, 10)),
+            ).Elif(kmeans_input_valid == Int(1, 2, 10))(
+                tile(Mux(tile == Int(tiles - 1, tile.width, 10), Int(0, tile.width, 10), tile + Int(1, tile.width, 10))),
+            )
+        )
+        core_tile = [('kmeans_core_tile', tile), ('kmeans_core_tile_valid', kmeans_input_valid == Int(1, 2, 10))]
+
+    if fold:
+        core_data_in, point_valid, core_tile = make_round_scheduler(m, pass_rst, kmeans_data_in, kmeans_input_valid,
+                                                                    fold_rounds(k, fold))
+
+    validity_protractor = Components().create_validity_protractor(fold_units(k, fold), core_dimensions, arity, mac,
+                                                                  tiles, fold > 0)
+    con = [('clk', clk), ('rst', pass_rst),
+           ('validity_protractor_input_valid', point_valid),
+           ('validity_protractor_output_valid', label_valid)]
     m.Instance(validity_protractor, 'validity_protractor', params, con)
 
-    kmeans_core = make_kmeans_core(data_width, k, sumK, dimensions, components_array)
-    for i in range(0, kmeans_cores):
+    kmeans_core = make_kmeans_core(data_width, k, sumK, dimensions, components_array, emission, arity, mac, widths,
+                                   ids, tiles, fold, multipass, shadow,
+                                   external_data_width // header_slot_width if header == 'dense' else 0,
+                                   centroid_id_base, imm_id_base)
+
+    if emission == 'generate':
         m.EmbeddedCode(' ')
-        m.EmbeddedCode('//kmeans_core core %d Instantiation' % i)
+        m.EmbeddedCode('//kmeans_core cores Instantiation')
 
-        con = [('clk', clk), ('rst', rst),
-               ('kmeans_core_centroids_configurations_in', kmeans_centroids_configurations_in),
-               ('kmeans_core_data_in', kmeans_data_in[(i * data_width * dimensions):(i * data_width * dimensions) + (
-                       data_width * dimensions)]),
+        i = m.Genvar('i')
+        gen = m.GenerateFor(i(0), i < kmeans_cores, i.inc(), 'kmeans_cores')
+        con = [('clk', clk), ('rst', core_rst),
+               ('kmeans_core_centroids_configurations_in', core_configurations_in),
+               ('kmeans_core_data_in', core_data_in[(i * data_width * core_dimensions):(i * data_width * core_dimensions) + (
+                       data_width * core_dimensions)]),
                ('kmeans_core_data_out',
-                kmeans_data_out[(i * controller_data_width):(i * controller_data_width) + controller_data_width])]
-        m.Instance(kmeans_core, 'kmeans_core_%d' % i, params, con)
+                core_data_out[(i * controller_data_width):(i * controller_data_width) + controller_data_width])] + core_tile + core_id_base + core_swap
+        gen.Instance(kmeans_core, 'kmeans_core', params, con)
+    else:
+        for i in range(0, kmeans_cores):
+            m.EmbeddedCode(' ')
+            m.EmbeddedCode('//kmeans_core core %d Instantiation' % i)
+
+            con = [('clk', clk), ('rst', core_rst),
+                   ('kmeans_core_centroids_configurations_in', core_configurations_in),
+                   ('kmeans_core_data_in', core_data_in[(i * data_width * core_dimensions):(i * data_width * core_dimensions) + (
+                           data_width * core_dimensions)]),
+                   ('kmeans_core_data_out',
+                    core_data_out[(i * controller_data_width):(i * controller_data_width) + controller_data_width])] + core_tile + core_id_base + core_swap
+            m.Instance(kmeans_core, 'kmeans_core_%d' % i, params, con)
+
+    if accumulate or persistent:
+        depth = pipeline_depth(fold_units(k, fold), dimensions, arity, mac, 1, fold > 0)
+        points_done, rd_cluster, rd_feature, accumulator_sum = make_cluster_accumulators(
+            m, pass_rst, k, dimensions, data_width, kmeans_cores, core_data_in, point_valid, core_data_out, label_valid,
+            depth, centroid_id_base)
+        if persistent:
+            make_lloyd_updater(m, k, dimensions, data_width, depth, label_valid, points_done, rd_cluster, rd_feature,
+                               accumulator_sum, shadow)
+        else:
+            make_accumulator_drain(m, k, dimensions, label_valid, points_done, rd_cluster, rd_feature,
+                                   accumulator_sum)
 
     return m
+
+
+def make_round_scheduler(m, rst, kmeans_data_in, kmeans_input_valid, rounds):
+    # folded cores: a beat takes rounds cycles, one per round of centroids,
+    # and the next beat starts with the last round of the previous one.
+    # Returns the beat, the validity of its labels and the round ports of
+    # the cores
+    clk = m.get_ports()['clk']
+    kmeans_ready = m.Output('kmeans_ready')
+
+    m.EmbeddedCode(' ')
+    m.EmbeddedCode('//Beat FIFO and round scheduler')
+    fifo = m.Reg('beat_fifo', kmeans_data_in.width, fold_fifo_depth)
+    fifo_head = m.Reg('fifo_head', bits(fold_fifo_depth))
+    fifo_tail = m.Reg('fifo_tail', bits(fold_fifo_depth))
+    fifo_count = m.Reg('fifo_count', bits(fold_fifo_depth + 1))
+    beat = m.Reg('beat', kmeans_data_in.width)
+    current_round = m.Reg('round', bits(rounds))
+    busy = m.Reg('busy')
+    input_done = m.Reg('input_done')
+    push = m.Wire('push')
+    pop = m.Wire('pop')
+    last_round = m.Wire('last_round')
+    point_valid = m.Wire('point_valid', 2)
+
+    push.assign(kmeans_input_valid == Int(1, 2, 10))
+    last_round.assign(current_round == Int(rounds - 1, current_round.width, 10))
+    pop.assign(AndList(fifo_count != Int(0, fifo_count.width, 10), OrList(Not(busy), last_round)))
+    kmeans_ready.assign(fifo_count <= Int(fold_fifo_depth - fold_fifo_slack, fifo_count.width, 10))
+    # the labels of a beat are valid with its last round; the input is done
+    # once every beat went through the cores
+    point_valid.assign(Mux(AndList(busy, last_round), Int(1, 2, 10),
+                           Mux(AndList(input_done, fifo_count == Int(0, fifo_count.width, 10), Not(busy)),
+                               Int(2, 2, 10), Int(0, 2, 10))))
+
+    m.Always(Posedge(clk))(
+        If(push)(
+            fifo[fifo_tail](kmeans_data_in),
+        ),
+        If(pop)(
+            beat(fifo[fifo_head]),
+        ),
+        If(rst)(
+            fifo_head(Int(0, fifo_head.width, 10)),
+            fifo_tail(Int(0, fifo_tail.width, 10)),
+            fifo_count(Int(0, fifo_count.width, 10)),
+            current_round(Int(0, current_round.width, 10)),
+            busy(Int(0, 1, 2)),
+            input_done(Int(0, 1, 2)),
+        ).Else(
+            If(push)(
+                fifo_tail(fifo_tail + Int(1, fifo_tail.width, 10)),
+            ),
+            If(pop)(
+                fifo_head(fifo_head + Int(1, fifo_head.width, 10)),
+            ),
+            If(AndList(push, Not(pop)))(
+                fifo_count(fifo_count + Int(1, fifo_count.width, 10)),
+            ).Elif(AndList(pop, Not(push)))(
+                fifo_count(fifo_count - Int(1, fifo_count.width, 10)),
+            ),
+            If(kmeans_input_valid == Int(2, 2, 10))(
+                input_done(Int(1, 1, 2)),
+            ),
+            If(pop)(
+                current_round(Int(0, current_round.width, 10)),
+                busy(Int(1, 1, 2)),
+            ).Elif(last_round)(
+                current_round(Int(0, current_round.width, 10)),
+                busy(Int(0, 1, 2)),
+            ).Elif(busy)(
+                current_round(current_round + Int(1, current_round.width, 10)),
+            ),
+        )
+    )
+
+    return beat, point_valid, [('kmeans_core_round', current_round), ('kmeans_core_round_valid', busy)]
+
+
+def make_cluster_accumulators(m, rst, k, dimensions, data_width, kmeans_cores, core_data_in, point_valid, core_labels,
+                              label_valid, depth, centroid_id_base=0):
+    # accumulate mode: the beat is delayed to the labels of its points, and
+    # every core adds its point to the sums of its cluster, up to the number
+    # of points of the header, past which the beats only hold padding. The
+    # accumulator of rd_cluster and rd_feature, summed over the cores, is
+    # in accumulator_sum two cycles later. The reset only clears the first
+    # stage of the validity protractor, so the done of the labels counts
+    # once the input is done. The labels are offset by centroid_id_base.
+    # Returns points_done, the read address and accumulator_sum
+    clk = m.get_ports()['clk']
+    kmeans_num_points = m.get_ports()['kmeans_num_points']
+
+    m.EmbeddedCode(' ')
+    m.EmbeddedCode('//Points delayed to their labels')
+    point_data = m.Wire('point_data', core_data_in.width)
+    reg_pipe = Components().create_register_pipeline()
+    params = [('num_register', depth), ('width', core_data_in.width)]
+    con = [('clk', clk), ('rst', rst), ('en', Int(1, 1, 2)), ('in', core_data_in), ('out', point_data)]
+    m.Instance(reg_pipe, 'point_pipe', params, con)
+
+    m.EmbeddedCode(' ')
+    m.EmbeddedCode('//Cluster accumulators')
+    labeled_points = m.Reg('labeled_points', 32)
+    points_done = m.Reg('points_done')
+    rd_cluster = m.Reg('rd_cluster', bits(k))
+    rd_feature = m.Reg('rd_feature', bits(dimensions + 1))
+    accumulator_sum = m.Reg('accumulator_sum', accumulator_width)
+    rd_data = [m.Wire('rd_data_%d' % i, accumulator_width) for i in range(kmeans_cores)]
+
+    cluster_accumulator = Components().create_cluster_accumulator(k, dimensions, data_width)
+    point_width = data_width * dimensions
+    label_width = core_labels.width // kmeans_cores
+    for i in range(kmeans_cores):
+        label = core_labels[i * label_width:i * label_width + bits(k)]
+        if centroid_id_base:
+            label = label - Int(centroid_id_base, bits(k), 10)
+        con = [('clk', clk), ('rst', rst),
+               ('cluster_accumulator_valid', AndList(label_valid == Int(1, 2, 10),
+                                                     labeled_points + Int(i, 32, 10) < kmeans_num_points)),
+               ('cluster_accumulator_label', label),
+               ('cluster_accumulator_data_in', point_data[i * point_width:(i + 1) * point_width]),
+               ('cluster_accumulator_rd_cluster', rd_cluster),
+               ('cluster_accumulator_rd_feature', rd_feature),
+               ('cluster_accumulator_rd_data', rd_data[i])]
+        m.Instance(cluster_accumulator, 'cluster_accumulator_%d' % i, [], con)
+
+    total = rd_data[0]
+    for data in rd_data[1:]:
+        total = total + data
+
+    m.Always(Posedge(clk))(
+        accumulator_sum(total),
+        If(rst)(
+            labeled_points(Int(0, labeled_points.width, 10)),
+            points_done(Int(0, 1, 2)),
+        ).Else(
+            If(label_valid == Int(1, 2, 10))(
+                labeled_points(labeled_points + Int(kmeans_cores, labeled_points.width, 10)),
+            ),
+            If(point_valid == Int(2, 2, 10))(
+                points_done(Int(1, 1, 2)),
+            ),
+        )
+    )
+
+    return points_done, rd_cluster, rd_feature, accumulator_sum
+
+
+def make_accumulator_drain(m, k, dimensions, label_valid, points_done, rd_cluster, rd_feature, accumulator_sum):
+    # once the labels are done, the accumulators are written one per cycle,
+    # cluster by cluster, the count after the sums
+    clk = m.get_ports()['clk']
+    rst = m.get_ports()['rst']
+    kmeans_data_out = m.get_ports()['kmeans_data_out']
+    kmeans_output_valid = m.get_ports()['kmeans_output_valid']
+
+    m.EmbeddedCode(' ')
+    m.EmbeddedCode('//Accumulator drain')
+    draining = m.Reg('draining')
+    drained = m.Reg('drained')
+    rd_valid = m.Reg('rd_valid')
+    sum_valid = m.Reg('sum_valid')
+
+    kmeans_data_out.assign(Cat(Int(0, accumulator_word_width - accumulator_width, 10), accumulator_sum))
+    kmeans_output_valid.assign(Mux(sum_valid, Int(1, 2, 10),
+                                   Mux(AndList(drained, Not(rd_valid), Not(sum_valid)), Int(2, 2, 10),
+                                       Int(0, 2, 10))))
+
+    m.Always(Posedge(clk))(
+        If(rst)(
+            draining(Int(0, 1, 2)),
+            drained(Int(0, 1, 2)),
+            rd_cluster(Int(0, rd_cluster.width, 10)),
+            rd_feature(Int(0, rd_feature.width, 10)),
+            rd_valid(Int(0, 1, 2)),
+            sum_valid(Int(0, 1, 2)),
+        ).Else(
+            rd_valid(draining),
+            sum_valid(rd_valid),
+            If(AndList(points_done, label_valid == Int(2, 2, 10), Not(draining), Not(drained)))(
+                draining(Int(1, 1, 2)),
+            ),
+            If(draining)(
+                If(rd_feature == Int(dimensions, rd_feature.width, 10))(
+                    rd_feature(Int(0, rd_feature.width, 10)),
+                    If(rd_cluster == Int(k - 1, rd_cluster.width, 10))(
+                        draining(Int(0, 1, 2)),
+                        drained(Int(1, 1, 2)),
+                    ).Else(
+                        rd_cluster(rd_cluster + Int(1, rd_cluster.width, 10)),
+                    ),
+                ).Else(
+                    rd_feature(rd_feature + Int(1, rd_feature.width, 10)),
+                ),
+            ),
+        )
+    )
+
+
+def make_lloyd_updater(m, k, dimensions, data_width, depth, label_valid, points_done, rd_cluster, rd_feature,
+                       accumulator_sum, shadow=False):
+    # persistent kernel: the centroids of the header are kept as they are
+    # loaded, and once the labels of a pass are done every coordinate is
+    # replaced by the sum of its cluster divided by the count, a quotient
+    # bit per cycle, or kept when the cluster got no point. Unless no
+    # coordinate changed, the maximum of passes of the header is reached or
+    # the points did not fit in the store, the accumulators are restarted,
+    # the new centroids go through the configuration bus of the cores as
+    # the header entries, for at least the depth of the protractor so that
+    # the done of the pass leaves it, and the points are replayed. With
+    # shadow centroids, every new coordinate goes to the bus as it is
+    # computed, and the restart only waits for the protractor. The kernel
+    # then writes the passes, with the converged flag in bit 32, and the
+    # header entries of the centroids, in 64-bit words
+    clk = m.get_ports()['clk']
+    rst = m.get_ports()['rst']
+    kmeans_centroids_configurations_in = m.get_ports()['kmeans_centroids_configurations_in']
+    kmeans_max_iterations = m.get_ports()['kmeans_max_iterations']
+    kmeans_store_overflow = m.get_ports()['kmeans_store_overflow']
+    kmeans_restart = m.get_ports()['kmeans_restart']
+    kmeans_replay = m.get_ports()['kmeans_replay']
+    kmeans_data_out = m.get_ports()['kmeans_data_out']
+    kmeans_output_valid = m.get_ports()['kmeans_output_valid']
+    core_configurations_in = m.find_identifier('core_centroids_configurations_in')
+
+    coordinates = k * dimensions
+    reload_cycles = depth + 1 if shadow else max(coordinates, depth + 1)
+
+    m.EmbeddedCode(' ')
+    m.EmbeddedCode('//Lloyd updater')
+    update_fsm = m.Reg('update_fsm', 3)
+    UPDATE_PASS = m.Localparam('UPDATE_PASS', Int(0, update_fsm.width, 10))
+    UPDATE_COUNT = m.Localparam('UPDATE_COUNT', Int(1, update_fsm.width, 10))
+    UPDATE_SUM = m.Localparam('UPDATE_SUM', Int(2, update_fsm.width, 10))
+    UPDATE_DIVIDE = m.Localparam('UPDATE_DIVIDE', Int(3, update_fsm.width, 10))
+    UPDATE_STORE = m.Localparam('UPDATE_STORE', Int(4, update_fsm.width, 10))
+    UPDATE_CHECK = m.Localparam('UPDATE_CHECK', Int(5, update_fsm.width, 10))
+    UPDATE_RELOAD = m.Localparam('UPDATE_RELOAD', Int(6, update_fsm.width, 10))
+    UPDATE_WRITE = m.Localparam('UPDATE_WRITE', Int(7, update_fsm.width, 10))
+
+    centroids = m.Reg('centroids', data_width, coordinates)
+    update_index = m.Reg('update_index', bits(max(coordinates + 1, reload_cycles)))
+    update_wait = m.Reg('update_wait', 2)
+    cluster_count = m.Reg('cluster_count', accumulator_width)
+    remainder = m.Reg('remainder', accumulator_width)
+    divisor = m.Reg('divisor', accumulator_width + data_width - 1)
+    quotient = m.Reg('quotient', data_width)
+    divide_step = m.Reg('divide_step', bits(data_width))
+    changed = m.Reg('changed')
+    converged = m.Reg('converged')
+    passes = m.Reg('passes', 32)
+    reload_entry = m.Reg('reload_entry', 64)
+    result = m.Reg('result', accumulator_word_width)
+    result_valid = m.Reg('result_valid')
+    written = m.Reg('written')
+    load_id = m.Wire('load_id', 32)
+    centroid = m.Wire('centroid', data_width)
+    new_centroid = m.Wire('new_centroid', data_width)
+
+    def entry(value, imm_id):
+        # header entry of a coordinate: the value above the IMM ID
+        value_bits = [Int(0, 32 - data_width, 10), value] if data_width < 32 else [value]
+        return Cat(*value_bits, Int(0, 32 - update_index.width, 10), imm_id)
+
+    # the configuration bus is idle once the header is loaded
+    core_configurations_in.assign(kmeans_centroids_configurations_in | reload_entry)
+    load_id.assign(kmeans_centroids_configurations_in[0:32])
+    centroid.assign(centroids[update_index])
+    new_centroid.assign(Mux(cluster_count == Int(0, cluster_count.width, 10), centroid, quotient))
+    kmeans_data_out.assign(result)
+    kmeans_output_valid.assign(Mux(result_valid, Int(1, 2, 10), Mux(written, Int(2, 2, 10), Int(0, 2, 10))))
+
+    m.Always(Posedge(clk))(
+        If(AndList(load_id != Int(0, 32, 10), load_id <= Int(coordinates, 32, 10)))(
+            centroids[load_id - Int(1, 32, 10)](kmeans_centroids_configurations_in[32:32 + data_width]),
+        ).Elif(update_fsm == UPDATE_STORE)(
+            centroids[update_index](new_centroid),
+        ),
+    )
+
+    m.Always(Posedge(clk))(
+        If(rst)(
+            update_fsm(UPDATE_PASS),
+            update_index(Int(0, update_index.width, 10)),
+            update_wait(Int(0, update_wait.width, 10)),
+            rd_cluster(Int(0, rd_cluster.width, 10)),
+            rd_feature(Int(0, rd_feature.width, 10)),
+            changed(Int(0, 1, 2)),
+            converged(Int(0, 1, 2)),
+            passes(Int(0, passes.width, 10)),
+            reload_entry(Int(0, reload_entry.width, 10)),
+            result_valid(Int(0, 1, 2)),
+            written(Int(0, 1, 2)),
+            kmeans_restart(Int(0, 1, 2)),
+            kmeans_replay(Int(0, 1, 2)),
+        ).Else(
+            kmeans_restart(Int(0, 1, 2)),
+            kmeans_replay(Int(0, 1, 2)),
+            result_valid(Int(0, 1, 2)),
+            reload_entry(Int(0, reload_entry.width, 10)),
+            Case(update_fsm)(
+                When(UPDATE_PASS)(
+                    If(AndList(points_done, label_valid == Int(2, 2, 10)))(
+                        update_index(Int(0, update_index.width, 10)),
+                        update_wait(Int(0, update_wait.width, 10)),
+                        rd_cluster(Int(0, rd_cluster.width, 10)),
+                        rd_feature(Int(dimensions, rd_feature.width, 10)),
+                        changed(Int(0, 1, 2)),
+                        update_fsm(UPDATE_COUNT),
+                    )
+                ),
+                When(UPDATE_COUNT)(
+                    update_wait(update_wait + Int(1, update_wait.width, 10)),
+                    If(update_wait == Int(2, update_wait.width, 10))(
+                        cluster_count(accumulator_sum),
+                        update_wait(Int(0, update_wait.width, 10)),
+                        rd_feature(Int(0, rd_feature.width, 10)),
+                        update_fsm(UPDATE_SUM),
+                    )
+                ),
+                When(UPDATE_SUM)(
+                    update_wait(update_wait + Int(1, update_wait.width, 10)),
+                    If(update_wait == Int(2, update_wait.width, 10))(
+                        remainder(accumulator_sum),
+                        divisor(cluster_count << Int(data_width - 1, 8, 10)),
+                        quotient(Int(0, quotient.width, 10)),
+                        divide_step(Int(0, divide_step.width, 10)),
+                        update_wait(Int(0, update_wait.width, 10)),
+                        update_fsm(UPDATE_DIVIDE),
+                    )
+                ),
+                When(UPDATE_DIVIDE)(
+                    If(remainder >= divisor)(
+                        remainder(remainder - divisor),
+                        quotient(Cat(quotient[0:data_width - 1], Int(1, 1, 2))),
+                    ).Else(
+                        quotient(Cat(quotient[0:data_width - 1], Int(0, 1, 2))),
+                    ),
+                    divisor(divisor >> Int(1, 8, 10)),
+                    divide_step(divide_step + Int(1, divide_step.width, 10)),
+                    If(divide_step == Int(data_width - 1, divide_step.width, 10))(
+                        update_fsm(UPDATE_STORE),
+                    )
+                ),
+                When(UPDATE_STORE)(
+                    If(new_centroid != centroid)(
+                        changed(Int(1, 1, 2)),
+                    ),
+                    [reload_entry(entry(new_centroid, update_index + Int(1, update_index.width, 10)))] if shadow else [],
+                    update_index(update_index + Int(1, update_index.width, 10)),
+                    If(rd_feature == Int(dimensions - 1, rd_feature.width, 10))(
+                        rd_feature(Int(dimensions, rd_feature.width, 10)),
+                        If(rd_cluster == Int(k - 1, rd_cluster.width, 10))(
+                            update_fsm(UPDATE_CHECK),
+                        ).Else(
+                            rd_cluster(rd_cluster + Int(1, rd_cluster.width, 10)),
+                            update_fsm(UPDATE_COUNT),
+                        ),
+                    ).Else(
+                        rd_feature(rd_feature + Int(1, rd_feature.width, 10)),
+                        update_fsm(UPDATE_SUM),
+                    ),
+                ),
+                When(UPDATE_CHECK)(
+                    passes(passes + Int(1, passes.width, 10)),
+                    update_index(Int(0, update_index.width, 10)),
+                    converged(Not(changed)),
+                    If(OrList(Not(changed), passes + Int(1, passes.width, 10) >= kmeans_max_iterations,
+                              kmeans_store_overflow))(
+                        update_fsm(UPDATE_WRITE),
+                    ).Else(
+                        kmeans_restart(Int(1, 1, 2)),
+                        update_fsm(UPDATE_RELOAD),
+                    ),
+                ),
+                When(UPDATE_RELOAD)(
+                    update_index(update_index + Int(1, update_index.width, 10)),
+                    [] if shadow else If(update_index < Int(coordinates, update_index.width, 10))(
+                        reload_entry(entry(centroid, update_index + Int(1, update_index.width, 10))),
+                    ),
+                    If(update_index == Int(reload_cycles - 1, update_index.width, 10))(
+                        kmeans_replay(Int(1, 1, 2)),
+                        update_fsm(UPDATE_PASS),
+                    ),
+                ),
+                When(UPDATE_WRITE)(
+                    If(Not(written))(
+                        update_index(update_index + Int(1, update_index.width, 10)),
+                        result_valid(Int(1, 1, 2)),
+                        If(update_index == Int(0, update_index.width, 10))(
+                            result(Cat(Int(0, 31, 10), converged, passes)),
+                        ).Else(
+                            result(entry(centroids[update_index - Int(1, update_index.width, 10)], update_index)),
+                        ),
+                        If(update_index == Int(coordinates, update_index.width, 10))(
+                            written(Int(1, 1, 2)),
+                        ),
+                    ),
+                ),
+            ),
+        )
+    )
@@ -2,81 +2,179 @@ from math import log2, ceil
 
 from veriloggen import *
 
-from utils import generate_kmeans_core
+from profiler import profiled
+from utils import Node, generate_kmeans_core, core_bus_widths, node_widths, centroid_id_tags, tile_dimensions, bits, \
+    fold_units, fold_rounds, fold_bank_centroids, state_width, state_id_width, header_slot_width
 
 
-def make_kmeans_core(data_width, k, sumK, dimensions, components_array):
+@profiled('make_kmeans_core')
+def make_kmeans_core(data_width, k, sumK, dimensions, components_array, emission='flat', arity=2, mac=False,
+                     widths='uniform', ids='datapath', tiles=1, fold=0, multipass=False, shadow=False,
+                     header_slots=0, centroid_id_base=0, imm_id_base=0):
     m = Module('kmeans_core_%d' % k)
 
-    controller_data_width = 8
+    # the kmeans of a top share the configuration bus and number their
+    # centroids and IMMs after those of the kmeans before them
+
+    # multipass: the core writes the state of every point instead of its
+    # label
+    controller_data_width = state_width if multipass else 8
     centroid_id_width = ceil(log2(sumK))
     imm_id_width = ceil(log2((sumK * dimensions) + 1))
 
-    core = generate_kmeans_core(k, dimensions)
+    # with tiles, the core takes a tile of every point per beat: the DFG
+    # covers the features of a tile, and the IMMs hold a coordinate per tile
+    full_dimensions = dimensions
+    dimensions = tile_dimensions(dimensions, tiles)
+
+    # with fold, the DFG has a distance unit per centroid of a round, whose
+    # IMMs are read from a centroid bank every round
+    units = fold_units(k, fold)
+    rounds = fold_rounds(k, fold)
+    core = generate_kmeans_core(units, dimensions, arity, mac, tiles, fold > 0)
 
     clk = m.Input('clk')
     rst = m.Input('rst')
 
-    kmeans_core_centroids_configurations_in = m.Input('kmeans_core_centroids_configurations_in', 64)
+    # header_slots: the configurations are the lines of the dense header,
+    # of header_slots coordinates each, above their line ID
+    kmeans_core_centroids_configurations_in = m.Input('kmeans_core_centroids_configurations_in',
+                                                      32 + header_slots * header_slot_width if header_slots else 64)
     kmeans_core_data_in = m.Input('kmeans_core_data_in', data_width * dimensions)
     kmeans_core_data_out = m.Output('kmeans_core_data_out', controller_data_width)
-
-    num_add = 0
-    for key, values in core.items():
-        if 'ADD' in str(key):
-            num_add = num_add + 1
-
-    add_log_width = 0
-    if num_add > 0:
-        add_log_width = int(log2(num_add))
-
-    bus_width_out = {'ADD': add_log_width + (2 * data_width) + centroid_id_width,
-                     'CMP': add_log_width + (2 * data_width) + centroid_id_width,
-                     'IN': data_width + centroid_id_width,
-                     'IMM': data_width + centroid_id_width,
-                     'QUAD': add_log_width + (2 * data_width) + centroid_id_width,
-                     'REG': add_log_width + (2 * data_width) + centroid_id_width,
-                     'SUB': data_width + centroid_id_width}
-
-    # components list
-    components = []
-    for key, values in core.items():
-        for value in values:
-            if str(key) not in components:
-                components.append(str(key))
-            if str(value) not in components:
-                components.append(str(value))
-    components.sort()
+    if multipass:
+        kmeans_core_id_base = m.Input('kmeans_core_id_base', state_id_width)
+    if shadow:
+        # the configurations load shadow centroids, that replace the
+        # running ones when swap is high
+        kmeans_core_centroids_swap = m.Input('kmeans_core_centroids_swap')
+
+    bus_width_out = core_bus_widths(data_width, sumK, core.count(Node.Type.ADD) + core.count(Node.Type.MAC), tiles)
+
+    # components list: every connected node, in name order
+    names = core.names()
+    components = [node for node in core if len(core.successors(node)) + len(core.predecessors(node)) > 0]
+    components.sort(key=names.__getitem__)
+
+    # data bits of every node, without the centroid ID: the same for all the
+    # nodes of a type, or the exact width of its value range
+    if widths == 'exact':
+        data_bits = node_widths(core, data_width, tiles)
+    else:
+        data_bits = [bus_width_out[core.node_type(node).name] - centroid_id_width for node in core]
+
+    # the nodes without centroid ID only carry their data bits
+    tags = centroid_id_tags(core, ids)
+    bus_bits = [data_bits[node] + (centroid_id_width if tags[node] else 0) for node in core]
+
+    # compare inputs go from the last centroid to the first, so that equal
+    # distances resolve to the first centroid
+    first_centroid = centroid_order(core, dimensions, centroid_id_base)
+
+    # generate emission: the IMM, SUB and QUAD nodes form one lane per
+    # centroid coordinate, indexed by the IMM number, and are emitted as
+    # generate loops over packed buses instead of one instance per node.
+    # MAC chains are not lanes and stay one instance per node
+    banked_types = []
+    if emission == 'generate':
+        banked_types = [Node.Type.IMM, Node.Type.SUB] + ([] if mac else [Node.Type.QUAD])
+    lane = {}
+    for component in components:
+        if core.node_type(component) == Node.Type.IMM:
+            lane[component] = core.ids[component]
+    for node_type in banked_types[1:]:
+        for component in components:
+            if core.node_type(component) == node_type:
+                lane[component] = [lane[pred] for pred in core.predecessors(component) if pred in lane][0]
+    lanes = core.count(Node.Type.IMM)
 
     m.EmbeddedCode(' ')
     m.EmbeddedCode('//Kmeans wires')
 
+    # the lanes of a type have the same width in every mode
+    bank_width = {}
+    for component in components:
+        bank_width[core.node_type(component)] = bus_bits[component]
+
+    banks = {}
+    for node_type in banked_types:
+        width = bank_width[node_type]
+        banks[node_type] = m.Wire('%s_bank_out' % node_type.name.lower(), lanes * width)
+    if banked_types:
+        sub_bank_in = m.Wire('sub_bank_in', lanes * bank_width[Node.Type.SUB])
+
     wires = {}
+    buses = {}
     for component in components:
-        pre = component.split('_')
-        wires[component + '_out'] = m.Wire(component + '_out', bus_width_out[pre[0]])
+        node_type = core.node_type(component)
+        width = bus_bits[component]
+        if node_type in banked_types:
+            base = lane[component] * width
+            wires[component] = banks[node_type][base:base + width]
+            buses[component] = (banks[node_type], base)
+        else:
+            wires[component] = m.Wire(names[component] + '_out', width)
+            buses[component] = (wires[component], 0)
+
+    def bus_in(pred, bits, tagged=True):
+        # value of pred on a bus of bits data bits, under its centroid ID when
+        # tagged. The distances get the ID of their centroid at the compare
+        # tree inputs; the uniform buses with IDs are connected as they are
+        if data_bits[pred] == bits and tags[pred] == tagged:
+            return wires[pred]
+        if widths != 'exact' and ids != 'leaves' and tiles == 1:
+            return wires[pred]
+        bus, base = buses[pred]
+        centroid_id = None
+        if tagged and tags[pred]:
+            centroid_id = bus[base + data_bits[pred]:base + bus_bits[pred]]
+        elif tagged:
+            centroid_id = Int(first_centroid[pred], centroid_id_width, 10)
+        return fit(bus, base, data_bits[pred], bits, centroid_id)
+
+    tile_stage = None
+    if tiles > 1:
+        tile_stage = make_tile_stages(m, core, components, tiles)
+    if fold:
+        make_centroid_banks(m, core, components, wires, data_bits, data_width, dimensions, k, units, rounds,
+                            centroid_id_width, imm_id_width, components_array, centroid_id_base, imm_id_base)
 
     m.EmbeddedCode(' ')
     m.EmbeddedCode('//Input assigns to Kmeans input wires')
 
-    for key in wires:
-        if 'IN' in key:
-            str_key = str(key)
-            pre = str_key.split('_')
-            input_number = int(pre[1])
-            wire = wires[key]
+    for component in components:
+        if core.node_type(component) == Node.Type.IN:
+            input_number = core.ids[component]
+            wire = wires[component]
             wire.assign(kmeans_core_data_in[input_number * data_width:(input_number * data_width) + data_width])
 
     m.EmbeddedCode(' ')
     m.EmbeddedCode('//Output assign')
-    for component in components:
-        if 'CMP' in component:
-            last = False
-            for dict_key, values in core.items():
-                if component == str(dict_key) and len(values) == 0:
-                    kmeans_core_data_out.assign(Cat(Int(0, kmeans_core_data_out.width - centroid_id_width, 10),
-                                                    wires[component + '_out'][
-                                                    bus_width_out['CMP'] - centroid_id_width:bus_width_out['CMP']]))
+    label = None
+    if fold:
+        distance, label = make_running_minimum(m, core, wires, data_bits, tags, first_centroid, units, rounds,
+                                               centroid_id_width)
+    else:
+        for component in core:
+            if core.node_type(component) == Node.Type.CMP and len(core.successors(component)) == 0:
+                width = data_bits[component] + centroid_id_width
+                distance = wires[component][0:data_bits[component]]
+                label = wires[component][width - centroid_id_width:width]
+    if multipass:
+        # the distance above the ID of the centroid in the kmeans, offset
+        # by the first centroid of the pass
+        distance_width = data_bits[core_root(core)]
+        if distance_width > state_width - state_id_width:
+            raise Exception('The %d-bit distances of kmeans_core_%d do not fit in the multipass state' % (
+                distance_width, k))
+        padding = [Int(0, state_width - state_id_width - distance_width, 10)] if \
+            distance_width < state_width - state_id_width else []
+        # offset by the first centroid of the pass
+        if centroid_id_base:
+            label = label - Int(centroid_id_base, centroid_id_width, 10)
+        kmeans_core_data_out.assign(Cat(*padding, distance, kmeans_core_id_base + label))
+    elif label is not None:
+        kmeans_core_data_out.assign(Cat(Int(0, kmeans_core_data_out.width - centroid_id_width, 10), label))
 
     # geração dos módulos
     # add = make_component_add(bus_width_out['ADD'], centroid_id_width)
@@ -88,66 +186,50 @@ def make_kmeans_core(data_width, k, sumK, dimensions, components_array):
 
     add = components_array['ADD']
     cmp = components_array['CMP']
+    mac_component = components_array.get('MAC')
     imm = components_array['IMM']
-    quad = components_array['QUAD']
+    quad = components_array['QUAD_EXACT' if widths == 'exact' and ids != 'leaves' else 'QUAD']
     sub = components_array['SUB']
     reg = components_array['REG']
 
+    if banked_types:
+        make_lane_banks(m, core, components, lane, lanes, wires, banks, sub_bank_in, bank_width, bus_in, dimensions, centroid_id_width, imm_id_width, components_array, widths, ids, tiles, full_dimensions, tile_stage, fold > 0, header_slots, centroid_id_base, imm_id_base)
+
     # instancialização dos módulos
     for component in components:
-        pre = component.split('_')
-        number = int(pre[1])
-        if 'ADD' in component:
+        node_type = core.node_type(component)
+        number = core.ids[component]
+        if node_type in banked_types:
+            continue
+        width = bus_bits[component]
+        id_params = [('CENTROID_ID_WIDTH', centroid_id_width)] if tags[component] else []
+        component_bus = [bus_in(pred, data_bits[component], tags[component]) for pred in core.predecessors(component)]
+        if node_type == Node.Type.ADD:
             m.EmbeddedCode(' ')
             m.EmbeddedCode('//ADD_%d Instantiation' % number)
-
-            component_bus = []
-            idx = 0
-            for dict_key, values in core.items():
-                for value in values:
-                    if 'ADD_' + str(number) == str(value):
-                        component_bus.append(wires[str(dict_key) + '_out'])
-                        idx = idx + 1
-            params = [('DATA_WIDTH', bus_width_out['ADD']), ('CENTROID_ID_WIDTH', centroid_id_width)]
-            con = [('clk', clk), ('rst', rst),
-                   ('data_in_0', component_bus[0]),
-                   ('data_in_1', component_bus[1]),
-                   ('data_out', wires[component + '_out'])]
-            m.Instance(add, 'm_add%d' % number, params, con)
-        elif 'CMP' in component:
+            params = [('DATA_WIDTH', width)] + id_params
+            con = [('clk', clk), ('rst', rst)]
+            con.extend(('data_in_%d' % i, bus) for i, bus in enumerate(component_bus))
+            con.append(('data_out', wires[component]))
+            add_component = add if len(component_bus) == 2 else components_array['ADD%d' % len(component_bus)]
+            m.Instance(add_component, 'm_add%d' % number, params, con)
+        elif node_type == Node.Type.CMP:
             m.EmbeddedCode(' ')
             m.EmbeddedCode('//CMP_%d Instantiation' % number)
 
-            component_bus = []
-            idx = 0
-            for dict_key, values in core.items():
-                for value in values:
-                    if 'CMP_' + str(number) == str(value):
-                        component_bus.append(wires[str(dict_key) + '_out'])
-                        idx = idx + 1
-
-            there_is_reg = False
-            for bus in component_bus:
-                if "REG" in str(bus):
-                    there_is_reg = True
-                    break
-
-            if there_is_reg:
-                if ("REG" in str(component_bus[1])):
-                    component_bus[0], component_bus[1] = component_bus[1], component_bus[0]
-            else:
-                componet_id_0 = str(component_bus[0]).split('_')[1]
-                componet_id_1 = str(component_bus[1]).split('_')[1]
-                if(int(componet_id_0) < int(componet_id_1)):
-                    component_bus[0], component_bus[1] = component_bus[1], component_bus[0]
-
-            params = [('DATA_WIDTH', bus_width_out['CMP']), ('CENTROID_ID_WIDTH', centroid_id_width)]
-            con = [('clk', clk), ('rst', rst),
-                   ('data_in_0', component_bus[0]),
-                   ('data_in_1', component_bus[1]),
-                   ('data_out', wires[component + '_out'])]
-            m.Instance(cmp, 'm_cmp%d' % number, params, con)
-        elif 'IMM' in component:
+            inputs = sorted(core.predecessors(component), key=first_centroid.__getitem__, reverse=True)
+            component_bus = [bus_in(node, data_bits[component]) for node in inputs]
+
+            params = [('DATA_WIDTH', width), ('CENTROID_ID_WIDTH', centroid_id_width)]
+            con = [('clk', clk), ('rst', rst)]
+            con.extend(('data_in_%d' % i, bus) for i, bus in enumerate(component_bus))
+            con.append(('data_out', wires[component]))
+            cmp_component = cmp if len(component_bus) == 2 else components_array['CMP%d' % len(component_bus)]
+            m.Instance(cmp_component, 'm_cmp%d' % number, params, con)
+        elif node_type == Node.Type.IMM:
+            if fold:
+                # read from the centroid banks
+                continue
             m.EmbeddedCode(' ')
             m.EmbeddedCode('//IMM_%d Instantiation' % number)
 
@@ -155,72 +237,493 @@ def make_kmeans_core(data_width, k, sumK, dimensions, components_array):
                 #cent_id = Int(0, centroid_id_width, 10)
             #else:
                 #cent_id = Int(int(log2(number)), centroid_id_width, 10)
-            cent_id = Int(int(number/dimensions), centroid_id_width, 10)
-
-            cent_im_id = Int(number + 1, imm_id_width, 10)
-
-            params = [('DATA_WIDTH', bus_width_out['IMM']),
+            cent_id = Int(centroid_id_base + int(number/dimensions), centroid_id_width, 10)
+
+            cent_im_id = Int(imm_id_base + number + 1, imm_id_width, 10)
+
+            if tiles > 1:
+                params = [('DATA_WIDTH', width),
+                          ('CENTROID_ID_WIDTH', centroid_id_width),
+                          ('CENTROID_ID', cent_id),
+                          ('IMM_ID_WIDTH', imm_id_width)]
+                params.extend(('IMM_ID_%d' % t, Int(imm_id, imm_id_width, 10)) for t, imm_id in
+                              enumerate(tile_imm_ids(number, dimensions, full_dimensions, tiles, imm_id_base)))
+                params.append(('TILE_WIDTH', bits(tiles)))
+                con = [('clk', clk), ('rst', rst),
+                       ('tile', tile_stage(component)[0:bits(tiles)]),
+                       ('centroid_configuration_in', kmeans_core_centroids_configurations_in),
+                       ('data_out', wires[component])]
+                m.Instance(components_array['IMM_TILED'], 'm_imm%d' % number, params, con)
+                continue
+
+            configuration_in = kmeans_core_centroids_configurations_in
+            if header_slots:
+                # the IMM takes the lines of the dense header as its entries
+                slot = imm_id_base + number
+                cent_im_id = Int(slot // header_slots + 1, imm_id_width, 10)
+                configuration_in = dense_entry(kmeans_core_centroids_configurations_in, slot % header_slots)
+
+            params = [('DATA_WIDTH', width),
                       ('CENTROID_ID_WIDTH', centroid_id_width),
                       ('CENTROID_ID', cent_id),
                       ('IMM_ID_WIDTH', imm_id_width),
                       ('IMM_ID', cent_im_id)]
             con = [('clk', clk), ('rst', rst),
-                   ('centroid_configuration_in', kmeans_core_centroids_configurations_in),
-                   ('data_out', wires[component + '_out'])]
+                   ('centroid_configuration_in', configuration_in),
+                   ('data_out', wires[component])]
+            if shadow:
+                con.insert(3, ('swap', kmeans_core_centroids_swap))
             m.Instance(imm, 'm_imm%d' % number, params, con)
-        elif 'QUAD' in component:
+        elif node_type == Node.Type.QUAD:
             m.EmbeddedCode(' ')
             m.EmbeddedCode('//QUAD_%d Instantiation' % number)
 
-            component_bus = []
-            idx = 0
-            for dict_key, values in core.items():
-                for value in values:
-                    if 'QUAD_' + str(number) == str(value):
-                        component_bus.append(wires[str(dict_key) + '_out'])
-                        idx = idx + 1
-
-            params = [('DATA_WIDTH_IN', data_width),
-                      ('DATA_WIDTH_OUT', bus_width_out['QUAD']),
-                      ('CENTROID_ID_WIDTH', centroid_id_width)]
+            pred = core.predecessors(component)[0]
+            params = [('DATA_WIDTH_IN', data_bits[pred]),
+                      ('DATA_WIDTH_OUT', width)] + id_params
 
             con = [('clk', clk), ('rst', rst),
-                   ('data_in_0', component_bus[0]),
-                   ('data_out', wires[component + '_out'])]
+                   ('data_in_0', wires[pred]),
+                   ('data_out', wires[component])]
             m.Instance(quad, 'm_quad%d' % number, params, con)
-        elif 'SUB' in component:
+        elif node_type == Node.Type.MAC:
             m.EmbeddedCode(' ')
-            m.EmbeddedCode('//SUB_%d Instantiation' % number)
+            m.EmbeddedCode('//MAC_%d Instantiation' % number)
+
+            # the partial sum comes from the MAC of the previous coordinate
+            inputs = core.predecessors(component)
+            partial = [node for node in inputs if core.node_type(node) == Node.Type.MAC]
+            data = [node for node in inputs if core.node_type(node) != Node.Type.MAC]
 
-            component_bus = []
-            idx = 0
-            for dict_key, values in core.items():
-                for value in values:
-                    if 'SUB_' + str(number) == str(value):
-                        component_bus.append(wires[str(dict_key) + '_out'])
-                        idx = idx + 1
+            params = [('DATA_WIDTH_IN', data_bits[data[0]]),
+                      ('DATA_WIDTH_OUT', width)] + id_params
+            con = [('clk', clk), ('rst', rst),
+                   ('data_in_0', wires[data[0]]),
+                   ('cascade_in', bus_in(partial[0], data_bits[component], tags[component]) if partial else
+                    Int(0, width, 10)),
+                   ('data_out', wires[component])]
+            m.Instance(mac_component, 'm_mac%d' % number, params, con)
+        elif node_type == Node.Type.SUB:
+            m.EmbeddedCode(' ')
+            m.EmbeddedCode('//SUB_%d Instantiation' % number)
 
-            params = [('DATA_WIDTH', bus_width_out['SUB']), ('CENTROID_ID_WIDTH', centroid_id_width)]
+            params = [('DATA_WIDTH', width)] + id_params
             con = [('clk', clk), ('rst', rst),
                    ('data_in_0', component_bus[0]),
                    ('data_in_1', component_bus[1]),
-                   ('data_out', wires[component + '_out'])]
+                   ('data_out', wires[component])]
             m.Instance(sub, 'm_sub%d' % number, params, con)
-        elif 'REG' in component:
+        elif node_type == Node.Type.ACC:
+            m.EmbeddedCode(' ')
+            m.EmbeddedCode('//ACC_%d Instantiation' % number)
+            params = [('DATA_WIDTH', width)] + id_params
+            con = [('clk', clk), ('rst', rst),
+                   ('en', tile_stage(component)[bits(tiles)]),
+                   ('first', tile_stage(component)[0:bits(tiles)] == Int(0, bits(tiles), 10)),
+                   ('data_in_0', component_bus[0]),
+                   ('data_out', wires[component])]
+            m.Instance(components_array['ACC'], 'm_acc%d' % number, params, con)
+        elif node_type == Node.Type.REG:
             m.EmbeddedCode(' ')
             m.EmbeddedCode('//REG_%d Instantiation' % number)
-
-            component_bus = []
-            idx = 0
-            for dict_key, values in core.items():
-                for value in values:
-                    if 'REG_' + str(number) == str(value):
-                        component_bus.append(wires[str(dict_key) + '_out'])
-                        idx = idx + 1
-            params = [('DATA_WIDTH', bus_width_out['REG'])]
+            params = [('DATA_WIDTH', width)]
             con = [('clk', clk), ('rst', rst),
                    ('data_in_0', component_bus[0]),
-                   ('data_out', wires[component + '_out'])]
+                   ('data_out', wires[component])]
             m.Instance(reg, 'm_reg%d' % number, params, con)
 
     return m
+
+
+def centroid_order(core, dimensions, centroid_id_base=0):
+    # first centroid whose IMM values reach every node
+    first = [None] * len(core)
+    for node in core.topological_order():
+        if core.node_type(node) == Node.Type.IMM:
+            first[node] = centroid_id_base + core.ids[node] // dimensions
+        else:
+            first[node] = min((first[pred] for pred in core.predecessors(node) if first[pred] is not None),
+                              default=None)
+    return first
+
+
+def dense_entry(configurations_in, slot):
+    # entry of the coordinate in slot of a line of the dense header: its
+    # value above the line ID, that the IMMs of the line have as IMM ID
+    value = configurations_in[32 + slot * header_slot_width:32 + (slot + 1) * header_slot_width]
+    return Cat(Int(0, 32 - header_slot_width, 10), value, configurations_in[0:32])
+
+
+def tile_imm_ids(number, dimensions, full_dimensions, tiles, imm_id_base=0):
+    # configuration ID of the coordinate of IMM number in every tile; 0 past
+    # the last feature of the point, where the IMM has no register and
+    # holds the zero of the padding
+    centroid, feature = divmod(number, dimensions)
+    imm_ids = []
+    for tile in range(tiles):
+        if tile * dimensions + feature < full_dimensions:
+            imm_ids.append(imm_id_base + centroid * full_dimensions + tile * dimensions + feature + 1)
+        else:
+            imm_ids.append(0)
+    return imm_ids
+
+
+def make_tile_stages(m, core, components, tiles):
+    # the tile of the point every pipeline stage works on, under the valid
+    # bit of its beat: the input tile delayed to the SUB stage of every IMM
+    # and to the ACC stage. Returns the stage seen by a node
+    kmeans_core_tile = m.Input('kmeans_core_tile', bits(tiles))
+    kmeans_core_tile_valid = m.Input('kmeans_core_tile_valid')
+
+    arrival = core.arrival_times()
+    delay = {}
+    for component in components:
+        node_type = core.node_type(component)
+        if node_type == Node.Type.IMM:
+            delay[component] = arrival[core.successors(component)[0]] - 1
+        elif node_type == Node.Type.ACC:
+            delay[component] = arrival[component] - 1
+
+    m.EmbeddedCode(' ')
+    m.EmbeddedCode('//Tile of every pipeline stage')
+    stages = make_stages(m, 'tile', kmeans_core_tile, kmeans_core_tile_valid, max(delay.values()))
+
+    return lambda component: stages[delay[component]]
+
+
+def make_stages(m, name, value, valid, depth):
+    # value under its valid bit at every pipeline stage up to depth; stage 0
+    # is the core input
+    clk = m.get_ports()['clk']
+    rst = m.get_ports()['rst']
+
+    stages = [m.Wire('%s_stage_0' % name, value.width + 1)]
+    stages[0].assign(Cat(valid, value))
+    for stage in range(1, depth + 1):
+        stages.append(m.Reg('%s_stage_%d' % (name, stage), stages[0].width))
+    m.Always(Posedge(clk))(
+        If(rst)(
+            [stage(Int(0, stage.width, 10)) for stage in stages[1:]],
+        ).Else(
+            [stage(previous) for previous, stage in zip(stages, stages[1:])],
+        )
+    )
+
+    return stages
+
+
+def make_centroid_banks(m, core, components, wires, data_bits, data_width, dimensions, k, units, rounds,
+                        centroid_id_width, imm_id_width, components_array, centroid_id_base=0, imm_id_base=0):
+    # folded core: a bank per distance unit holds the centroids
+    # round * units + unit, read a cycle before the SUB stage of the round.
+    # The units past the last centroid in the last round hold a copy of the
+    # first centroid of that round, and never win the compare tree over it.
+    # With shadow centroids every bank holds two sets of rounds: the
+    # configurations load the set that is not read, and swap exchanges them
+    # and restarts the loader
+    clk = m.get_ports()['clk']
+    rst = m.get_ports()['rst']
+    kmeans_core_centroids_configurations_in = m.get_ports()['kmeans_core_centroids_configurations_in']
+    kmeans_core_round = m.Input('kmeans_core_round', bits(rounds))
+    kmeans_core_round_valid = m.Input('kmeans_core_round_valid')
+    swap = m.get_ports().get('kmeans_core_centroids_swap')
+    configuration_id_width = 32
+
+    arrival = core.arrival_times()
+    imms = [[None] * dimensions for unit in range(units)]
+    for component in components:
+        if core.node_type(component) == Node.Type.IMM:
+            unit, feature = divmod(core.ids[component], dimensions)
+            imms[unit][feature] = component
+    # stage in which the SUB of every IMM takes it, and in which every bank
+    # is read
+    needed = [[arrival[core.successors(imm)[0]] - 1 for imm in unit_imms] for unit_imms in imms]
+    read = [min(unit_needed) - 1 for unit_needed in needed]
+
+    m.EmbeddedCode(' ')
+    m.EmbeddedCode('//Round of every pipeline stage')
+    stages = make_stages(m, 'round', kmeans_core_round, kmeans_core_round_valid,
+                         max(max(read), arrival[core_root(core)]))
+
+    # the configuration entries arrive in IMM_ID order: the coordinates of
+    # a centroid, one centroid per unit and a round of units after another
+    m.EmbeddedCode(' ')
+    m.EmbeddedCode('//Centroid loader')
+    load_imm_id = m.Reg('load_imm_id', imm_id_width + 1)
+    load_feature = m.Reg('load_feature', bits(dimensions))
+    load_unit = m.Reg('load_unit', bits(units))
+    load_round = m.Reg('load_round', bits(rounds))
+    load = m.Wire('load')
+    load_value = m.Wire('load_value', data_width)
+    load_centroid = m.Wire('load_centroid', data_width * dimensions)
+    load_write = m.Wire('load_write')
+
+    load.assign(AndList(kmeans_core_centroids_configurations_in[0:load_imm_id.width] == load_imm_id,
+                        load_imm_id <= Int(imm_id_base + k * dimensions, load_imm_id.width, 10)))
+    load_value.assign(kmeans_core_centroids_configurations_in[configuration_id_width:
+                                                              configuration_id_width + data_width])
+    load_write.assign(AndList(load, load_feature == Int(dimensions - 1, load_feature.width, 10)))
+    last_feature = Int(dimensions - 1, load_feature.width, 10)
+    last_unit = Int(units - 1, load_unit.width, 10)
+    if dimensions > 1:
+        # the coordinates before the last one of the centroid, the first at
+        # the bottom
+        load_features = m.Reg('load_features', data_width * (dimensions - 1))
+        load_centroid.assign(Cat(load_value, load_features))
+        shift = [load_features(Cat(load_value, load_features[data_width:load_features.width]) if dimensions > 2 else
+                               load_value)]
+    else:
+        load_centroid.assign(load_value)
+        shift = []
+
+    load_rst = rst
+    if swap is not None:
+        bank_active = m.Reg('bank_active')
+        load_rst = OrList(rst, swap)
+        m.Always(Posedge(clk))(
+            If(rst)(
+                bank_active(Int(0, 1, 2)),
+            ).Elif(swap)(
+                bank_active(Not(bank_active)),
+            )
+        )
+
+    m.Always(Posedge(clk))(
+        If(load_rst)(
+            load_imm_id(Int(imm_id_base + 1, load_imm_id.width, 10)),
+            load_feature(Int(0, load_feature.width, 10)),
+            load_unit(Int(0, load_unit.width, 10)),
+            load_round(Int(0, load_round.width, 10)),
+        ).Elif(load)(
+            load_imm_id(load_imm_id + Int(1, load_imm_id.width, 10)),
+            shift,
+            If(load_feature == last_feature)(
+                load_feature(Int(0, load_feature.width, 10)),
+                If(load_unit == last_unit)(
+                    load_unit(Int(0, load_unit.width, 10)),
+                    load_round(load_round + Int(1, load_round.width, 10)),
+                ).Else(
+                    load_unit(load_unit + Int(1, load_unit.width, 10)),
+                )
+            ).Else(
+                load_feature(load_feature + Int(1, load_feature.width, 10)),
+            )
+        )
+    )
+
+    # a unit past the last centroid is written with the copy it holds in
+    # the last round
+    centroids = fold_bank_centroids(k, units)
+    bank = components_array['CENTROID_BANK']
+    for unit in range(units):
+        m.EmbeddedCode(' ')
+        m.EmbeddedCode('//Centroid bank %d' % unit)
+        centroid = m.Wire('centroid_%d' % unit, data_width * dimensions)
+        write = load_unit == Int(unit, load_unit.width, 10)
+        copied = centroids[unit][-1] - (rounds - 1) * units
+        if copied != unit:
+            write = OrList(write, AndList(load_unit == Int(copied, load_unit.width, 10),
+                                          load_round == Int(rounds - 1, load_round.width, 10)))
+        params = [('DATA_WIDTH', data_width * dimensions), ('ADDR_WIDTH', bits(rounds)), ('DEPTH', rounds)]
+        wr_addr = load_round
+        rd_addr = stages[read[unit]][0:bits(rounds)]
+        if swap is not None:
+            params = [('DATA_WIDTH', data_width * dimensions), ('ADDR_WIDTH', bits(rounds) + 1),
+                      ('DEPTH', (1 << bits(rounds)) + rounds)]
+            wr_addr = Cat(Not(bank_active), load_round)
+            rd_addr = Cat(bank_active, rd_addr)
+        con = [('clk', clk),
+               ('wr_en', AndList(load_write, write)),
+               ('wr_addr', wr_addr),
+               ('wr_data', load_centroid),
+               ('rd_addr', rd_addr),
+               ('rd_data', centroid)]
+        m.Instance(bank, 'm_centroid_bank%d' % unit, params, con)
+
+        # the coordinates taken later by the SUBs of a MAC chain wait in
+        # registers
+        for feature, imm in enumerate(imms[unit]):
+            bus, base = centroid, feature * data_width
+            for delay in range(needed[unit][feature] - read[unit] - 1):
+                reg = m.Reg('centroid_%d_%d_d%d' % (unit, feature, delay), data_width)
+                m.Always(Posedge(clk))(
+                    reg(bus[base:base + data_width])
+                )
+                bus, base = reg, 0
+            wires[imm].assign(fit(bus, base, data_width, data_bits[imm],
+                                  Int(centroid_id_base + unit, centroid_id_width, 10)))
+
+
+def core_root(core):
+    # output of the compare tree, or the distance of a single unit
+    return [node for node in core if len(core.successors(node)) == 0 and len(core.predecessors(node)) > 0][0]
+
+
+def make_running_minimum(m, core, wires, data_bits, tags, first_centroid, units, rounds,
+                         centroid_id_width):
+    # folded core: minimum of the compare tree outputs of the rounds of a
+    # point. Only a smaller distance replaces the minimum, so equal
+    # distances resolve to the first centroid as in the compare tree.
+    # Returns the distance and label registers
+    clk = m.get_ports()['clk']
+    rst = m.get_ports()['rst']
+    root = core_root(core)
+    stage = m.get_vars()['round_stage_%d' % core.arrival_times()[root]]
+    round_width = bits(rounds)
+
+    distance = m.Wire('round_distance', data_bits[root])
+    unit = m.Wire('round_unit', centroid_id_width)
+    label = m.Wire('round_label', centroid_id_width)
+    best_distance = m.Reg('best_distance', data_bits[root])
+    best_label = m.Reg('best_label', centroid_id_width)
+
+    distance.assign(wires[root][0:data_bits[root]])
+    if tags[root]:
+        unit.assign(wires[root][data_bits[root]:data_bits[root] + centroid_id_width])
+    else:
+        unit.assign(Int(first_centroid[root], centroid_id_width, 10))
+    label.assign(stage[0:round_width] * Int(units, centroid_id_width, 10) + unit)
+
+    m.Always(Posedge(clk))(
+        If(rst)(
+            best_distance(Int(0, best_distance.width, 10)),
+            best_label(Int(0, best_label.width, 10)),
+        ).Elif(AndList(stage[round_width], OrList(stage[0:round_width] == Int(0, round_width, 10),
+                                                  distance < best_distance)))(
+            best_distance(distance),
+            best_label(label),
+        )
+    )
+
+    return best_distance, best_label
+
+
+def fit(bus, base, bits, target, centroid_id=None):
+    # the bits data bits at bus[base:] moved to target data bits, under
+    # centroid_id when given. Only the non-negative values are widened; the
+    # narrowed values fit in target bits by the range analysis
+    data = bus[base:base + min(bits, target)]
+    if target > bits:
+        data = Cat(Int(0, target - bits, 10), data)
+    if centroid_id is None:
+        return data
+    return Cat(centroid_id, data)
+
+
+def make_lane_banks(m, core, components, lane, lanes, wires, banks, sub_bank_in, bank_width, bus_in, dimensions,
+                    centroid_id_width, imm_id_width, components_array, widths='uniform', ids='datapath', tiles=1,
+                    full_dimensions=None, tile_stage=None, folded=False, header_slots=0, centroid_id_base=0,
+                    imm_id_base=0):
+    clk = m.get_ports()['clk']
+    rst = m.get_ports()['rst']
+    kmeans_core_centroids_configurations_in = m.get_ports()['kmeans_core_centroids_configurations_in']
+
+    # the IMM lanes always carry their centroid ID, the SUB and QUAD lanes
+    # only when the IDs travel through the datapath
+    tagged = ids != 'leaves'
+    id_bits = centroid_id_width if tagged else 0
+    imm_width = bank_width[Node.Type.IMM]
+    sub_width = bank_width[Node.Type.SUB]
+    quad_width = bank_width.get(Node.Type.QUAD)
+    id_params = [('CENTROID_ID_WIDTH', centroid_id_width)] if tagged else []
+    imm_bank_out = banks[Node.Type.IMM]
+    sub_bank_out = banks[Node.Type.SUB]
+    quad_bank_out = banks.get(Node.Type.QUAD)
+
+    m.EmbeddedCode(' ')
+    m.EmbeddedCode('//SUB lane inputs')
+
+    # every SUB subtracts its lane IMM from a balanced input, or the other way
+    # around; the order is the same for all lanes of a core
+    imm_first = None
+    for component in components:
+        if core.node_type(component) == Node.Type.SUB:
+            inputs = core.predecessors(component)
+            first = core.node_type(inputs[0]) == Node.Type.IMM
+            if imm_first is None:
+                imm_first = first
+            elif imm_first != first:
+                raise Exception('Kmeans core SUB lanes with different input orders cannot be emitted as a loop')
+            other = inputs[1] if first else inputs[0]
+            sub_bank_in[lane[component] * sub_width:(lane[component] + 1) * sub_width].assign(
+                bus_in(other, sub_width - id_bits, tagged))
+
+    if tiles > 1:
+        # the tile of the SUB stage of every lane, that differs between the
+        # coordinates of a MAC chain
+        m.EmbeddedCode(' ')
+        m.EmbeddedCode('//IMM lane tiles')
+        tile_width = bits(tiles)
+        imm_tile_bank_in = m.Wire('imm_tile_bank_in', lanes * tile_width)
+        for component in components:
+            if core.node_type(component) == Node.Type.IMM:
+                imm_tile_bank_in[lane[component] * tile_width:(lane[component] + 1) * tile_width].assign(
+                    tile_stage(component)[0:tile_width])
+
+    i = m.Genvar('i')
+
+    # the folded IMM lanes are read from the centroid banks
+    if not folded:
+        m.EmbeddedCode(' ')
+        m.EmbeddedCode('//IMM lanes')
+        gen = m.GenerateFor(i(0), i < lanes, i.inc(), 'imm_bank')
+        params = [('DATA_WIDTH', imm_width),
+                  ('CENTROID_ID_WIDTH', centroid_id_width),
+                  ('CENTROID_ID', centroid_id_base + i / dimensions if centroid_id_base else i / dimensions),
+                  ('IMM_ID_WIDTH', imm_id_width)]
+        con = [('clk', clk), ('rst', rst),
+               ('centroid_configuration_in', kmeans_core_centroids_configurations_in),
+               ('data_out', imm_bank_out[i * imm_width:(i + 1) * imm_width])]
+        if tiles > 1:
+            # IMM_ID_<t> of tile_imm_ids for lane i
+            for t in range(tiles):
+                feature = t * dimensions + i % dimensions
+                imm_id = (i / dimensions) * full_dimensions + feature + 1
+                params.append(('IMM_ID_%d' % t, Mux(feature < full_dimensions,
+                                                     imm_id_base + imm_id if imm_id_base else imm_id, 0)))
+            params.append(('TILE_WIDTH', tile_width))
+            con.insert(2, ('tile', imm_tile_bank_in[i * tile_width:(i + 1) * tile_width]))
+            gen.Instance(components_array['IMM_TILED'], 'm_imm', params, con)
+        elif header_slots:
+            slot = imm_id_base + i if imm_id_base else i
+            params.append(('IMM_ID', slot / header_slots + 1))
+            con[2] = ('centroid_configuration_in', dense_entry(kmeans_core_centroids_configurations_in,
+                                                               slot % header_slots))
+            gen.Instance(components_array['IMM'], 'm_imm', params, con)
+        else:
+            params.append(('IMM_ID', imm_id_base + i + 1 if imm_id_base else i + 1))
+            if 'kmeans_core_centroids_swap' in m.get_ports():
+                con.insert(3, ('swap', m.get_ports()['kmeans_core_centroids_swap']))
+            gen.Instance(components_array['IMM'], 'm_imm', params, con)
+
+    m.EmbeddedCode(' ')
+    m.EmbeddedCode('//SUB lanes')
+    gen = m.GenerateFor(i(0), i < lanes, i.inc(), 'sub_bank')
+    if imm_width == sub_width:
+        imm_in = imm_bank_out[i * imm_width:(i + 1) * imm_width]
+    else:
+        imm_bits = imm_width - centroid_id_width
+        centroid_id = imm_bank_out[i * imm_width + imm_bits:(i + 1) * imm_width] if tagged else None
+        imm_in = fit(imm_bank_out, i * imm_width, imm_bits, sub_width - id_bits, centroid_id)
+    sub_in = [imm_in, sub_bank_in[i * sub_width:(i + 1) * sub_width]]
+    if not imm_first:
+        sub_in.reverse()
+    params = [('DATA_WIDTH', sub_width)] + id_params
+    con = [('clk', clk), ('rst', rst),
+           ('data_in_0', sub_in[0]),
+           ('data_in_1', sub_in[1]),
+           ('data_out', sub_bank_out[i * sub_width:(i + 1) * sub_width])]
+    gen.Instance(components_array['SUB'], 'm_sub', params, con)
+
+    if quad_bank_out is None:
+        return
+
+    m.EmbeddedCode(' ')
+    m.EmbeddedCode('//QUAD lanes')
+    gen = m.GenerateFor(i(0), i < lanes, i.inc(), 'quad_bank')
+    params = [('DATA_WIDTH_IN', sub_width - id_bits),
+              ('DATA_WIDTH_OUT', quad_width)] + id_params
+    con = [('clk', clk), ('rst', rst),
+           ('data_in_0', sub_bank_out[i * sub_width:(i + 1) * sub_width]),
+           ('data_out', quad_bank_out[i * quad_width:(i + 1) * quad_width])]
+    gen.Instance(components_array['QUAD_EXACT' if widths == 'exact' and tagged else 'QUAD'], 'm_quad', params, con)
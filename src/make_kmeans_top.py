@@ -1,13 +1,41 @@
 from veriloggen import *
 
 from components import Components
+from kmeans_generator import KmeansConfig
 from make_kmeans import make_kmeans
+from profiler import profiled
+from utils import line_cores, needs_gearbox, point_tiles, tile_dimensions, state_width, state_id_width, \
+    accumulator_word_width, bits, configuration_width
 
 
-def make_kmeans_top(external_data_width, data_width, k_array, dimensions):
+@profiled('make_kmeans_top')
+def make_kmeans_top(external_data_width, data_width, k_array, dimensions, emission='flat', arity=2, mac=False,
+                    widths='uniform', ids='datapath', fold=0, multipass=False, accumulate=False,
+                    persistent=0, shadow=False, header='sparse'):
     id_width = 32
     conf_width = 32
-    output_controller_num_inputs = (external_data_width // data_width) // dimensions
+    output_controller_num_inputs = line_cores(external_data_width, data_width, dimensions)
+    # points wider than two lines are fed to a single core in tiles
+    tiles = point_tiles(external_data_width, data_width, dimensions)
+    beat_width = output_controller_num_inputs * data_width * tile_dimensions(dimensions, tiles)
+    last_width = (dimensions - (tiles - 1) * tile_dimensions(dimensions, tiles)) * data_width
+    KmeansConfig(dimensions, k_array, 1, external_data_width, data_width, emission, arity, mac, widths, ids, fold,
+                 multipass, accumulate, persistent, shadow, header).validate()
+    # bits written per core and point: the label, or the multipass state
+    output_width = 8
+    if multipass:
+        output_width = state_width
+    if persistent:
+        # persistent: the lines of points of the first pass are kept in a
+        # store of persistent lines and replayed for the next passes
+        output_width = accumulator_word_width
+        output_words = 1
+    elif accumulate:
+        # a kmeans writes an accumulator per valid
+        output_width = accumulator_word_width
+        output_words = 1
+    else:
+        output_words = output_controller_num_inputs
 
     m = Module('kmeans_top')
 
@@ -39,27 +67,53 @@ def make_kmeans_top(external_data_width, data_width, k_array, dimensions):
     m.EmbeddedCode('//config_centroids wires')
     config_centroids_request_read = m.Wire('config_centroids_request_read')
     config_centroids_start_circuit = m.Wire('config_centroids_start_circuit')
-    config_centroids_configurations_out = m.Wire('config_centroids_configurations_out', 64)
+    config_centroids_configurations_out = m.Wire('config_centroids_configurations_out',
+                                                 configuration_width(external_data_width, header))
+    if multipass:
+        config_centroids_id_base = m.Wire('config_centroids_id_base', state_id_width)
+    if accumulate or persistent:
+        config_centroids_num_points = m.Wire('config_centroids_num_points', 32)
+    if persistent:
+        config_centroids_max_iterations = m.Wire('config_centroids_max_iterations', 32)
 
     m.EmbeddedCode(' ')
     m.EmbeddedCode('//input controller wires')
     input_controller_request_read = m.Wire('input_controller_request_read')
     input_controller_data_out = m.Wire('input_controller_data_out', external_data_width)
     input_controller_output_valid = m.Wire('input_controller_output_valid', 2)
+    if fold:
+        # the folded kmeans take a beat every few cycles
+        kmeans_ready = m.Wire('kmeans_ready', nKmeans)
 
     m.EmbeddedCode(' ')
     m.EmbeddedCode('//output controller wires')
     output_controller_input_valid = m.Wire('output_controller_input_valid', 2, nKmeans)
-    output_controller_data_in = m.Wire('output_controller_data_in', output_controller_num_inputs * 8, nKmeans)
+    output_controller_data_in = m.Wire('output_controller_data_in', output_words * output_width, nKmeans)
+
+    if shadow:
+        # the header loads the shadow centroids, swapped in as the circuit
+        # starts
+        centroids_swap = m.Wire('centroids_swap')
+        start_circuit_r = m.Reg('start_circuit_r')
 
     m.EmbeddedCode(' ')
     m.EmbeddedCode('//assigns')
     request_read.assign(config_centroids_request_read | input_controller_request_read)
     start_circuit.assign(config_centroids_start_circuit)
+    if shadow:
+        centroids_swap.assign(start_circuit & Not(start_circuit_r))
+        m.Always(Posedge(clk))(
+            If(rst)(
+                start_circuit_r(Int(0, 1, 2)),
+            ).Else(
+                start_circuit_r(start_circuit),
+            )
+        )
 
     m.EmbeddedCode(' ')
     m.EmbeddedCode('//Config Centroid Instantiation')
-    config_centroids = Components().create_config_centroids(external_data_width)
+    config_centroids = Components().create_config_centroids(external_data_width, multipass, accumulate or persistent,
+                                                            persistent > 0, header == 'dense')
     params = []
     con = [('clk', clk), ('rst', rst), ('start', start),
            #('config_centroids_available_read', kmeans_top_available_read[0]),
@@ -68,12 +122,18 @@ def make_kmeans_top(external_data_width, data_width, k_array, dimensions):
            ('config_centroids_read_data_valid', kmeans_top_read_data_valid[0]),
            ('config_centroids_start_circuit', config_centroids_start_circuit),
            ('config_centroids_configurations_out', config_centroids_configurations_out)]
+    if multipass:
+        con.append(('config_centroids_id_base', config_centroids_id_base))
+    if accumulate or persistent:
+        con.append(('config_centroids_num_points', config_centroids_num_points))
+    if persistent:
+        con.append(('config_centroids_max_iterations', config_centroids_max_iterations))
     m.Instance(config_centroids, 'config_centroids', params, con)
 
     m.EmbeddedCode(' ')
     m.EmbeddedCode('//Input Controller Instantiation')
 
-    input_controller = Components().create_input_controller(external_data_width)
+    input_controller = Components().create_input_controller(external_data_width, fold > 0)
     params = []
     con = [('clk', clk), ('rst', rst), ('start', start_circuit), ('done_rd_data', kmeans_top_done_rd_data[0]),
            #('input_controller_available_read', kmeans_top_available_read[0]),
@@ -82,39 +142,118 @@ def make_kmeans_top(external_data_width, data_width, k_array, dimensions):
            ('input_controller_request_read', input_controller_request_read),
            ('input_controller_data_out', input_controller_data_out),
            ('input_controller_output_valid', input_controller_output_valid)]
+    if fold:
+        con.append(('input_controller_ready', Uand(kmeans_ready)))
     m.Instance(input_controller, 'input_controller', params, con)
 
+    kmeans_data_in = input_controller_data_out
+    kmeans_input_valid = input_controller_output_valid
+    gearbox_rst = rst
+    if persistent:
+        kmeans_data_in, kmeans_input_valid, store_overflow, kmeans_restart, kmeans_replay = make_point_store(
+            m, persistent, input_controller_data_out, input_controller_output_valid,
+            Uand(kmeans_ready) if fold else Int(1, 1, 2))
+        gearbox_rst = m.Wire('gearbox_rst')
+        gearbox_rst.assign(rst | kmeans_restart)
+    line_data = kmeans_data_in
+    line_valid = kmeans_input_valid
+    if needs_gearbox(external_data_width, data_width, dimensions):
+        m.EmbeddedCode(' ')
+        m.EmbeddedCode('//Input Gearbox Instantiation')
+        kmeans_data_in = m.Wire('input_gearbox_data_out', beat_width)
+        kmeans_input_valid = m.Wire('input_gearbox_output_valid', 2)
+
+        if last_width == beat_width:
+            input_gearbox = Components().create_input_gearbox(external_data_width, beat_width)
+        else:
+            input_gearbox = Components().create_input_gearbox(external_data_width, beat_width, tiles, last_width)
+        params = []
+        con = [('clk', clk), ('rst', gearbox_rst),
+               ('input_gearbox_data_in', line_data),
+               ('input_gearbox_input_valid', line_valid),
+               ('input_gearbox_data_out', kmeans_data_in),
+               ('input_gearbox_output_valid', kmeans_input_valid)]
+        m.Instance(input_gearbox, 'input_gearbox', params, con)
+
     m.EmbeddedCode(' ')
     m.EmbeddedCode('//Kmeans Cores Instantiation')
 
     components_array = {}
     components_array['ADD'] = Components().create_add()
     components_array['CMP'] = Components().create_cmp()
-    components_array['IMM'] = Components().create_imm()
+    components_array['IMM'] = Components().create_imm(shadow)
     components_array['QUAD'] = Components().create_quad()
     components_array['SUB'] = Components().create_sub()
     components_array['REG'] = Components().create_reg()
+    for num_inputs in range(3, arity + 1):
+        components_array['ADD%d' % num_inputs] = Components().create_add(num_inputs)
+        components_array['CMP%d' % num_inputs] = Components().create_cmp(num_inputs)
+    if mac:
+        components_array['MAC'] = Components().create_mac()
+    if widths == 'exact':
+        components_array['QUAD_EXACT'] = Components().create_quad_exact()
+    if tiles > 1:
+        components_array['ACC'] = Components().create_acc()
+        components_array['IMM_TILED'] = Components().create_imm_tiled(tiles)
+    if fold:
+        components_array['CENTROID_BANK'] = Components().create_centroid_bank()
+    if ids == 'leaves':
+        # the arithmetic nodes carry no centroid ID
+        components_array['ADD'] = Components().create_add_noid()
+        components_array['QUAD'] = Components().create_quad_noid()
+        components_array['SUB'] = Components().create_sub_noid()
+        for num_inputs in range(3, arity + 1):
+            components_array['ADD%d' % num_inputs] = Components().create_add_noid(num_inputs)
+        if mac:
+            components_array['MAC'] = Components().create_mac_noid()
+        if tiles > 1:
+            components_array['ACC'] = Components().create_acc_noid()
 
+    # the kmeans share the configuration bus: the centroids and IMMs of a
+    # kmeans are numbered after those of the kmeans before it
     count = 0
+    centroid_id_base = 0
     kmeans_array = {}
     for k in k_array:
         if k not in kmeans_array.keys():
-            kmeans_array[k] = make_kmeans(external_data_width, data_width, k, sum(k_array), dimensions, components_array)
+            kmeans_array[k] = make_kmeans(external_data_width, data_width, k, sum(k_array), dimensions, components_array,
+                                         emission, arity, mac, widths, ids, fold, multipass, accumulate,
+                                         persistent > 0, shadow, header, centroid_id_base,
+                                         centroid_id_base * dimensions)
+            centroid_id_base += k
         kmeans = kmeans_array[k]
         params = []
         con = [('clk', clk), ('rst', rst),
                ('kmeans_centroids_configurations_in', config_centroids_configurations_out),
-               ('kmeans_data_in', input_controller_data_out),
-               ('kmeans_input_valid', input_controller_output_valid),
+               ('kmeans_data_in', kmeans_data_in),
+               ('kmeans_input_valid', kmeans_input_valid),
                ('kmeans_data_out', output_controller_data_in[count]),
                ('kmeans_output_valid', output_controller_input_valid[count])]
+        if fold:
+            con.append(('kmeans_ready', kmeans_ready[count]))
+        if multipass:
+            con.append(('kmeans_id_base', config_centroids_id_base))
+        if accumulate or persistent:
+            con.append(('kmeans_num_points', config_centroids_num_points))
+        if persistent:
+            con += [('kmeans_max_iterations', config_centroids_max_iterations),
+                    ('kmeans_store_overflow', store_overflow),
+                    ('kmeans_restart', kmeans_restart),
+                    ('kmeans_replay', kmeans_replay)]
+        if shadow:
+            con.append(('kmeans_centroids_swap', centroids_swap))
         m.Instance(kmeans, 'kmeans_%d_%d' % (count, k), params, con)
 
         m.EmbeddedCode(' ')
 
         m.EmbeddedCode('//Output Controller Instantiation')
 
-        output_controller = Components().create_output_controller(external_data_width, data_width, dimensions)
+        if accumulate or persistent:
+            output_controller = Components().create_output_controller(external_data_width, data_width, dimensions,
+                                                                      output_width, output_words)
+        else:
+            output_controller = Components().create_output_controller(external_data_width, data_width, dimensions,
+                                                                      output_width)
         params = []
         con = [('clk', clk), ('rst', rst), ('start', start_circuit),
                ('output_controller_available_write', kmeans_top_available_write[count]),
@@ -128,3 +267,74 @@ def make_kmeans_top(external_data_width, data_width, k_array, dimensions):
         count = count + 1
 
     return m
+
+
+def make_point_store(m, lines, line_data, line_valid, ready):
+    # persistent kernel: the lines of the first pass are written to the
+    # store as they go to the kmeans, and the store overflows past lines
+    # lines. Once the kmeans restarts, the lines are only read from the
+    # store, with a registered read while ready, when the kmeans replays
+    # them, and the done follows the last one. Returns the lines and their
+    # validity, the overflow and the restart and replay wires of the kmeans
+    clk = m.get_ports()['clk']
+    rst = m.get_ports()['rst']
+
+    m.EmbeddedCode(' ')
+    m.EmbeddedCode('//Point store and replay')
+    kmeans_restart = m.Wire('kmeans_restart')
+    kmeans_replay = m.Wire('kmeans_replay')
+    store_data = m.Wire('store_data', line_data.width)
+    store_valid = m.Wire('store_valid', 2)
+    store_write = m.Wire('store_write')
+    store_read = m.Wire('store_read')
+    store_lines = m.Reg('store_lines', bits(lines + 1))
+    store_overflow = m.Reg('store_overflow')
+    replaying = m.Reg('replaying')
+    replay_running = m.Reg('replay_running')
+    replay_addr = m.Reg('replay_addr', bits(lines + 1))
+    replay_valid = m.Reg('replay_valid')
+    pass_data = m.Wire('pass_data', line_data.width)
+    pass_valid = m.Wire('pass_valid', 2)
+
+    store_write.assign(AndList(Not(replaying), line_valid == Int(1, 2, 10),
+                               store_lines < Int(lines, store_lines.width, 10)))
+    store_read.assign(AndList(replay_running, replay_addr < store_lines, ready))
+    store_valid.assign(Mux(replay_valid, Int(1, 2, 10),
+                           Mux(AndList(replay_running, replay_addr == store_lines), Int(2, 2, 10), Int(0, 2, 10))))
+    pass_data.assign(Mux(replaying, store_data, line_data))
+    pass_valid.assign(Mux(replaying, store_valid, line_valid))
+
+    point_store = Components().create_centroid_bank()
+    params = [('DATA_WIDTH', line_data.width), ('ADDR_WIDTH', bits(lines)), ('DEPTH', lines)]
+    con = [('clk', clk), ('wr_en', store_write), ('wr_addr', store_lines[0:bits(lines)]), ('wr_data', line_data),
+           ('rd_addr', replay_addr[0:bits(lines)]), ('rd_data', store_data)]
+    m.Instance(point_store, 'point_store', params, con)
+
+    m.Always(Posedge(clk))(
+        If(rst)(
+            store_lines(Int(0, store_lines.width, 10)),
+            store_overflow(Int(0, 1, 2)),
+            replaying(Int(0, 1, 2)),
+            replay_running(Int(0, 1, 2)),
+            replay_addr(Int(0, replay_addr.width, 10)),
+            replay_valid(Int(0, 1, 2)),
+        ).Else(
+            replay_valid(store_read),
+            If(store_write)(
+                store_lines(store_lines + Int(1, store_lines.width, 10)),
+            ).Elif(AndList(Not(replaying), line_valid == Int(1, 2, 10)))(
+                store_overflow(Int(1, 1, 2)),
+            ),
+            If(kmeans_restart)(
+                replaying(Int(1, 1, 2)),
+                replay_running(Int(0, 1, 2)),
+                replay_addr(Int(0, replay_addr.width, 10)),
+            ).Elif(kmeans_replay)(
+                replay_running(Int(1, 1, 2)),
+            ).Elif(store_read)(
+                replay_addr(replay_addr + Int(1, replay_addr.width, 10)),
+            ),
+        )
+    )
+
+    return pass_data, pass_valid, store_overflow, kmeans_restart, kmeans_replay
@@ -0,0 +1,133 @@
+import cProfile
+import functools
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self.stack = []
+        self.cprofile_stage = None
+        self.cprofiles = {}
+
+    def enable(self, cprofile_stage=None):
+        # cprofile_stage: None disables cProfile, 'hottest' profiles every
+        # top-level stage and keeps the slowest one, or the name of a stage
+        self.enabled = True
+        self.stages = {}
+        self.stack = []
+        self.cprofile_stage = cprofile_stage
+        self.cprofiles = {}
+        self.start = time.perf_counter()
+        tracemalloc.start()
+
+    def disable(self):
+        self.wall = time.perf_counter() - self.start
+        self.enabled = False
+        tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        if name not in self.stages:
+            self.stages[name] = {'depth': len(self.stack), 'calls': 0, 'seconds': 0.0, 'peak_bytes': 0}
+
+        # the traced memory peak is reset on every stage boundary; the peak
+        # seen so far belongs to the enclosing stage
+        current, peak = tracemalloc.get_traced_memory()
+        if self.stack:
+            self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        entry = {'start': current, 'peak': current}
+        self.stack.append(entry)
+
+        profile = self._cprofile_for(name)
+        if profile is not None:
+            profile.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+
+            current, peak = tracemalloc.get_traced_memory()
+            entry['peak'] = max(entry['peak'], peak)
+            self.stack.pop()
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], entry['peak'])
+            tracemalloc.reset_peak()
+
+            stats = self.stages[name]
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            stats['peak_bytes'] = max(stats['peak_bytes'], entry['peak'] - entry['start'])
+
+    def _cprofile_for(self, name):
+        if self.cprofile_stage is None:
+            return None
+        if self.cprofile_stage == 'hottest':
+            # only one profiler can be active, so only top-level stages
+            if len(self.stack) != 1:
+                return None
+        elif self.cprofile_stage != name:
+            return None
+        if name not in self.cprofiles:
+            self.cprofiles[name] = cProfile.Profile()
+        return self.cprofiles[name]
+
+    def report(self):
+        lines = ['%-28s %6s %10s %7s %11s' % ('stage', 'calls', 'time (s)', 'wall', 'peak (MB)')]
+        for name, stats in self.stages.items():
+            lines.append('%-28s %6d %10.4f %6.1f%% %11.2f' % (
+                '  ' * stats['depth'] + name, stats['calls'], stats['seconds'],
+                100.0 * stats['seconds'] / self.wall if self.wall else 0.0, stats['peak_bytes'] / (1024.0 * 1024.0)))
+        lines.append('%-28s %6s %10.4f' % ('total', '', self.wall))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return {'wall_seconds': self.wall, 'stages': self.stages}
+
+    def write_json(self, file_name):
+        with open(file_name, 'w') as fp:
+            json.dump(self.to_dict(), fp, indent=2)
+
+    def dump_cprofile(self, file_name):
+        # writes the cProfile statistics of the slowest profiled stage
+        if not self.cprofiles:
+            return None
+        name = max(self.cprofiles, key=lambda n: self.stages[n]['seconds'])
+        self.cprofiles[name].dump_stats(file_name)
+        return name
+
+
+profiler = Profiler()
+
+
+def profiled(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with profiler.stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add_profile_args(parser):
+    parser.add_argument('--profile', help='Print the time and peak memory of every generation stage',
+                        action='store_true')
+    parser.add_argument('--profile-json', help='Also write the stage profile to this JSON file', type=str)
+    parser.add_argument('--cprofile', help='Write cProfile statistics of the hottest stage to this file', type=str)
+    parser.add_argument('--cprofile-stage', help='Stage profiled by --cprofile (default: the hottest top-level '
+                                                 'stage)', type=str, default='hottest')
@@ -0,0 +1,390 @@
+import math
+
+from utils import Node, generate_kmeans_core, core_bus_widths, node_widths, centroid_id_tags, pipeline_depth, \
+    line_cores, needs_gearbox, point_tiles, tile_dimensions, fold_units, fold_rounds, bits, state_width, \
+    accumulator_width, accumulator_word_width
+
+# ap_clk requested by package_kernel.tcl
+kernel_frequency = 250e6
+
+# VU9P resources left to the kernel by the F1 shell (approximate)
+f1_budget = {'lut': 895000, 'ff': 1790000, 'bram': 1680, 'dsp': 5640}
+
+# F1 DDR4-2133 channels of 64 bits; the efficiency is the fraction of the
+# peak sustained by long sequential bursts
+ddr_channels = 4
+ddr_channel_bandwidth = 17.0e9
+ddr_efficiency = 0.8
+
+# 26x17 unsigned tiles of the DSP48E2 27x18 signed multiplier
+dsp_a_width = 26
+dsp_b_width = 17
+
+# cost of the parts that are not generated from the DFG, from their RTL
+# (axi_reader.sv, axi_writer.sv, control_s_axi) and the platform side of
+# every m_axi port and DDR controller. The F1 shell already holds one DDR
+# controller, the others are placed in the kernel region
+axi_reader_cost = {'lut': 600, 'ff': 900}
+axi_writer_cost = {'lut': 600, 'ff': 900}
+control_port_cost = {'lut': 150, 'ff': 192}
+interconnect_port_cost = {'lut': 3500, 'ff': 6000}
+ddr_controller_cost = {'lut': 28000, 'ff': 35000, 'bram': 40}
+resource_names = ['lut', 'ff', 'bram', 'dsp']
+
+
+def dsp_count(a_width, b_width, product_width):
+    # partial products of a a_width x b_width multiplier, without the tiles
+    # above the truncated product
+    tiles = 0
+    for i in range(math.ceil(a_width / dsp_a_width)):
+        for j in range(math.ceil(b_width / dsp_b_width)):
+            if i * dsp_a_width + j * dsp_b_width < product_width:
+                tiles += 1
+    return tiles
+
+
+def bram_count(width, depth):
+    # BRAM36 in the 512x72 configuration
+    return math.ceil(width / 72) * math.ceil(depth / 512)
+
+
+def lutram_count(width, depth):
+    # RAM32M16: 8 LUTs hold 32 entries of 14 bits
+    return math.ceil(width / 14) * 8 * math.ceil(depth / 32)
+
+
+def empty():
+    return dict((r, 0) for r in resource_names)
+
+
+def add(total, cost, times=1):
+    for r in resource_names:
+        total[r] += cost.get(r, 0) * times
+    return total
+
+
+def node_cost(node_type, num_inputs, width, input_width, centroid_id_width, imm_id_width, signed_square=False,
+              tiles=1):
+    # width: data bits of the node output; input_width: data bits of its
+    # widest input; centroid_id_width: 0 for the nodes without ID
+    bus = width + centroid_id_width
+    if node_type == Node.Type.IMM:
+        # a coordinate per tile behind the tile mux
+        return {'lut': tiles * (math.ceil(imm_id_width / 6) + 1) + width * math.ceil((tiles - 1) / 3),
+                'ff': tiles * width}
+    if node_type == Node.Type.ACC:
+        # adder with the restart mux folded in
+        return {'lut': width, 'ff': bus}
+    if node_type == Node.Type.SUB:
+        return {'lut': width, 'ff': bus}
+    if node_type == Node.Type.QUAD:
+        if signed_square:
+            # m_quad_exact and m_quad_noid square the signed input on its own
+            # width
+            return {'dsp': dsp_count(input_width - 1, input_width - 1, width), 'ff': bus}
+        # m_quad squares the sign extended input on 2 * input_width bits
+        return {'dsp': dsp_count(2 * input_width, 2 * input_width, 2 * input_width), 'ff': bus}
+    if node_type == Node.Type.MAC:
+        # signed multiplier, post-adder and output register of one DSP chain
+        return {'dsp': dsp_count(input_width - 1, input_width - 1, width)}
+    if node_type == Node.Type.ADD:
+        # num_inputs - 1 carry chain adders
+        return {'lut': (num_inputs - 1) * width, 'ff': bus}
+    if node_type == Node.Type.CMP:
+        # comparator carry chain and a 2:1 mux, two bits per LUT, per input
+        # after the first
+        return {'lut': (num_inputs - 1) * (width + math.ceil(bus / 2)), 'ff': bus}
+    if node_type == Node.Type.REG:
+        return {'ff': bus}
+    return {}
+
+
+def estimate_core(data_width, k, sum_k, dimensions, arity=2, mac=False, widths='uniform', ids='datapath', tiles=1,
+                  fold=0, shadow=False):
+    # walks the same DFG lowered by make_kmeans_core; shadow adds a shadow
+    # register behind every IMM, or a second set of rounds to the banks
+    units = fold_units(k, fold)
+    rounds = fold_rounds(k, fold)
+    core = generate_kmeans_core(units, tile_dimensions(dimensions, tiles), arity, mac, tiles, fold > 0)
+    centroid_id_width = math.ceil(math.log2(sum_k))
+    imm_id_width = math.ceil(math.log2((sum_k * dimensions) + 1))
+    if widths == 'exact':
+        data_bits = node_widths(core, data_width, tiles)
+    else:
+        bus_width = core_bus_widths(data_width, sum_k, core.count(Node.Type.ADD) + core.count(Node.Type.MAC),
+                                    tiles)
+        data_bits = [bus_width[core.node_type(node).name] - centroid_id_width for node in core]
+    tags = centroid_id_tags(core, ids)
+
+    nodes = {}
+    bus_width = {}
+    resources = empty()
+    for node in core:
+        inputs = core.predecessors(node)
+        if len(core.successors(node)) + len(inputs) == 0:
+            continue
+        node_type = core.node_type(node)
+        nodes[node_type.name] = nodes.get(node_type.name, 0) + 1
+        id_width = centroid_id_width if tags[node] else 0
+        bus_width[node_type.name] = max(bus_width.get(node_type.name, 0), data_bits[node] + id_width)
+
+        # the uniform QUAD and MAC take the data width, whatever the width of
+        # their input bus
+        if widths != 'exact' and node_type in [Node.Type.QUAD, Node.Type.MAC]:
+            input_width = data_width
+        else:
+            input_width = max((data_bits[pred] for pred in inputs), default=0)
+        if fold and node_type == Node.Type.IMM:
+            # read from the centroid banks
+            continue
+        add(resources, node_cost(node_type, len(inputs), data_bits[node], input_width, id_width, imm_id_width,
+                                 widths == 'exact' or ids == 'leaves', tiles))
+        if shadow and node_type == Node.Type.IMM:
+            add(resources, {'ff': data_bits[node]})
+
+    if tiles > 1:
+        # tile of every pipeline stage up to the ACC nodes
+        arrival = core.arrival_times()
+        depth = max(arrival[node] for node in core if core.node_type(node) == Node.Type.ACC)
+        add(resources, {'ff': depth * (math.ceil(math.log2(tiles)) + 1)})
+
+    if fold:
+        # a bank of a centroid per round for every unit, that synthesis keeps
+        # in LUTRAM while it is shallow; the loader, the round of every
+        # stage up to the compare tree output and the running minimum
+        bank_depth = (1 << bits(rounds)) + rounds if shadow else rounds
+        if bank_depth > 64:
+            add(resources, {'bram': bram_count(dimensions * data_width, bank_depth)}, units)
+        else:
+            add(resources, {'lut': lutram_count(dimensions * data_width, bank_depth)}, units)
+        arrival = core.arrival_times()
+        root = max(arrival[node] for node in core if arrival[node] is not None)
+        add(resources, {'lut': 3 * imm_id_width,
+                        'ff': imm_id_width + 1 + bits(dimensions) + bits(units) + bits(rounds) +
+                        (dimensions - 1) * data_width})
+        add(resources, {'ff': root * (bits(rounds) + 1)})
+        add(resources, {'lut': 2 * max(data_bits) + centroid_id_width, 'ff': max(data_bits) + centroid_id_width})
+        if mac:
+            # the coordinates wait for the SUB of their MAC in registers
+            add(resources, {'ff': units * data_width * dimensions * (dimensions - 1) // 2})
+
+    return {'nodes': nodes, 'bus_width': bus_width, 'resources': resources}
+
+
+def accumulators_cost(k, dimensions, data_width, cores, depth):
+    # accumulate mode: the beat delayed to its labels in shift registers,
+    # per core a distributed RAM per feature and for the count, with its
+    # adder and read mux, and the sum of the cores and drain counters
+    beat_width = cores * data_width * dimensions
+    cost = add(empty(), {'lut': beat_width * math.ceil((depth - 1) / 32.0), 'ff': beat_width})
+    core = empty()
+    add(core, {'lut': lutram_count(accumulator_width, k)}, dimensions + 1)
+    add(core, {'lut': accumulator_width * (dimensions + 1 + math.ceil((dimensions + 1) / 4.0)),
+               'ff': accumulator_width + k})
+    add(cost, core, cores)
+    return add(cost, {'lut': accumulator_width * (cores - 1) + 64,
+                      'ff': accumulator_width + 32 + bits(k) + bits(dimensions + 1) + 4})
+
+
+def persistent_cost(k, dimensions, data_width, lines, external_data_width=512):
+    # persistent kernel: the point store and its replay counters, and the
+    # Lloyd updater with the centroids behind a read mux, the bit-serial
+    # divider and the reload and write counters
+    coordinates = k * dimensions
+    cost = add(empty(), {'bram': bram_count(external_data_width, lines),
+                         'lut': 3 * bits(lines + 1) + external_data_width + 8,
+                         'ff': 3 * bits(lines + 1) + 4})
+    add(cost, {'lut': data_width * math.ceil(coordinates / 4.0) + 2 * (accumulator_width + data_width) + 64 + 32,
+               'ff': data_width * coordinates + 3 * accumulator_width + 2 * data_width + 64 + 32 +
+                     accumulator_word_width + bits(coordinates + 1) + 16})
+    return cost
+
+
+def controllers_cost(external_data_width, data_width, dimensions, num_kmeans, multipass=False, accumulate=False,
+                     header='sparse'):
+    # config_centroids, input_controller and one output_controller per kmeans.
+    # The dense header goes out a line at a time, above its line ID, instead
+    # of through the 64-bit entry shifter
+    if header == 'dense':
+        cost = add(empty(), {'lut': 4 * 32, 'ff': external_data_width + 32 + 32 + 32 + 32 + 5})
+    else:
+        cost = add(empty(), {'lut': 2 * 64 + 3 * 32, 'ff': external_data_width + 9 + 32 + 32 + 64 + 5})
+    add(cost, {'lut': 8, 'ff': external_data_width + 5})
+
+    cores = line_cores(external_data_width, data_width, dimensions)
+    tiles = point_tiles(external_data_width, data_width, dimensions)
+    beat_width = cores * data_width * tile_dimensions(dimensions, tiles)
+    output_width = (state_width if multipass else 8) * cores
+    if accumulate:
+        # an accumulator per valid
+        output_width = accumulator_word_width
+    if output_width == external_data_width:
+        output = {'lut': 8, 'ff': external_data_width + 2}
+    elif external_data_width % output_width == 0:
+        output = {'lut': external_data_width + 16, 'ff': 2 * external_data_width + 13}
+    else:
+        # dense label packing: barrel shifter over the line and a beat
+        buffer_width = external_data_width + output_width
+        output = {'lut': buffer_width * math.ceil(math.log2(buffer_width)) // 2 + 16,
+                  'ff': buffer_width + external_data_width + 13}
+
+    if needs_gearbox(external_data_width, data_width, dimensions):
+        # input gearbox: a beat and a line of buffer behind a barrel shifter,
+        # and the slack of a short last tile
+        buffer_width = beat_width + external_data_width
+        if tiles > 1:
+            buffer_width += (tiles * tile_dimensions(dimensions, tiles) - dimensions) * data_width
+        add(cost, {'lut': buffer_width * math.ceil(math.log2(buffer_width)) // 2 + 2 * buffer_width,
+                   'ff': buffer_width + beat_width + 14})
+    return add(cost, output, num_kmeans)
+
+
+def interface_cost(copies, external_data_width=512):
+    # per m_axi port: axi_reader with its 512-deep BRAM FIFO, axi_writer with
+    # its 32-deep LUTRAM FIFO, the control registers and the interconnect
+    port = empty()
+    add(port, axi_reader_cost)
+    add(port, {'bram': bram_count(external_data_width, 512)})
+    add(port, axi_writer_cost)
+    add(port, {'lut': lutram_count(external_data_width, 32), 'ff': external_data_width})
+    add(port, control_port_cost)
+    add(port, interconnect_port_cost)
+    return add(empty(), port, copies)
+
+
+def ddr_cost(copies):
+    return add(empty(), ddr_controller_cost, max(0, min(copies, ddr_channels) - 1))
+
+
+def estimate_throughput(config, frequency=kernel_frequency, channels=ddr_channels,
+                        channel_bandwidth=ddr_channel_bandwidth * ddr_efficiency):
+    # every copy takes one cache line per cycle, or with folded cores a beat
+    # every ceil(K / units) cycles; the copies share the DDR channels round
+    # robin, one m_axi port each. Points are packed densely, so a line may
+    # hold a fraction of a point
+    points_per_line = config.external_data_width / float(config.data_width * config.dimensions)
+    points_per_cycle = points_per_line
+    rounds = max(fold_rounds(k, config.fold) for k in config.k_array)
+    if rounds > 1:
+        cores = line_cores(config.external_data_width, config.data_width, config.dimensions)
+        points_per_cycle = min(points_per_line, cores / float(rounds))
+    line_bytes = config.external_data_width // 8
+    # 8-bit centroid label per point and per kmeans, or the 64-bit state of
+    # the point in multipass mode; the accumulators are written once, after
+    # the points, and so are the centroids of the persistent kernel, whose
+    # passes after the first read the points from the store instead of the
+    # DDR (the model counts the first one)
+    output_bytes = state_width // 8 if config.multipass else 1
+    if config.accumulate or config.persistent:
+        output_bytes = 0
+    bytes_per_point = line_bytes / points_per_line + output_bytes * len(config.k_array)
+    copy_bandwidth = frequency * points_per_cycle * bytes_per_point
+
+    used = 0.0
+    for channel in range(channels):
+        copies_on_channel = config.copies // channels + (1 if channel < config.copies % channels else 0)
+        used += min(copies_on_channel * copy_bandwidth, channel_bandwidth)
+
+    compute_points = config.copies * frequency * points_per_cycle
+    points = used / bytes_per_point
+
+    # sub, square and add per coordinate, and one compare per centroid
+    ops_per_point = sum(3 * k * config.dimensions + k - 1 for k in config.k_array)
+    intensity = ops_per_point / bytes_per_point
+    return {'frequency': frequency,
+            'points_per_cycle': config.copies * points_per_cycle,
+            'bytes_per_point': bytes_per_point,
+            'compute_points_per_s': compute_points,
+            'memory_points_per_s': min(config.copies, channels) * channel_bandwidth / bytes_per_point,
+            'points_per_s': points,
+            'bandwidth_bytes_per_s': used,
+            'ops_per_point': ops_per_point,
+            'ops_per_byte': intensity,
+            'bound': 'compute' if points >= compute_points * 0.999 else 'bandwidth'}
+
+
+def estimate(config, frequency=kernel_frequency, budget=None):
+    # resources and throughput of the design generated for config, without
+    # generating it
+    if budget is None:
+        budget = f1_budget
+
+    sum_k = sum(config.k_array)
+    cores_per_kmeans = line_cores(config.external_data_width, config.data_width, config.dimensions)
+    tiles = point_tiles(config.external_data_width, config.data_width, config.dimensions)
+    config.validate()
+
+    kmeans = empty()
+    cores = {}
+    for k in sorted(set(config.k_array)):
+        cores[k] = estimate_core(config.data_width, k, sum_k, config.dimensions, config.arity, config.mac,
+                                 config.widths, config.ids, tiles, config.fold, config.shadow)
+    for k in config.k_array:
+        add(kmeans, cores[k]['resources'], cores_per_kmeans)
+        # validity_protractor: 2-bit register pipeline
+        add(kmeans, {'ff': 2 * pipeline_depth(fold_units(k, config.fold), tile_dimensions(config.dimensions, tiles),
+                                              config.arity, config.mac, tiles, config.fold > 0)})
+        if config.fold:
+            # beat FIFO, the beat of the cores and the round scheduler
+            beat_width = cores_per_kmeans * config.data_width * config.dimensions
+            add(kmeans, {'lut': lutram_count(beat_width, 8) + 32, 'ff': beat_width + 16})
+        if config.accumulate or config.persistent:
+            add(kmeans, accumulators_cost(k, config.dimensions, config.data_width, cores_per_kmeans,
+                                          pipeline_depth(fold_units(k, config.fold), config.dimensions, config.arity,
+                                                         config.mac, 1, config.fold > 0)))
+        if config.persistent:
+            add(kmeans, persistent_cost(k, config.dimensions, config.data_width, config.persistent,
+                                        config.external_data_width))
+
+    blocks = {'kmeans': add(empty(), kmeans, config.copies),
+              'controllers': add(empty(), controllers_cost(config.external_data_width, config.data_width,
+                                                           config.dimensions, len(config.k_array), config.multipass,
+                                                           config.accumulate or config.persistent > 0,
+                                                           config.header),
+                                  config.copies),
+              'interface': interface_cost(config.copies, config.external_data_width),
+              'ddr': ddr_cost(config.copies)}
+
+    total = empty()
+    for block in blocks.values():
+        add(total, block)
+
+    utilization = dict((r, total[r] / float(budget[r])) for r in resource_names)
+    return {'config': config.to_dict(),
+            'cores_per_kmeans': cores_per_kmeans,
+            'cores': dict((k, {'nodes': c['nodes'], 'resources': c['resources']}) for k, c in cores.items()),
+            'blocks': blocks,
+            'total': total,
+            'budget': budget,
+            'utilization': utilization,
+            'fits': all(u <= 1.0 for u in utilization.values()),
+            'throughput': estimate_throughput(config, frequency)}
+
+
+def report(estimation):
+    config = estimation['config']
+    lines = ['K=%s N=%d copies=%d data width=%d: %d cores per kmeans' % (
+        ','.join(str(k) for k in config['k_array']), config['dimensions'], config['copies'], config['data_width'],
+        estimation['cores_per_kmeans'])]
+
+    for k, core in estimation['cores'].items():
+        lines.append('  kmeans_core_%d: %s' % (k, ', '.join('%d %s' % (n, t) for t, n in sorted(core['nodes'].items()))))
+
+    lines.append('')
+    lines.append('%-14s %10s %10s %8s %8s' % ('block', 'LUT', 'FF', 'BRAM', 'DSP'))
+    rows = list(estimation['blocks'].items()) + [('total', estimation['total']), ('budget', estimation['budget'])]
+    for name, r in rows:
+        lines.append('%-14s %10d %10d %8d %8d' % (name, r['lut'], r['ff'], r['bram'], r['dsp']))
+    u = estimation['utilization']
+    lines.append('%-14s %9.1f%% %9.1f%% %7.1f%% %7.1f%%' % ('utilization', 100 * u['lut'], 100 * u['ff'],
+                                                         100 * u['bram'], 100 * u['dsp']))
+    if not estimation['fits']:
+        lines.append('The design does not fit the F1 kernel region')
+
+    t = estimation['throughput']
+    lines.append('')
+    lines.append('%.1f Mpoints/s at %.0f MHz (%s bound): compute %.1f Mpoints/s, memory %.1f Mpoints/s, '
+                 '%.2f GB/s of DDR' % (t['points_per_s'] / 1e6, t['frequency'] / 1e6, t['bound'],
+                                       t['compute_points_per_s'] / 1e6, t['memory_points_per_s'] / 1e6,
+                                       t['bandwidth_bytes_per_s'] / 1e9))
+    return '\n'.join(lines)
@@ -0,0 +1,135 @@
+import argparse
+import itertools
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from create_project import create_project, list_template, add_data_width_arg, add_emission_arg, add_datapath_args, \
+    add_materialize_arg, add_split_arg, clean_generator_files
+from generation_cache import add_cache_args, open_cache
+from kmeans_generator import KmeansConfig
+
+
+def create_args():
+    parser = argparse.ArgumentParser('sweep -h')
+    parser.add_argument('-N', '--dimensions', help='Numbers of Kmeans dimensions', type=int, nargs='+')
+    parser.add_argument('-K', '--centroids', help='Numbers of Kmeans clusters', type=int, nargs='+')
+    parser.add_argument('-c', '--copies', help='Numbers of KmeansAcc copies', type=int, nargs='+', default=[1])
+    parser.add_argument('-f', '--configs', help='File with one "N K copies [name]" configuration per line',
+                        type=str)
+    parser.add_argument('-j', '--jobs', help='Number of parallel workers', type=int, default=os.cpu_count())
+    parser.add_argument('-o', '--output', help='Projects location', type=str, default='.')
+    parser.add_argument('-m', '--manifest', help='Summary manifest file name', type=str,
+                        default='sweep_manifest.json')
+    add_data_width_arg(parser)
+    add_emission_arg(parser)
+    add_datapath_args(parser)
+    # -m is the manifest of the sweep
+    add_materialize_arg(parser, '-M')
+    add_split_arg(parser)
+    add_cache_args(parser)
+
+    return parser.parse_args()
+
+
+def project_name(dimensions, centroids, copies):
+    return 'kmeans_n%d_k%d_c%d.prj' % (dimensions, centroids, copies)
+
+
+def read_configs(file_name):
+    configs = []
+    with open(file_name) as fp:
+        for line in fp:
+            fields = line.split('#')[0].replace(',', ' ').split()
+            if not fields:
+                continue
+            dimensions, centroids, copies = (int(x) for x in fields[:3])
+            name = fields[3] if len(fields) > 3 else project_name(dimensions, centroids, copies)
+            configs.append((dimensions, centroids, copies, name))
+    return configs
+
+
+def grid_configs(dimensions, centroids, copies):
+    return [(n, k, c, project_name(n, k, c)) for n, k, c in itertools.product(dimensions, centroids, copies)]
+
+
+def run_config(config, output, template_list, cache, split, options):
+    # options: KmeansConfig keyword arguments shared by the whole sweep
+    dimensions, centroids, copies, name = config
+    result = {'name': name, 'dimensions': dimensions, 'centroids': centroids, 'copies': copies}
+    start = time.perf_counter()
+    try:
+        config = KmeansConfig(dimensions, centroids, copies, **options)
+        project_path, metadata = create_project(config, name, output, template_list, cache, split)
+        result['status'] = 'ok'
+        result['path'] = os.path.abspath(project_path)
+        result.update(metadata)
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e) or traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def sweep(configs, output, jobs=None, manifest='sweep_manifest.json', materialize='full', cache=None,
+          split=False, options=None):
+    if options is None:
+        options = {}
+    os.makedirs(output, exist_ok=True)
+    template_list = list_template(materialize=materialize)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_config, config, output, template_list, cache, split, options) for config in configs]
+        for future in as_completed(futures):
+            result = future.result()
+            print('%-32s %-6s %8.2fs' % (result['name'], result['status'], result['seconds']))
+            results.append(result)
+
+    order = {config[3]: i for i, config in enumerate(configs)}
+    results.sort(key=lambda r: order[r['name']])
+
+    with open(os.path.join(output, manifest), 'w') as fp:
+        json.dump({'output': os.path.abspath(output), 'projects': results}, fp, indent=2)
+
+    return results
+
+
+def main():
+    args = create_args()
+
+    configs = []
+    if args.configs:
+        configs.extend(read_configs(args.configs))
+    if args.dimensions and args.centroids:
+        configs.extend(grid_configs(args.dimensions, args.centroids, args.copies))
+    if not configs:
+        raise Exception('Missing configurations. Run sweep -h to see all parameters needed')
+
+    names = [config[3] for config in configs]
+    if len(set(names)) != len(names):
+        raise Exception('Duplicated project names in the sweep')
+
+    start = time.perf_counter()
+    options = {'data_width': args.data_width, 'emission': args.emission, 'arity': args.arity, 'mac': args.mac,
+               'widths': args.widths, 'ids': args.ids, 'fold': args.fold, 'multipass': args.multipass,
+               'accumulate': args.accumulate, 'persistent': args.persistent, 'shadow': args.shadow,
+               'header': args.header}
+    results = sweep(configs, args.output, args.jobs, args.manifest, args.materialize, open_cache(args),
+                    args.split_modules, options)
+
+    clean_generator_files()
+
+    failed = len([r for r in results if r['status'] != 'ok'])
+    print('%d projects created, %d failed in %.2fs. Manifest: %s' % (
+        len(results) - failed, failed, time.perf_counter() - start, os.path.join(args.output, args.manifest)))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        print(e)
+        traceback.print_exc()
@@ -1,10 +1,32 @@
+import functools
+import hashlib
 import math
+import os
+import re
 import subprocess
+from array import array
 from enum import Enum
 from itertools import chain
 
 from veriloggen import *
 
+from profiler import profiled
+
+# multipass state of a point: the distance to its nearest centroid of the
+# pass above the centroid ID, in a 64-bit record
+state_width = 64
+state_id_width = 16
+
+# accumulate mode: the coordinate sums and point count of every cluster,
+# kept in accumulator_width bits and written in 64-bit words
+accumulator_width = 48
+accumulator_word_width = 64
+
+# dense header: the configuration lines hold a coordinate per
+# header_slot_width-bit slot, in IMM ID order, instead of 64-bit entries of
+# the IMM ID and the value
+header_slot_width = 16
+
 
 class Node:
     class Type(Enum):
@@ -18,37 +40,36 @@ class Node:
         EQ = 7
         CONST = 8
         ACC = 9
+        MAC = 10
 
     @classmethod
     def get_node(cls, node_type, graph):
-        index = node_type.value
-        node_id = cls.next_id[index]
-        cls.next_id[index] += 1
-        node = Node(node_id, node_type)
-        graph[node] = []
-        return node
+        return graph.get_node(node_type)
 
     @classmethod
-    def reduce(cls, nodes, operation, graph):
+    def reduce(cls, nodes, operation, graph, arity=2):
+        # tree of operators of up to arity inputs; a node left alone at the
+        # end of a level is carried by a REG
         while len(nodes) > 1:
             queue = nodes
             nodes = []
             it = 0
 
             while it < len(queue):
+                group = queue[it:it + arity]
 
-                if it + 2 <= len(queue):
+                if len(group) > 1:
                     operator = cls.get_node(operation, graph)
-                    graph[queue[it]].append(operator)
-                    graph[queue[it + 1]].append(operator)
+                    for node in group:
+                        graph.connect(node, operator)
                     nodes.append(operator)
-                    it += 2
 
                 else:
                     reg = cls.get_node(cls.Type.REG, graph)
-                    graph[queue[it]].append(reg)
+                    graph.connect(group[0], reg)
                     nodes.append(reg)
-                    it += 1
+
+                it += len(group)
 
         return nodes[0]
 
@@ -65,8 +86,8 @@ class Node:
                 for el in queue:
                     regl = cls.get_node(cls.Type.REG, graph)
                     regr = cls.get_node(cls.Type.REG, graph)
-                    graph[el].append(regl)
-                    graph[el].append(regr)
+                    graph.connect(el, regl)
+                    graph.connect(el, regr)
                     nodes.append(regl)
                     nodes.append(regr)
 
@@ -78,12 +99,12 @@ class Node:
                 while it_out < len(out):
 
                     if len(out) - it_out > len(queue) - it_queue:
-                        graph[queue[it_queue]].append(out[it_out])
-                        graph[queue[it_queue]].append(out[it_out + 1])
+                        graph.connect(queue[it_queue], out[it_out])
+                        graph.connect(queue[it_queue], out[it_out + 1])
                         it_out += 2
 
                     else:
-                        graph[queue[it_queue]].append(out[it_out])
+                        graph.connect(queue[it_queue], out[it_out])
                         it_out += 1
 
                     it_queue += 1
@@ -96,11 +117,24 @@ class Node:
     def delay(cls, node, n, graph):
         while n > 0:
             reg = Node.get_node(Node.Type.REG, graph)
-            graph[node].append(reg)
+            graph.connect(node, reg)
             node = reg
             n -= 1
         return node
 
+    @classmethod
+    def latency(cls, node_type):
+        # cycles between the inputs and the output of a node: every operator
+        # registers its output; IN is the registered input line and IMM and
+        # CONST hold values loaded before the data, outside the pipeline
+        if node_type in [cls.Type.IN, cls.Type.IMM, cls.Type.CONST]:
+            return 0
+        return 1
+
+    @classmethod
+    def is_static(cls, node_type):
+        return node_type in [cls.Type.IMM, cls.Type.CONST]
+
     @classmethod
     def print_dot(cls, graph):
         print("digraph {")
@@ -108,11 +142,11 @@ class Node:
         for k, v in graph.items():
 
             for i in v:
-                print("    {} -> {}".format(k, i))
+                print("    {} -> {}".format(graph.name(k), graph.name(i)))
 
         print("}")
 
-    next_id = [0 for x in Type]
+    __slots__ = ('id', 'type')
 
     def __init__(self, node_id, node_type):
         self.id = node_id
@@ -122,6 +156,200 @@ class Node:
         return "{}_{}".format(self.type.name, self.id)
 
 
+# Builder for one dataflow graph. The node id counters belong to the graph,
+# so rebuilding the same graph always yields the same node names.
+#
+# Nodes are integer handles into flat arrays (opcode and per-type id per
+# node, source and destination per edge); successor and predecessor lists
+# are kept in CSR form, built on first use after the graph changes. The
+# incoming edges of every node, in edge order, are indexed alongside the
+# CSR and kept up to date as edges are added, so moving the source of an
+# edge only looks at the inputs of its destination.
+class DataflowGraph:
+    def __init__(self):
+        self.next_id = [0 for x in Node.Type]
+        self.types = array('b')
+        self.ids = array('l')
+        self.edge_src = array('l')
+        self.edge_dst = array('l')
+        self._names = None
+        self._csr = None
+        self._in_edges = None
+
+    def get_node(self, node_type):
+        index = node_type.value
+        self.types.append(index)
+        self.ids.append(self.next_id[index])
+        self.next_id[index] += 1
+        self._names = None
+        self._csr = None
+        if self._in_edges is not None:
+            self._in_edges.append([])
+        return len(self.types) - 1
+
+    def connect(self, src, dst):
+        self.edge_src.append(src)
+        self.edge_dst.append(dst)
+        self._csr = None
+        if self._in_edges is not None:
+            self._in_edges[dst].append(len(self.edge_src) - 1)
+
+    def replace_input(self, src, dst, new_src):
+        # moves the first src -> dst edge to new_src -> dst
+        for edge in self._get_in_edges()[dst]:
+            if self.edge_src[edge] == src:
+                self.edge_src[edge] = new_src
+                self._csr = None
+                return
+        raise Exception('No edge from %s to %s' % (self.name(src), self.name(dst)))
+
+    def node_type(self, node):
+        return Node.Type(self.types[node])
+
+    def node(self, node):
+        return Node(self.ids[node], self.node_type(node))
+
+    def name(self, node):
+        return self.names()[node]
+
+    def names(self):
+        if self._names is None:
+            type_names = [t.name for t in Node.Type]
+            self._names = ['{}_{}'.format(type_names[t], i) for t, i in zip(self.types, self.ids)]
+        return self._names
+
+    def count(self, node_type):
+        return self.types.count(node_type.value)
+
+    def successors(self, node):
+        succ_ptr, succ, pred_ptr, pred = self._get_csr()
+        return succ[succ_ptr[node]:succ_ptr[node + 1]]
+
+    def predecessors(self, node):
+        succ_ptr, succ, pred_ptr, pred = self._get_csr()
+        return pred[pred_ptr[node]:pred_ptr[node + 1]]
+
+    def items(self):
+        for node in range(len(self.types)):
+            yield node, self.successors(node)
+
+    def keys(self):
+        return range(len(self.types))
+
+    def __iter__(self):
+        return iter(range(len(self.types)))
+
+    def __len__(self):
+        return len(self.types)
+
+    def topological_order(self):
+        pending = [len(self.predecessors(node)) for node in self]
+        ready = [node for node in self if pending[node] == 0]
+        order = []
+        while ready:
+            node = ready.pop()
+            order.append(node)
+            for succ in self.successors(node):
+                pending[succ] -= 1
+                if pending[succ] == 0:
+                    ready.append(succ)
+        if len(order) != len(self):
+            raise Exception('The dataflow graph has a cycle')
+        return order
+
+    def arrival_times(self):
+        # cycle in which the value of every node is ready, counted from the
+        # input line; None for the static nodes
+        types = [Node.Type(t) for t in range(len(Node.Type))]
+        arrival = [None] * len(self)
+        for node in self.topological_order():
+            node_type = types[self.types[node]]
+            if Node.is_static(node_type):
+                continue
+            inputs = [arrival[pred] for pred in self.predecessors(node) if arrival[pred] is not None]
+            arrival[node] = max(inputs, default=0) + Node.latency(node_type)
+        return arrival
+
+    def latency(self):
+        # longest path from the input line to the outputs
+        arrival = self.arrival_times()
+        outputs = [arrival[node] for node in self
+                   if arrival[node] is not None and len(self.successors(node)) == 0 and
+                   len(self.predecessors(node)) > 0]
+        return max(outputs, default=0)
+
+    def balance_paths(self):
+        # delays the early inputs of every node with REG chains, so that all
+        # the values reaching a node were computed from the same input line.
+        # Only the inputs of the node being balanced move, so the inputs of
+        # the nodes after it are read from the CSR of the graph as it was.
+        # Returns the number of registers inserted
+        arrival = self.arrival_times()
+        succ_ptr, succ, pred_ptr, preds = self._get_csr()
+        inserted = 0
+        for node in self.topological_order():
+            inputs = [pred for pred in preds[pred_ptr[node]:pred_ptr[node + 1]] if arrival[pred] is not None]
+            if not inputs:
+                continue
+            target = max(arrival[pred] for pred in inputs)
+            for pred in inputs:
+                if arrival[pred] < target:
+                    self.replace_input(pred, node, Node.delay(pred, target - arrival[pred], self))
+                    inserted += target - arrival[pred]
+        return inserted
+
+    def _get_csr(self):
+        if self._csr is None:
+            self._csr = self._build_csr()
+        return self._csr
+
+    def _get_in_edges(self):
+        if self._in_edges is None:
+            self._get_csr()
+        return self._in_edges
+
+    def _build_csr(self):
+        num_nodes = len(self.types)
+
+        # successors: stable counting sort of the edges by source, so every
+        # node keeps its successors in connection order
+        succ_ptr = self._offsets(self.edge_src, num_nodes)
+        succ = array('l', bytes(len(self.edge_dst) * succ_ptr.itemsize))
+        fill = array('l', succ_ptr)
+        for src, dst in zip(self.edge_src, self.edge_dst):
+            succ[fill[src]] = dst
+            fill[src] += 1
+
+        # predecessors: walk the successor lists in node order, so every node
+        # lists its inputs in graph order
+        pred_ptr = self._offsets(self.edge_dst, num_nodes)
+        pred = array('l', bytes(len(self.edge_src) * pred_ptr.itemsize))
+        fill = array('l', pred_ptr)
+        for src in range(num_nodes):
+            for dst in succ[succ_ptr[src]:succ_ptr[src + 1]]:
+                pred[fill[dst]] = src
+                fill[dst] += 1
+
+        # incoming edges of every node, in edge order: moving the source of
+        # an edge keeps it among the inputs of the same node
+        if self._in_edges is None:
+            self._in_edges = [[] for node in range(num_nodes)]
+            for edge, dst in enumerate(self.edge_dst):
+                self._in_edges[dst].append(edge)
+
+        return succ_ptr, succ, pred_ptr, pred
+
+    @staticmethod
+    def _offsets(endpoints, num_nodes):
+        offsets = array('l', bytes((num_nodes + 1) * array('l').itemsize))
+        for node in endpoints:
+            offsets[node + 1] += 1
+        for node in range(num_nodes):
+            offsets[node + 1] += offsets[node]
+        return offsets
+
+
+@profiled('initialize_regs')
 def initialize_regs(module, values=None):
     regs = []
     if values is None:
@@ -154,10 +382,22 @@ def initialize_regs(module, values=None):
                 s.add(r[1](value))
 
 
-def generate_kmeans_core(k, dimensions):
-    graph = {}
+@profiled('dfg_build')
+def generate_kmeans_core(k, dimensions, arity=2, mac=False, tiles=1, folded=False):
+    # arity: inputs of the ADD and CMP tree operators
+    # mac: squared differences accumulated by a chain of MAC nodes, one per
+    # coordinate, instead of QUAD nodes and an ADD tree
+    # tiles: beats of every point; dimensions are then the features of a
+    # tile, and an ACC node per centroid sums the partial distances of the
+    # tiles before the compare tree
+    # folded: k distance units whose IMMs are read from the centroid banks
+    # every round; the inputs are delayed once so the synchronous read of
+    # the banks meets them at the SUBs
+    graph = DataflowGraph()
 
     inputs = [Node.get_node(Node.Type.IN, graph) for x in range(dimensions)]
+    if folded:
+        inputs = [Node.delay(x, 1, graph) for x in inputs]
 
     # regs = [Node.get_node(Node.Type.REG, graph) for x in range(dimensions)]
 
@@ -172,6 +412,11 @@ def generate_kmeans_core(k, dimensions):
 
     # balanced_inputs = list(chain(*[Node.balance(x, [regs[it], *subs[it]], graph)
     #                               for it, x in enumerate(inputs)]))
+    if mac:
+        # coordinate it meets the partial sum of the MAC chain it cycles
+        # later; the delay is shared by the SUBs of all the centroids
+        inputs = [Node.delay(x, it, graph) for it, x in enumerate(inputs)]
+
     balanced_inputs = list(chain(*[Node.balance(x, subs[it], graph) for it, x in enumerate(inputs)]))
 
     '''for i, reg in enumerate(regs):
@@ -187,23 +432,42 @@ def generate_kmeans_core(k, dimensions):
         subs_ordered.append([])
 
         for dim, imm in enumerate(imms_k):
-            graph[imm].append(subs[dim][K])
+            graph.connect(imm, subs[dim][K])
             subs_ordered[K].append(subs[dim][K])
 
         # print(*subs_ordered[K])
 
     inertias = []
     for subs_k in subs_ordered:
+        if mac:
+            partial = None
+            for sub in subs_k:
+                node = Node.get_node(Node.Type.MAC, graph)
+                if partial is not None:
+                    graph.connect(partial, node)
+                graph.connect(sub, node)
+                partial = node
+            inertias.append(partial)
+            continue
+
         to_reduce = []
 
         for sub in subs_k:
             quad = Node.get_node(Node.Type.QUAD, graph)
-            graph[sub].append(quad)
+            graph.connect(sub, quad)
             to_reduce.append(quad)
 
-        inertias.append(Node.reduce(to_reduce, Node.Type.ADD, graph))
+        inertias.append(Node.reduce(to_reduce, Node.Type.ADD, graph, arity))
+
+    if tiles > 1:
+        for it, inertia in enumerate(inertias):
+            acc = Node.get_node(Node.Type.ACC, graph)
+            graph.connect(inertia, acc)
+            inertias[it] = acc
+
+    cmp_node = Node.reduce(inertias, Node.Type.CMP, graph, arity)
 
-    cmp_node = Node.reduce(inertias, Node.Type.CMP, graph)
+    graph.balance_paths()
 
     # consts = [Node.get_node(Node.Type.CONST, graph) for x in range(k)]
     # eqs = [Node.get_node(Node.Type.EQ, graph) for x in range(k)]
@@ -228,28 +492,200 @@ def generate_kmeans_core(k, dimensions):
     return graph
 
 
-def validate_configurations(external_data_width, data_width, dimensions):
-    cache_line_fit = external_data_width % (dimensions * data_width) == 0
+@functools.lru_cache(maxsize=None)
+def pipeline_depth(k, dimensions, arity=2, mac=False, tiles=1, folded=False):
+    # cycles from an input line to the kmeans_core output, taken from the
+    # longest path of the balanced dataflow graph. A folded core keeps the
+    # running minimum of the rounds in one more register
+    return generate_kmeans_core(k, dimensions, arity, mac, tiles, folded).latency() + (1 if folded else 0)
+
+
+def fold_units(k, fold=0):
+    # distance units of a kmeans core: one per centroid, or at most fold
+    # that iterate over the centroids
+    if fold:
+        return min(fold, k)
+    return k
+
+
+def fold_rounds(k, fold=0):
+    # cycles of every point in a folded core
+    return -(-k // fold_units(k, fold))
+
+
+def fold_bank_centroids(k, fold=0):
+    # centroid held by every distance unit in every round of a folded core:
+    # round * units + unit, or for the units past the last centroid, the
+    # first centroid of the last round, that never loses the compare tree
+    # to its copy
+    units = fold_units(k, fold)
+    rounds = fold_rounds(k, fold)
+    return [[round * units + unit if round * units + unit < k else (rounds - 1) * units for round in range(rounds)]
+            for unit in range(units)]
+
+
+def core_bus_widths(data_width, sum_k, num_add, tiles=1):
+    # output width of every kmeans_core node type: the data bits followed by
+    # the centroid ID of the value. num_add counts the ADD and MAC nodes; the
+    # sums of the tiles take ceil(log2(tiles)) bits more
+    centroid_id_width = math.ceil(math.log2(sum_k))
+    add_log_width = int(math.log2(num_add)) if num_add > 0 else 0
+    acc_log_width = math.ceil(math.log2(tiles))
+    return {'ACC': acc_log_width + add_log_width + (2 * data_width) + centroid_id_width,
+            'ADD': add_log_width + (2 * data_width) + centroid_id_width,
+            'CMP': acc_log_width + add_log_width + (2 * data_width) + centroid_id_width,
+            'IN': data_width + centroid_id_width,
+            'IMM': data_width + centroid_id_width,
+            'MAC': add_log_width + (2 * data_width) + centroid_id_width,
+            'QUAD': add_log_width + (2 * data_width) + centroid_id_width,
+            'REG': acc_log_width + add_log_width + (2 * data_width) + centroid_id_width,
+            'SUB': data_width + centroid_id_width}
+
+
+def range_width(low, high):
+    # bits of [low, high]: unsigned when low is not negative, two's
+    # complement otherwise
+    if low >= 0:
+        return max(1, high.bit_length())
+    return max(high.bit_length(), (-low - 1).bit_length()) + 1
+
+
+def value_ranges(graph, data_width, tiles=1):
+    # interval of the values of every node, without the centroid ID bits,
+    # for unsigned data_width-bit features and centroids. None for the nodes
+    # without a value
+    top = (1 << data_width) - 1
+    ranges = [None] * len(graph)
+    for node in graph.topological_order():
+        node_type = graph.node_type(node)
+        inputs = [ranges[pred] for pred in graph.predecessors(node)]
+        if node_type in [Node.Type.IN, Node.Type.IMM]:
+            ranges[node] = (0, top)
+        elif not inputs or None in inputs:
+            continue
+        elif node_type == Node.Type.SUB:
+            # data_in_0 - data_in_1, in predecessor order
+            ranges[node] = (inputs[0][0] - inputs[1][1], inputs[0][1] - inputs[1][0])
+        elif node_type == Node.Type.QUAD:
+            ranges[node] = square_range(*inputs[0])
+        elif node_type == Node.Type.MAC:
+            partial = [ranges[pred] for pred in graph.predecessors(node) if graph.node_type(pred) == Node.Type.MAC]
+            data = [ranges[pred] for pred in graph.predecessors(node) if graph.node_type(pred) != Node.Type.MAC]
+            square = square_range(*data[0])
+            ranges[node] = (square[0] + sum(p[0] for p in partial), square[1] + sum(p[1] for p in partial))
+        elif node_type == Node.Type.ADD:
+            ranges[node] = (sum(r[0] for r in inputs), sum(r[1] for r in inputs))
+        elif node_type == Node.Type.ACC:
+            ranges[node] = (tiles * inputs[0][0], tiles * inputs[0][1])
+        elif node_type == Node.Type.CMP:
+            ranges[node] = (min(r[0] for r in inputs), min(r[1] for r in inputs))
+        elif node_type == Node.Type.REG:
+            ranges[node] = inputs[0]
+    return ranges
+
+
+def square_range(low, high):
+    if low <= 0 <= high:
+        return 0, max(low * low, high * high)
+    return min(low * low, high * high), max(low * low, high * high)
+
+
+def node_widths(graph, data_width, tiles=1):
+    # exact data width of every node, without the centroid ID bits: the
+    # width of its value range, except for the CMP nodes, that compare on
+    # the width of their widest input
+    ranges = value_ranges(graph, data_width, tiles)
+    widths = [None] * len(graph)
+    for node in graph.topological_order():
+        if ranges[node] is None:
+            continue
+        if graph.node_type(node) == Node.Type.CMP:
+            widths[node] = max(widths[pred] for pred in graph.predecessors(node))
+        else:
+            widths[node] = range_width(*ranges[node])
+    return widths
+
+
+def centroid_id_tags(graph, ids='datapath'):
+    # nodes whose bus carries the centroid ID above the data: all of them
+    # when the IDs travel through the datapath. With ids='leaves' only the
+    # IMM outputs and the compare tree do, the IDs of the distances being
+    # added as constants at the compare tree inputs
+    if ids != 'leaves':
+        return [True] * len(graph)
+    tags = [False] * len(graph)
+    for node in graph.topological_order():
+        node_type = graph.node_type(node)
+        if node_type in [Node.Type.IMM, Node.Type.CMP]:
+            tags[node] = True
+        elif node_type == Node.Type.REG:
+            tags[node] = any(tags[pred] for pred in graph.predecessors(node))
+    return tags
+
+
+def configuration_width(external_data_width, header='sparse'):
+    # bits of the configuration bus of the cores: an entry of the sparse
+    # header, or a line of the dense header above its ID, from 1
+    if header == 'dense':
+        return 32 + external_data_width
+    return 64
+
+
+def line_cores(external_data_width, data_width, dimensions):
+    # kmeans cores fed by every beat: the points of a cache line when they
+    # fill it, or one more than fit whole in a line, so that the cores keep
+    # up with the line rate behind the input gearbox. A single core takes
+    # the points wider than a line
+    return -(-external_data_width // (data_width * dimensions))
+
+
+def point_tiles(external_data_width, data_width, dimensions):
+    # beats of a point: one, or for the points of two lines or more, as many
+    # as the whole lines of the point, so that every tile but the last is at
+    # least a line wide and a single core keeps up with the line rate
+    point_width = data_width * dimensions
+    if point_width < 2 * external_data_width:
+        return 1
+    tiles = point_width // external_data_width
+    return -(-dimensions // tile_dimensions(dimensions, tiles))
+
+
+def tile_dimensions(dimensions, tiles=1):
+    # features of every tile but the last, that takes the rest
+    return -(-dimensions // tiles)
+
+
+def needs_gearbox(external_data_width, data_width, dimensions):
+    # the points, or their tiles, straddle the cache lines
+    tiles = point_tiles(external_data_width, data_width, dimensions)
+    if tiles > 1:
+        return tile_dimensions(dimensions, tiles) * tiles != dimensions or \
+            tile_dimensions(dimensions, tiles) * data_width != external_data_width
+    return external_data_width % (data_width * dimensions) != 0
 
-    if not cache_line_fit:
-        return False
 
+def write_if_changed(name, string):
+    # the file, and its timestamp, is kept when the content hash is the same
+    digest = hashlib.sha256(string.encode('utf-8')).hexdigest()
+    if os.path.exists(name):
+        with open(name, 'rb') as fp:
+            if hashlib.sha256(fp.read()).hexdigest() == digest:
+                return False
+    with open(name, 'w') as fp:
+        fp.write(string)
     return True
 
 
 def split_modules(str_modules, dir):
-    modules = str_modules.split('endmodule')
-    for m in modules:
+    # writes one <module name>.v file per module and returns the file names,
+    # rewriting only the files whose content changed
+    files = {}
+    for m in re.split(r'^endmodule[ \t]*$', str_modules, flags=re.M):
         m = m.strip(' \n')
-        if m.strip('\n') != '':
-            name = m.split(' ')[1]
-            # name = name.replace('\n','')
-            # name = name.replace('(', '')
-            # name = name.replace(')', '')
-            name = re.sub("[\n()]", "", name)
-            with open(dir + '/%s.v' % (name), 'w') as fm:
-                m = m + '\n\nendmodule'
-                fm.write(m)
+        if m != '':
+            name = re.search(r'^module\s+(\w+)', m, flags=re.M).group(1)
+            files['%s.v' % name] = write_if_changed(dir + '/%s.v' % name, m + '\n\nendmodule\n')
+    return files
 
 
 def bits(n):
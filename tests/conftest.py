@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the generator modules import each other from src, and the pynq host
+# packing lives next to its driver
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'src'))
+sys.path.insert(0, os.path.join(root, 'resources', 'template.prj', 'xilinx_aws_f1', 'sw', 'pynq'))
@@ -0,0 +1,84 @@
+import math
+
+import pytest
+
+from utils import DataflowGraph, Node, generate_kmeans_core, pipeline_depth
+
+
+def closed_form_depth(k, dimensions):
+    # SUB, QUAD, the ADD and CMP trees, and the registers that balance the
+    # fan-out of every input to the SUBs of the k centroids
+    fanout = 0 if k < 3 else math.ceil(math.log2(k)) - 1
+    return 2 + math.ceil(math.log2(dimensions)) + math.ceil(math.log2(k)) + fanout
+
+
+@pytest.mark.parametrize('k, dimensions', [(2, 2), (3, 4), (4, 4), (5, 3), (8, 16), (16, 5)])
+def test_pipeline_depth_matches_the_trees(k, dimensions):
+    assert pipeline_depth(k, dimensions) == closed_form_depth(k, dimensions)
+
+
+@pytest.mark.parametrize('k, dimensions', [(2, 2), (5, 3), (16, 5)])
+def test_node_counts(k, dimensions):
+    core = generate_kmeans_core(k, dimensions)
+    assert core.count(Node.Type.IN) == dimensions
+    assert core.count(Node.Type.IMM) == k * dimensions
+    assert core.count(Node.Type.SUB) == k * dimensions
+    assert core.count(Node.Type.QUAD) == k * dimensions
+    assert core.count(Node.Type.ADD) == k * (dimensions - 1)
+    assert core.count(Node.Type.CMP) == k - 1
+
+
+@pytest.mark.parametrize('options', [{}, {'arity': 3}, {'arity': 4}, {'mac': True}, {'tiles': 3},
+                                     {'folded': True}])
+def test_balanced_paths(options):
+    # every node takes all its pipelined inputs in the same cycle
+    core = generate_kmeans_core(5, 6, **options)
+    arrival = core.arrival_times()
+    for node in core:
+        inputs = {arrival[pred] for pred in core.predecessors(node) if arrival[pred] is not None}
+        assert len(inputs) <= 1
+
+
+def test_pipeline_depth_of_the_variants():
+    assert pipeline_depth(4, 4, arity=4) < pipeline_depth(4, 4)
+    assert pipeline_depth(4, 4, mac=True) == generate_kmeans_core(4, 4, mac=True).latency()
+    # the running minimum of a folded core takes one more register
+    assert pipeline_depth(4, 4, folded=True) == generate_kmeans_core(4, 4, folded=True).latency() + 1
+
+
+def test_replace_input_moves_the_first_edge():
+    graph = DataflowGraph()
+    source = graph.get_node(Node.Type.IN)
+    add = graph.get_node(Node.Type.ADD)
+    graph.connect(source, add)
+    graph.connect(source, add)
+    assert list(graph.predecessors(add)) == [source, source]
+    # the index of the inputs follows the nodes and edges added after it
+    reg = graph.get_node(Node.Type.REG)
+    graph.connect(source, reg)
+    graph.replace_input(source, add, reg)
+    assert list(graph.predecessors(add)) == [source, reg]
+    assert list(graph.successors(reg)) == [add]
+    graph.replace_input(source, add, reg)
+    assert list(graph.predecessors(add)) == [reg, reg]
+    with pytest.raises(Exception):
+        graph.replace_input(source, add, reg)
+
+
+def test_balance_paths_delays_every_early_input():
+    # every ADD takes the input line and its copy a cycle later
+    graph = DataflowGraph()
+    source = graph.get_node(Node.Type.IN)
+    adds = []
+    for _ in range(100):
+        reg = graph.get_node(Node.Type.REG)
+        add = graph.get_node(Node.Type.ADD)
+        graph.connect(source, reg)
+        graph.connect(source, add)
+        graph.connect(reg, add)
+        adds.append(add)
+    assert graph.balance_paths() == 100
+    arrival = graph.arrival_times()
+    for add in adds:
+        assert [graph.node_type(pred) for pred in graph.predecessors(add)] == [Node.Type.REG, Node.Type.REG]
+        assert {arrival[pred] for pred in graph.predecessors(add)} == {1}
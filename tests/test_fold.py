@@ -0,0 +1,32 @@
+import pytest
+
+from utils import fold_bank_centroids, fold_rounds, fold_units
+
+
+@pytest.mark.parametrize('k, fold, units, rounds', [(4, 0, 4, 1), (4, 2, 2, 2), (5, 2, 2, 3), (7, 3, 3, 3),
+                                                    (3, 8, 3, 1), (8, 8, 8, 1), (16, 5, 5, 4)])
+def test_fold_units_and_rounds(k, fold, units, rounds):
+    assert fold_units(k, fold) == units
+    assert fold_rounds(k, fold) == rounds
+
+
+def test_bank_contents():
+    assert fold_bank_centroids(4, 2) == [[0, 2], [1, 3]]
+    # the last round holds centroid 6 alone, copied to the idle units
+    assert fold_bank_centroids(7, 3) == [[0, 3, 6], [1, 4, 6], [2, 5, 6]]
+    assert fold_bank_centroids(3, 0) == [[0], [1], [2]]
+
+
+@pytest.mark.parametrize('k, fold', [(3, 2), (5, 2), (7, 3), (9, 4), (16, 5), (6, 6)])
+def test_banks_hold_every_centroid(k, fold):
+    centroids = fold_bank_centroids(k, fold)
+    assert len(centroids) == fold_units(k, fold)
+    assert all(len(bank) == fold_rounds(k, fold) for bank in centroids)
+    assert sorted(set(c for bank in centroids for c in bank)) == list(range(k))
+    # every round compares distinct centroids but for the copies of its
+    # first one
+    for round in range(fold_rounds(k, fold)):
+        held = [bank[round] for bank in centroids]
+        assert held[0] == min(held)
+        assert len(set(held)) == len(held) - held.count(held[0]) + 1
+
@@ -0,0 +1,179 @@
+import importlib.util
+import random
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from kmeans_packing import flat_clusters, flat_data, header_line, output_bytes
+from make_kmeans_top import make_kmeans_top
+from utils import line_cores, needs_gearbox, point_tiles, tile_dimensions
+
+# external data width, data width, dimensions, cores, tiles, gearbox
+CONFIGURATIONS = [(512, 16, 32, 1, 1, False),
+                  (512, 16, 8, 4, 1, False),
+                  (512, 8, 64, 1, 1, False),
+                  (512, 16, 3, 11, 1, True),
+                  (512, 8, 12, 6, 1, True),
+                  (512, 16, 40, 1, 1, True),
+                  (512, 16, 64, 1, 2, False),
+                  (512, 16, 71, 1, 2, True),
+                  (512, 16, 100, 1, 3, True)]
+
+# the kernel reads the lines of the input, and the writer takes the lines of
+# the size given by the host before it signals done. Every write request is
+# counted until the kernel has been idle for a while after done
+TESTBENCH = '''
+module tb;
+  reg clk = 0, rst = 1, start = 0;
+  reg [511:0] mem [0:4095];
+  integer nlines, expected, rd_ptr, wcount, idle, seen, fd, i;
+  wire request_read, request_write, done;
+  wire [511:0] write_data;
+  wire read_valid = rd_ptr < nlines;
+  reg done_rd = 0, done_wr = 0;
+  kmeans_top dut(.clk(clk), .rst(rst), .start(start), .kmeans_top_done_rd_data(done_rd),
+    .kmeans_top_done_wr_data(done_wr), .kmeans_top_read_data(mem[rd_ptr]), .kmeans_top_request_read(request_read),
+    .kmeans_top_read_data_valid(read_valid), .kmeans_top_available_write(1'b1), .kmeans_top_write_data(write_data),
+    .kmeans_top_request_write(request_write), .kmeans_top_done(done));
+  always #5 clk = ~clk;
+  initial begin
+    $readmemh("in.hex", mem);
+    fd = $fopen("params.txt", "r");
+    i = $fscanf(fd, "%d %d", nlines, expected);
+    $fclose(fd);
+    rd_ptr = 0; wcount = 0; idle = 0; seen = 0;
+    fd = $fopen("out.hex", "w");
+    repeat (5) @(posedge clk);
+    rst = 0;
+    @(posedge clk); start = 1;
+  end
+  always @(posedge clk) begin
+    if (!rst) begin
+      if (request_read && read_valid) rd_ptr <= rd_ptr + 1;
+      done_rd <= (rd_ptr >= nlines);
+      if (request_write) begin $fdisplay(fd, "%h", write_data); wcount <= wcount + 1; end
+      done_wr <= (wcount >= expected);
+      if (done) seen <= 1;
+      if (rd_ptr >= nlines) idle <= idle + 1;
+      if (idle > 5000) begin $display("WRITES %0d DONE %0d", wcount, seen); $fclose(fd); $finish; end
+    end
+  end
+endmodule
+'''
+
+
+def beats(external_data_width, data_width, dimensions):
+    # widths of the beats of a point, in order
+    cores = line_cores(external_data_width, data_width, dimensions)
+    tiles = point_tiles(external_data_width, data_width, dimensions)
+    features = tile_dimensions(dimensions, tiles)
+    last = dimensions - (tiles - 1) * features
+    return [cores * data_width * features] * (tiles - 1) + [cores * data_width * last]
+
+
+@pytest.mark.parametrize('external_data_width, data_width, dimensions, cores, tiles, gearbox', CONFIGURATIONS)
+def test_line_mapping(external_data_width, data_width, dimensions, cores, tiles, gearbox):
+    assert line_cores(external_data_width, data_width, dimensions) == cores
+    assert point_tiles(external_data_width, data_width, dimensions) == tiles
+    assert needs_gearbox(external_data_width, data_width, dimensions) == gearbox
+    widths = beats(external_data_width, data_width, dimensions)
+    # the cores of a beat keep up with a line
+    assert widths[0] >= external_data_width
+    assert 0 < widths[-1] <= widths[0]
+    # without gearbox the beats are the lines
+    if not gearbox:
+        assert widths == [external_data_width] * tiles
+
+
+@pytest.mark.parametrize('data_width, dimensions', [(16, 8), (16, 3), (8, 3), (12, 7), (16, 71), (8, 200)])
+def test_output_bytes(data_width, dimensions):
+    # a label per core of every beat, the last one flushed by the gearbox
+    for num_points in range(1, 200):
+        point_lines = -(-num_points * dimensions * data_width // 512)
+        widths = beats(512, data_width, dimensions)
+        cores = line_cores(512, data_width, dimensions)
+        labels = 0
+        bits = point_lines * 512
+        while bits > sum(widths[:-1]):
+            bits -= sum(widths)
+            labels += cores
+        assert output_bytes(num_points, dimensions, data_width) == -(-labels // 64) * 64
+        assert output_bytes(num_points, dimensions, data_width, 8) == -(-labels * 8 // 64) * 64
+
+
+def simulator():
+    if shutil.which('iverilog'):
+        return 'iverilog'
+    if shutil.which('verilator') or importlib.util.find_spec('verilator'):
+        return 'verilator'
+    pytest.skip('no Verilog simulator')
+
+
+def build(path, module):
+    path.mkdir(exist_ok=True)
+    module.to_verilog(str(path / 'kmeans_top.v'))
+    (path / 'tb.v').write_text(TESTBENCH)
+    sources = [str(path / 'tb.v'), str(path / 'kmeans_top.v')]
+    if simulator() == 'iverilog':
+        subprocess.run(['iverilog', '-g2012', '-o', str(path / 'sim')] + sources, check=True, capture_output=True)
+        return ['vvp', str(path / 'sim')]
+    verilator = [shutil.which('verilator')] if shutil.which('verilator') else [sys.executable, '-m', 'verilator']
+    subprocess.run(verilator + ['--binary', '-Wno-fatal', '-Wno-lint', '-Wno-style', '--top-module', 'tb', '-o', 'sim',
+                                '-Mdir', str(path / 'obj')] + sources, check=True, capture_output=True)
+    return [str(path / 'obj' / 'sim')]
+
+
+def launch(path, command, lines, expected):
+    # the lines written, and whether the kernel finished
+    with open(path / 'in.hex', 'w') as fp:
+        fp.writelines('%0128x\n' % line for line in lines)
+    (path / 'params.txt').write_text('%d %d\n' % (len(lines), expected))
+    result = subprocess.run(command, cwd=str(path), check=True, capture_output=True, text=True)
+    summary = [line.split() for line in result.stdout.splitlines() if line.startswith('WRITES')][0]
+    written = [int(line, 16) for line in (path / 'out.hex').read_text().split()]
+    assert len(written) == int(summary[1])
+    return written, summary[3] == '1'
+
+
+def lines_of(buffer):
+    value = int.from_bytes(bytes(buffer), 'little')
+    return [(value >> (512 * i)) & ((1 << 512) - 1) for i in range(-(-len(buffer) // 64))]
+
+
+def words_of(lines, width):
+    return [(line >> (i * width)) & ((1 << width) - 1) for line in lines for i in range(512 // width)]
+
+
+@pytest.mark.parametrize('data_width, dimensions, options, point_counts',
+                         [(16, 8, {}, [64, 10]),
+                          (16, 3, {}, [64, 7, 43]),
+                          (8, 3, {}, [43]),
+                          (12, 7, {}, [30, 61]),
+                          (16, 71, {}, [5, 9]),
+                          (16, 5, {'multipass': True}, [7, 20]),
+                          (16, 71, {'multipass': True}, [9])])
+def test_kernel_writes_the_host_output(tmp_path, data_width, dimensions, options, point_counts):
+    # the labels, or multipass states, of the generated kernel behind the input
+    # gearbox, on the output size of the hosts
+    k = 2
+    command = build(tmp_path, make_kmeans_top(512, data_width, [k], dimensions, **options))
+    rng = random.Random(dimensions)
+    word_bytes = 8 if options.get('multipass') else 1
+    for num_points in point_counts:
+        points = [[rng.randrange(1 << (data_width - 2)) for _ in range(dimensions)] for _ in range(num_points)]
+        centroids = [[rng.randrange(1 << (data_width - 2)) for _ in range(dimensions)] for _ in range(k)]
+        expected = output_bytes(num_points, dimensions, data_width, word_bytes) // 64
+        # the points start on the line after the configuration
+        configuration = flat_clusters(centroids)
+        configuration += [0] * (-len(configuration) % 64)
+        lines = lines_of(header_line(k * dimensions, num_points) + configuration + flat_data(points, data_width))
+        written, done = launch(tmp_path, command, lines, expected)
+        assert done
+        assert len(written) == expected
+        labels = words_of(written, 8 * word_bytes)[:num_points]
+        if word_bytes == 8:
+            labels = [state & 0xffff for state in labels]
+        distances = [[sum((p - c) ** 2 for p, c in zip(point, centroid)) for centroid in centroids] for point in points]
+        assert labels == [d.index(min(d)) for d in distances]
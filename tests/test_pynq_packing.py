@@ -0,0 +1,96 @@
+import numpy as np
+
+from kmeans_packing import header_line, flat_clusters, flat_data, merge_states, unpack_accumulators, \
+    unpack_persistent
+from utils import accumulator_width, accumulator_word_width, header_slot_width, state_id_width, state_width
+
+
+def words(buffer, width=64):
+    value = int.from_bytes(bytes(buffer), 'little')
+    return [(value >> (i * width)) & ((1 << width) - 1) for i in range(len(buffer) * 8 // width)]
+
+
+def test_header_line():
+    assert words(header_line(4 * 3, 1000, 7)) == [12, 1000 | 7 << 32, 0, 0, 0, 0, 0, 0]
+    assert words(header_line(8 * 3, id_base=16)) == [24 | 16 << 32, 0, 0, 0, 0, 0, 0, 0]
+
+
+def test_sparse_clusters():
+    # a 64-bit entry per coordinate: the IMM ID from 1 below the value
+    assert words(flat_clusters([[5, 6], [7, 8]])) == [1 | 5 << 32, 2 | 6 << 32, 3 | 7 << 32, 4 | 8 << 32]
+
+
+def test_dense_clusters():
+    # 16-bit values in IMM ID order, the line padded with zeros
+    packed = flat_clusters([[5, 6, 7], [8, 9, 10]], 'dense')
+    assert len(packed) == 64
+    assert words(packed, header_slot_width) == [5, 6, 7, 8, 9, 10] + [0] * 26
+    # a whole number of lines
+    assert len(flat_clusters(np.ones((4, 16)), 'dense')) == 128
+    assert len(flat_clusters(np.ones((3, 11)), 'dense')) == 128
+
+
+def test_flat_data():
+    points = [[1, 2, 3], [4, 5, 6]]
+    assert flat_data(points, 8) == [1, 2, 3, 4, 5, 6]
+    assert words(flat_data(points, 16), 16) == [1, 2, 3, 4, 5, 6]
+    assert words(flat_data(points, 32), 32) == [1, 2, 3, 4, 5, 6]
+
+
+def test_flat_data_packs_the_bits():
+    # 12-bit features straddle the bytes, the first at the LSB
+    rng = np.random.default_rng(12)
+    points = rng.integers(0, 1 << 12, (4, 3))
+    packed = flat_data(points, 12)
+    assert len(packed) == 4 * 3 * 12 // 8
+    assert words(packed, 12) == points.flatten().tolist()
+
+
+def states(distances, labels, id_base):
+    # the state a multipass kernel writes per point
+    return np.array([d << state_id_width | id_base + label for d, label in zip(distances, labels)],
+                    dtype='<u8').view('u1')
+
+
+def test_state_layout():
+    assert state_width == 64
+    best = np.full((1,), np.iinfo('u8').max, dtype='u8')
+    labels = np.zeros((1,), dtype='u2')
+    merge_states(states([(1 << 48) - 1], [3], 65530), best, labels)
+    assert best[0] == (1 << 48) - 1
+    assert labels[0] == 65533
+
+
+def test_merge_states_of_the_blocks():
+    best = np.full((4,), np.iinfo('u8').max, dtype='u8')
+    labels = np.zeros((4,), dtype='u2')
+    merge_states(states([10, 20, 30, 40], [0, 1, 2, 3], 0), best, labels)
+    merge_states(states([5, 20, 35, 0], [1, 0, 3, 2], 4), best, labels)
+    # the nearer state wins, and a tie keeps the first block
+    assert labels.tolist() == [5, 1, 2, 6]
+    assert best.tolist() == [5, 20, 30, 0]
+
+
+def test_accumulator_drain_order():
+    # the clusters in order, the sums of a cluster before its count; the
+    # line is padded past the last accumulator
+    k, n = 3, 2
+    drained = [10, 11, 2, 20, 21, 3, (1 << accumulator_width) - 1, 31, 4, 0, 0, 0]
+    output = np.array(drained, dtype='<u8').view('u1')
+    assert accumulator_word_width == 64
+    sums, counts = unpack_accumulators(output, k, n)
+    assert sums.tolist() == [[10, 11], [20, 21], [(1 << accumulator_width) - 1, 31]]
+    assert counts.tolist() == [2, 3, 4]
+
+
+def test_persistent_result():
+    # the passes and the convergence bit, then the centroids above their
+    # IMM IDs
+    k, n = 2, 2
+    centroids = [[100, 200], [300, 400]]
+    result = [7 | 1 << 32] + words(flat_clusters(centroids)) + [0] * 3
+    passes, converged, final = unpack_persistent(np.array(result, dtype='<u8').view('u1'), k, n)
+    assert (passes, converged) == (7, True)
+    assert final.tolist() == centroids
+    passes, converged, final = unpack_persistent(np.array([12] + result[1:], dtype='<u8').view('u1'), k, n)
+    assert (passes, converged) == (12, False)
@@ -0,0 +1,34 @@
+from components import Components
+from make_kmeans_core import tile_imm_ids
+from utils import tile_dimensions
+
+
+def test_tile_imm_ids():
+    # 71 features in 2 tiles of 36, the last one padded with a zero
+    assert tile_imm_ids(0, 36, 71, 2) == [1, 37]
+    assert tile_imm_ids(34, 36, 71, 2) == [35, 71]
+    assert tile_imm_ids(35, 36, 71, 2) == [36, 0]
+    assert tile_imm_ids(36, 36, 71, 2) == [72, 108]
+    assert tile_imm_ids(71, 36, 71, 2) == [107, 0]
+
+
+def test_tile_imm_ids_after_the_preceding_kmeans():
+    assert tile_imm_ids(35, 36, 71, 2, imm_id_base=142) == [178, 0]
+    assert tile_imm_ids(36, 36, 71, 2, imm_id_base=142) == [214, 250]
+
+
+def test_tile_imm_ids_cover_the_configuration():
+    # every coordinate of the k centroids is loaded by a single tile of a
+    # single IMM, and the padding by none
+    for k, full_dimensions, tiles in [(2, 71, 2), (3, 100, 3), (4, 64, 2), (2, 65, 5)]:
+        dimensions = tile_dimensions(full_dimensions, tiles)
+        ids = [imm_id for number in range(k * dimensions)
+               for imm_id in tile_imm_ids(number, dimensions, full_dimensions, tiles)]
+        assert sorted(i for i in ids if i) == list(range(1, k * full_dimensions + 1))
+        assert ids.count(0) == k * (dimensions * tiles - full_dimensions)
+
+
+def test_padding_tiles_have_no_register():
+    verilog = Components().create_imm_tiled(3).to_verilog()
+    for tile in range(3):
+        assert 'generate if(IMM_ID_%d != 0) begin : tile_%d' % (tile, tile) in verilog
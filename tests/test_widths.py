@@ -0,0 +1,48 @@
+import math
+
+import pytest
+
+from utils import Node, core_bus_widths, generate_kmeans_core, node_widths, range_width, value_ranges
+
+
+@pytest.mark.parametrize('low, high, width', [(0, 0, 1), (0, 1, 1), (0, 255, 8), (0, 256, 9), (-1, 0, 1),
+                                              (-128, 127, 8), (-255, 255, 9), (-129, 0, 9)])
+def test_range_width(low, high, width):
+    assert range_width(low, high) == width
+
+
+def test_value_ranges_of_the_distance():
+    data_width = 8
+    top = (1 << data_width) - 1
+    core = generate_kmeans_core(2, 4)
+    ranges = value_ranges(core, data_width)
+    widths = node_widths(core, data_width)
+    for node in core:
+        node_type = core.node_type(node)
+        if node_type == Node.Type.SUB:
+            assert ranges[node] == (-top, top)
+            assert widths[node] == data_width + 1
+        elif node_type == Node.Type.QUAD:
+            assert ranges[node] == (0, top * top)
+            assert widths[node] == 2 * data_width
+    # the full sum of the squares of the 4 features
+    assert max(widths[node] for node in core if core.node_type(node) == Node.Type.ADD) == 2 * data_width + 2
+
+
+@pytest.mark.parametrize('options', [{}, {'arity': 3}, {'mac': True}, {'tiles': 2}, {'folded': True}])
+def test_exact_widths_fit_the_uniform_bus(options):
+    data_width = 16
+    tiles = options.get('tiles', 1)
+    core = generate_kmeans_core(3, 5, **options)
+    widths = node_widths(core, data_width, tiles)
+    num_add = core.count(Node.Type.ADD) + core.count(Node.Type.MAC)
+    uniform = core_bus_widths(data_width, 3, num_add, tiles)
+    id_width = math.ceil(math.log2(3))
+    for node in core:
+        # the uniform SUB wraps its difference in the data width, the exact
+        # one keeps the sign bit
+        if widths[node] is None or core.node_type(node) == Node.Type.SUB:
+            continue
+        assert widths[node] <= uniform[core.node_type(node).name] - id_width
+        if core.node_type(node) == Node.Type.CMP:
+            assert widths[node] == max(widths[pred] for pred in core.predecessors(node))